@@ -1,18 +1,19 @@
 # -*- coding: utf-8 -*-
-#TODO: USE HANDLER SOCKET OR SOME FORM OF CACHING
 import logging
 from logging.handlers import RotatingFileHandler
-from hashlib import sha256
 
 __author__ = 'qweqwe'
 
 from flask import Flask, request, make_response, abort
 from urlparse import urlparse
 from datetime import datetime
-from coltrane.db.models import User, Application, AppToken
+from coltrane.db.models import Application, AppToken
 from coltrane.db.extension import db
+from coltrane.rest.lib.guard_manager import GuardManager
+from coltrane.utils import TTLCache
 from coltrane import config
 from coltrane.apphosting.config import DefaultConfig
+from coltrane.apphosting import securelink
 
 app = Flask(__name__)
 app.config.from_object(DefaultConfig)
@@ -36,6 +37,15 @@ error_file_handler.setLevel(logging.WARNING)
 error_file_handler.setFormatter(formatter)
 app.logger.addHandler(error_file_handler)
 
+# every asset of the app passes through before_request, so users
+# and ids of apps are cached instead of querying db for each of them.
+# Users are cached the same way REST does it, so regenerated auth tokens
+# are invalidated in every process through the shared cache.
+# Unknown domains are cached as False
+users = GuardManager(app.config['CACHE_TTL'], app.config['CACHE_SIZE'])
+apps_cache = TTLCache(app.config['CACHE_TTL'], app.config['CACHE_SIZE'])
+tokens_cache = TTLCache(app.config['CACHE_TTL'], app.config['CACHE_SIZE'])
+
 
 @app.before_request
 def before_request():
@@ -48,21 +58,27 @@ def before_request():
     auth_token = request.cookies.get(config.COOKIE_USER_AUTH_TOKEN)
     app_token = request.cookies.get(config.COOKIE_APP_TOKEN)
     anonymous = request.cookies.get(config.COOKIE_ANONYMOUS_TOKEN)
+    hosting_link = request.cookies.get(config.COOKIE_HOSTING_LINK)
+    secret = app.config.get('HOSTING_SECRET')
+
+    # nginx serves files itself when the cookie is valid,
+    # the same check is done here for setups without nginx
+    if secret and hosting_link and securelink.verify(secret, hosting_link,
+                                full_domain.lower(), auth_token, app_token):
+        response.headers['X-Accel-Redirect'] = "/files/"+base_path
+        return response
 
     # if user opens this app for the first time
     if auth_token and not app_token:
-        # generate token
-        user = User.query.filter(User.auth_hash ==  sha256(auth_token).hexdigest()).first()
-        app  = Application.query.filter(Application.domain == app_domain).first()
-        if not app:
-            print 'app with domin %s was not found' % app_domain
+        app_id = get_app_id(app_domain)
+        if not app_id:
+            app.logger.debug('app with domain %s was not found', app_domain)
             return abort(404)
-        token = AppToken(user, app)
-        db.session.add(token)
-        db.session.commit()
-        print 'setting cookies'
-        response.set_cookie(config.COOKIE_APP_TOKEN, value=token.token,
-                            domain=full_domain, httponly=True)
+        user_id = get_user_id(auth_token)
+        if user_id:
+            app_token = get_app_token(user_id, app_id)
+            response.set_cookie(config.COOKIE_APP_TOKEN, value=app_token,
+                                domain=full_domain, httponly=True)
 
     # if user was anonymous but have authenticated
     if auth_token and anonymous:
@@ -74,10 +90,42 @@ def before_request():
         response.set_cookie(config.COOKIE_ANONYMOUS_TOKEN, value='true',
                             domain=full_domain)
 
+    # all cookies are issued, so next requests don't need apphosting
+    if secret and (app_token or not auth_token):
+        ttl = app.config['HOSTING_LINK_TTL']
+        response.set_cookie(config.COOKIE_HOSTING_LINK,
+            value=securelink.make(secret, ttl, full_domain.lower(),
+                                  auth_token, app_token),
+            max_age=ttl, domain=full_domain, httponly=True)
+
     response.headers['X-Accel-Redirect'] = "/files/"+base_path
     return response
 
 
+def get_user_id(auth_token):
+    user = users.authenticate_user(auth_token)
+    return user.id if user else False
+
+
+def get_app_id(domain):
+    app_id = apps_cache.get(domain)
+    if app_id is None:
+        application = Application.query.filter(Application.domain == domain).first()
+        app_id = application.id if application else False
+        apps_cache.set(domain, app_id)
+    return app_id
+
+
+def get_app_token(user_id, app_id):
+    """ Returns token of the user for the app. Assets of a page are requested
+        at once, so all of them get the same token """
+    token = tokens_cache.get((user_id, app_id))
+    if token is None:
+        token = AppToken.get_or_create(user_id, app_id).token
+        tokens_cache.set((user_id, app_id), token)
+    return token
+
+
 def get_subdomain():
     host = urlparse(request.url_root).netloc.split(':')[0]
     #olololo, super magic,
@@ -3,8 +3,14 @@
     :Authors: - qweqwe
 """
 
+import os
 from coltrane.config import DefaultConfig as dc
 
 class DefaultConfig(dc):
     DEBUG_LOG          = '/web/hosting/debug.log'
     ERROR_LOG          = '/web/hosting/error.log'
+    CACHE_TTL          = 60
+    CACHE_SIZE         = 10000
+    #: shared with nginx, signed hosting cookie isn't issued without it
+    HOSTING_SECRET     = os.environ.get('COLTRANE_HOSTING_SECRET')
+    HOSTING_LINK_TTL   = 3600
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+    Signed cookie letting nginx serve app files without asking apphosting.
+
+    nginx verifies it with ngx_http_secure_link_module, see
+    etc/nginx/hosting.cfg, the expression signed here must match
+    secure_link_md5 directive there:
+
+        "$secure_link_expires$host$cookie_auth_token$cookie_app_token $hosting_secret"
+
+    The cookie value is "<hash>.<expires>", comma would make werkzeug quote
+    it, nginx turns it into "<hash>,<expires>" expected by secure_link. Auth and app tokens are signed
+    too, so once they change the cookie is not valid anymore and request
+    goes to apphosting which issues new tokens and a new cookie.
+"""
+
+import hmac
+import time
+from base64 import urlsafe_b64encode
+from hashlib import md5
+
+
+def sign(secret, expires, host, auth_token, app_token):
+    expression = '%d%s%s%s %s' % (expires, host, auth_token or '',
+                                  app_token or '', secret)
+    return urlsafe_b64encode(md5(expression).digest()).rstrip('=')
+
+
+def make(secret, ttl, host, auth_token, app_token):
+    """ Returns value of the cookie valid for ttl seconds """
+    expires = int(time.time()) + ttl
+    return '%s.%d' % (sign(secret, expires, host, auth_token, app_token),
+                      expires)
+
+
+def verify(secret, value, host, auth_token, app_token):
+    """ Same check as nginx does, used when apphosting runs without it """
+    try:
+        signature, expires = value.split('.')
+        expires = int(expires)
+    except ValueError:
+        return False
+    if expires < time.time():
+        return False
+    return _equal(signature, sign(secret, expires, host, auth_token, app_token))
+
+
+def _compare_digest(a, b):
+    """ Compares strings in time not depending on their contents,
+        hmac.compare_digest appeared only in python 2.7.7 """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+_equal = getattr(hmac, 'compare_digest', _compare_digest)
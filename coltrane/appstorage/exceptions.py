@@ -20,6 +20,16 @@ class DocumentNotFoundError(StorageError):
 
 
 
+class DocumentExistsError(StorageError):
+    """Error raised when live document with the key already exists"""
+
+    message = "Document with bucket [{bucket}] and key [{key}] already exists"
+
+    def __init__(self, message=None, **kwargs):
+        super(DocumentExistsError, self).__init__(message, **kwargs)
+
+
+
 class InvalidAppIdError(StorageError):
     """Error raised when application id is invalid"""
 
@@ -56,3 +66,25 @@ class InvalidDocumentError(StorageError):
 
     def __init__(self, message, **kwargs):
         super(InvalidDocumentError, self).__init__(message, **kwargs)
+
+
+
+class IndexQuotaExceededError(StorageError):
+    """Error raised when application declared all indexes it may have"""
+
+    message = "Application may declare no more than {max_indexes} indexes"
+
+    def __init__(self, message=None, **kwargs):
+        super(IndexQuotaExceededError, self).__init__(message, **kwargs)
+
+
+
+class IndexLimitExceededError(StorageError):
+    """Error raised when indexes declared by all applications reached the limit"""
+
+    GEO_INDEXES = "No more than {max_indexes} geo indexes may be declared"
+
+    message = "No more than {max_indexes} indexes may be declared by all applications"
+
+    def __init__(self, message=None, **kwargs):
+        super(IndexLimitExceededError, self).__init__(message, **kwargs)
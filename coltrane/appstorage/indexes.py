@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+    Indexes of appdata collection matching query shapes of AppdataStorage.
+    All documents live in one collection and every query is scoped by
+    __hashid__, so every index starts with it, except geo indexes which
+    have to be the first key of compound index.
+    Requests never create indexes, they are created at start or declared
+    by applications, so tenants can't lock the collection or use up
+    the limit of indexes it may have.
+"""
+
+from datetime import datetime
+from hashlib import sha1
+from pymongo import ASCENDING, DESCENDING, GEO2D
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from coltrane.appstorage import intf, extf, reservedf
+from coltrane.appstorage.exceptions import IndexQuotaExceededError, IndexLimitExceededError
+from coltrane.appstorage.typeconverters import GeoPointConverter
+
+
+# sort is followed by _id, so documents with equal values keep their order,
+# indexes of sort fields end with _id to serve it
+DEFAULT_INDEXES = (
+    [(intf.HASHID, ASCENDING)],
+    [(intf.HASHID, ASCENDING), (reservedf.CREATED_AT, ASCENDING), (intf.ID, ASCENDING)],
+    [(intf.HASHID, ASCENDING), (reservedf.UPDATED_AT, ASCENDING), (intf.ID, ASCENDING)],
+)
+
+# db 2.2+ removes documents once _expires_at passes, older versions
+# ignore the option and expired documents are removed by Purger
+TTL_INDEX = [(reservedf.EXPIRES_AT, ASCENDING)]
+
+
+class IndexManager(object):
+    """
+        Creates missing indexes of the collection.
+        Existing indexes are read from db once, so creating an index
+        that already exists costs nothing.
+    """
+
+    def __init__(self, entities):
+        """
+            :param entities: MongoDB collection object
+        """
+        self.entities = entities
+        self.known = None
+
+    def ensure_default_indexes(self):
+        for keys in DEFAULT_INDEXES:
+            self.ensure_index(keys)
+        self.ensure_index(TTL_INDEX, expireAfterSeconds=0, sparse=True)
+
+    def ensure_index(self, keys, **kwargs):
+        if self.known is None:
+            self.known = set(_normalize(info['key']) for info in
+                             self.entities.index_information().values())
+        normalized = _normalize(keys)
+        if normalized not in self.known:
+            self.entities.create_index(keys, **kwargs)
+            self.known.add(normalized)
+
+
+DECLARATION_APP_ID = 'app_id'
+DECLARATION_BUCKET = 'bucket'
+DECLARATION_FIELDS = 'fields'
+
+# counters of declarations have no app_id, so they are never listed
+COUNTER_PREFIX = 'count:'
+COUNTER_VALUE = 'value'
+ALL_COUNTER = COUNTER_PREFIX + 'all'
+GEO_COUNTER = COUNTER_PREFIX + 'geo'
+
+
+class DeclaredIndexes(object):
+    """
+        Indexes declared by applications for fields they filter and sort on.
+        Index is created in appdata collection as compound index prefixed by
+        __hashid__, so it serves queries of every user of the bucket.
+        Declarations are kept in separate collection, they are counted
+        against quota of the application and against limit of all
+        applications, db keeps no more than 64 indexes of collection.
+        Counters are kept in the same collection and changed atomically,
+        so concurrent requests can't declare more than quota.
+    """
+
+    def __init__(self, entities, declarations):
+        """
+            :param entities: MongoDB collection object with appdata
+            :param declarations: MongoDB collection object with declarations
+        """
+        self.declarations = declarations
+        self.indexes = IndexManager(entities)
+
+    def declare(self, app_id, bucket, fields, max_indexes=None,
+                max_geo_indexes=None, max_all_indexes=None):
+        """
+            Creates index on the fields of the bucket.
+            Parameters:
+            fields: List of (field, direction) pairs, field is external name.
+                Geo index has one field with GEO2D direction
+            max_indexes: Int, how many indexes the app may declare at all
+            max_geo_indexes: Int, how many geo indexes all apps may declare,
+                db 2.0 uses only one 2d index of collection
+            max_all_indexes: Int, how many indexes all apps may declare
+
+            Returns True if index was declared, False if it already existed
+        """
+        if not fields:
+            raise RuntimeError('At least one field must be passed')
+        geo = fields[0][1] == GEO2D
+        if geo and len(fields) > 1:
+            raise RuntimeError('Geo index must have one field')
+        for field, direction in fields:
+            if direction not in (ASCENDING, DESCENDING) and not geo:
+                raise RuntimeError('Direction of field %s must be 1 or -1' % field)
+
+        id = _declaration_id(app_id, bucket, fields)
+        if self.declarations.find_one({'_id': id}, fields=['_id']):
+            return False
+
+        counters = []
+        try:
+            self._take(_app_counter(app_id), {DECLARATION_APP_ID: app_id},
+                       max_indexes, counters,
+                       IndexQuotaExceededError(max_indexes=max_indexes))
+            self._take(ALL_COUNTER, {DECLARATION_APP_ID: {'$exists': True}},
+                       max_all_indexes, counters,
+                       IndexLimitExceededError(max_indexes=max_all_indexes))
+            if geo:
+                self._take(GEO_COUNTER, {DECLARATION_FIELDS + '.0.1': GEO2D},
+                           max_geo_indexes, counters,
+                           IndexLimitExceededError(IndexLimitExceededError.GEO_INDEXES,
+                                                   max_indexes=max_geo_indexes))
+            self.declarations.insert({
+                '_id': id,
+                DECLARATION_APP_ID: app_id,
+                DECLARATION_BUCKET: bucket,
+                DECLARATION_FIELDS: [list(f) for f in fields],
+                reservedf.CREATED_AT: datetime.utcnow()
+            }, safe=True)
+        except DuplicateKeyError:
+            # the same index was declared by concurrent request
+            self._release(counters)
+            return False
+        except Exception:
+            self._release(counters)
+            raise
+
+        # index could be dropped by another process since it was read
+        self.indexes.known = None
+        try:
+            self.indexes.ensure_index(_index_keys(fields), background=True)
+        except Exception:
+            self.declarations.remove({'_id': id}, safe=True)
+            self._release(counters)
+            raise
+        return True
+
+    def undeclare(self, app_id, bucket, fields):
+        """
+            Removes declaration of index on the fields of the bucket.
+            Index is dropped unless another declaration uses it.
+
+            Returns True if index was declared, False otherwise
+        """
+        result = self.declarations.remove(
+            {'_id': _declaration_id(app_id, bucket, fields)}, safe=True)
+        if not result.get('n'):
+            return False
+        counters = [_app_counter(app_id), ALL_COUNTER]
+        if fields[0][1] == GEO2D:
+            counters.append(GEO_COUNTER)
+        self._release(counters)
+
+        if not self.declarations.find_one(
+                {DECLARATION_FIELDS: [list(f) for f in fields]}, fields=['_id']):
+            keys = _index_keys(fields)
+            try:
+                self.indexes.entities.drop_index(keys)
+            except OperationFailure:
+                # already dropped by concurrent request
+                pass
+            if self.indexes.known is not None:
+                self.indexes.known.discard(_normalize(keys))
+        return True
+
+    def _take(self, counter, criteria, limit, taken, error):
+        """
+            Increments counter unless it reached the limit, raises error
+            otherwise. Taken counter is appended to taken list.
+            Missing counter starts from number of declarations
+            matching criteria.
+        """
+        query = {'_id': counter}
+        if limit is not None:
+            query[COUNTER_VALUE] = {'$lt': limit}
+        update = {'$inc': {COUNTER_VALUE: 1}}
+        found = self.declarations.find_and_modify(query, update)
+        if found is None and not self.declarations.find_one({'_id': counter}):
+            try:
+                self.declarations.insert({'_id': counter, COUNTER_VALUE:
+                    self.declarations.find(criteria).count()}, safe=True)
+            except DuplicateKeyError:
+                pass
+            found = self.declarations.find_and_modify(query, update)
+        if found is None:
+            raise error
+        taken.append(counter)
+
+    def _release(self, counters):
+        for counter in counters:
+            self.declarations.update({'_id': counter, COUNTER_VALUE: {'$gt': 0}},
+                                     {'$inc': {COUNTER_VALUE: -1}}, safe=True)
+
+    def find(self, app_id, bucket=None):
+        """
+            Returns indexes declared by the app for the bucket
+            or for all buckets if bucket is None
+        """
+        criteria = {DECLARATION_APP_ID: app_id}
+        if bucket is not None:
+            criteria[DECLARATION_BUCKET] = bucket
+        cursor = self.declarations.find(criteria, fields={'_id': False})
+        cursor = cursor.sort(reservedf.CREATED_AT, ASCENDING)
+        indexes = []
+        for declaration in cursor:
+            del declaration[DECLARATION_APP_ID]
+            declaration[DECLARATION_FIELDS] = [tuple(f) for f in
+                                               declaration[DECLARATION_FIELDS]]
+            indexes.append(declaration)
+        return indexes
+
+
+def _index_keys(fields):
+    """ Keys of appdata index serving declared fields """
+    if fields[0][1] == GEO2D:
+        return [(_geo_key(fields[0][0]), GEO2D), (intf.HASHID, ASCENDING)]
+    keys = [(intf.HASHID, ASCENDING)] + [(intf.ID if field == extf.KEY else field, direction)
+                                         for field, direction in fields]
+    field, direction = keys[-1]
+    if field != intf.ID:
+        # sort by the fields is followed by _id in the same direction
+        keys.append((intf.ID, direction))
+    return keys
+
+
+def _app_counter(app_id):
+    return COUNTER_PREFIX + 'app:' + app_id
+
+
+def _declaration_id(app_id, bucket, fields):
+    signature = ','.join('%s:%s' % (field, direction) for field, direction in fields)
+    return sha1('|'.join([app_id, bucket, signature]).encode('utf-8')).hexdigest()
+
+
+def _geo_key(field):
+    """ Geo point is stored under prefixed key """
+    head, _, last = field.rpartition('.')
+    return (head + '.' if head else '') + GeoPointConverter.START_FOR_GEO_KEY + last
+
+
+def _normalize(keys):
+    """ Index keys as they are returned by db, i.e. with float directions """
+    return tuple((str(field), direction if isinstance(direction, basestring)
+                                        else int(direction))
+                 for field, direction in keys)
+
+
+def _geo_paths(document, prefix=''):
+    """ Returns paths of all geo fields of internal document """
+    paths = set()
+    for key, val in document.items():
+        if key.startswith('$'):
+            # atomic operation or query operator, its keys are fields
+            path = prefix.rstrip('.')
+        else:
+            path = prefix + key
+            if key.split('.')[-1].startswith(GeoPointConverter.START_FOR_GEO_KEY):
+                paths.add(path)
+                continue
+        if type(val) == dict:
+            paths.update(_geo_paths(val, path + '.' if path else ''))
+        elif type(val) == list:
+            for v in val:
+                if type(v) == dict:
+                    paths.update(_geo_paths(v, path + '.' if path else ''))
+    return paths
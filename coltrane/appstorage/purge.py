@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+    Purge of soft-deleted documents.
+    delete only flags documents, so they stay in appdata collection and
+    its indexes forever. Purger removes documents deleted longer than
+    retention period ago. It works in small batches with pauses between
+    them, so it doesn't compete with requests, and saves checkpoint after
+    every batch, so interrupted run is continued by the next one.
+    Expired documents are removed as well, db 2.0 has no TTL indexes.
+"""
+
+import logging
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from time import sleep, time
+from bson import BSON
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from coltrane.appstorage import intf, reservedf
+from coltrane.appstorage.indexes import IndexManager
+from coltrane.appstorage.retry import RetryPolicy
+from coltrane.utils import Enum
+
+
+LOG = logging.getLogger('coltrane.appstorage.purge')
+
+# removed documents are scanned in order of deletion time,
+# delete sets _updated_at so it is the time of deletion
+PURGE_INDEX = [(intf.DELETED, ASCENDING), (reservedf.UPDATED_AT, ASCENDING),
+               (intf.ID, ASCENDING)]
+
+CHECKPOINT_ID = 'purge'
+
+
+class checkpointf(Enum):
+    # [_updated_at, _id] of the last scanned document of unfinished run
+    POSITION     = 'position'
+    REMOVED      = 'removed'
+    BYTES        = 'bytes'
+    STARTED_AT   = 'started_at'
+    FINISHED_AT  = 'finished_at'
+    LOCKED_UNTIL = 'locked_until'
+
+
+class report(Enum):
+    REMOVED = 'removed'
+    EXPIRED = 'expired'
+    BYTES   = 'bytes'
+    BATCHES = 'batches'
+    SECONDS = 'seconds'
+
+
+class Purger(object):
+    """
+        Removes soft-deleted documents for good.
+        Only one run at a time goes on, it holds a lease in checkpoint
+        collection, so purge may be started by several processes or hosts.
+    """
+
+    def __init__(self, entities, checkpoints, retention, app_retention=None,
+                 batch_size=500, pause=0.1, lease=600, retry=None):
+        """
+            :param entities: MongoDB collection object with appdata
+            :param checkpoints: MongoDB collection object keeping checkpoint
+            :param retention: seconds, documents deleted earlier are removed
+            :param app_retention: dict of app_id and its own retention
+            :param batch_size: how many documents are removed at once
+            :param pause: seconds between batches
+            :param lease: seconds, run which doesn't save checkpoint
+                for so long is considered dead
+            :param retry: RetryPolicy of db operations
+        """
+        self.entities = entities
+        self.checkpoints = checkpoints
+        self.retention = retention
+        self.app_retention = app_retention or {}
+        self.batch_size = batch_size
+        self.pause = pause
+        self.lease = lease
+        self.retry = retry or RetryPolicy()
+        self.indexes = IndexManager(entities)
+
+    def run(self):
+        """
+            Removes all documents deleted longer than retention ago.
+            Returns report of the run or None if another run goes on
+        """
+        checkpoint = self._acquire()
+        if checkpoint is None:
+            LOG.info('Purge is already running')
+            return None
+        self.indexes.ensure_index(PURGE_INDEX, background=True)
+
+        started = time()
+        now = datetime.utcnow()
+        cutoffs = dict((app_id, now - timedelta(seconds=seconds))
+                       for app_id, seconds in self.app_retention.items())
+        default_cutoff = now - timedelta(seconds=self.retention)
+        # documents of every app are older than the latest of cutoffs
+        latest_cutoff = max(cutoffs.values() + [default_cutoff])
+
+        position = checkpoint.get(checkpointf.POSITION)
+        if position is None:
+            checkpoint.update({checkpointf.REMOVED: 0, checkpointf.BYTES: 0,
+                               checkpointf.STARTED_AT: now})
+        else:
+            LOG.info('Continuing purge from %s', position)
+
+        result = {report.REMOVED: 0, report.BYTES: 0, report.BATCHES: 0}
+        while True:
+            batch = self._next_batch(latest_cutoff, position)
+            if not batch:
+                break
+            last = batch[-1]
+            position = [last[reservedf.UPDATED_AT], last[intf.ID]]
+
+            due = [doc for doc in batch if doc[reservedf.UPDATED_AT] <
+                   cutoffs.get(doc.get(intf.APP_ID), default_cutoff)]
+            removed, size = self._remove(due) if due else (0, 0)
+            result[report.REMOVED] += removed
+            result[report.BYTES] += size
+            result[report.BATCHES] += 1
+
+            checkpoint[checkpointf.POSITION] = position
+            checkpoint[checkpointf.REMOVED] += removed
+            checkpoint[checkpointf.BYTES] += size
+            self._save(checkpoint)
+            LOG.debug('Purged batch %d, removed %d documents',
+                      result[report.BATCHES], removed)
+
+            if len(batch) < self.batch_size:
+                break
+            sleep(self.pause)
+
+        checkpoint[checkpointf.POSITION] = None
+        self._save(checkpoint)
+
+        # all scanned expired documents are removed, so there is no position
+        result[report.EXPIRED] = 0
+        while True:
+            batch = self._next_expired_batch(now)
+            if not batch:
+                break
+            removed, size = self._remove(batch, {reservedf.EXPIRES_AT: {'$lte': now}})
+            result[report.EXPIRED] += removed
+            result[report.BYTES] += size
+            result[report.BATCHES] += 1
+            checkpoint[checkpointf.BYTES] += size
+            self._save(checkpoint)
+            if len(batch) < self.batch_size:
+                break
+            sleep(self.pause)
+
+        checkpoint[checkpointf.FINISHED_AT] = datetime.utcnow()
+        self._save(checkpoint, release=True)
+
+        result[report.SECONDS] = round(time() - started, 3)
+        LOG.info('Purge removed %(removed)d deleted and %(expired)d expired documents, '
+                 '%(bytes)d bytes in %(batches)d batches, %(seconds).3fs', result)
+        return result
+
+    def _next_batch(self, cutoff, position):
+        """ Removed documents deleted before cutoff following position """
+        criteria = {intf.DELETED: True, reservedf.UPDATED_AT: {'$lt': cutoff}}
+        if position is not None:
+            updated_at, id = position
+            criteria['$or'] = [
+                {reservedf.UPDATED_AT: {'$gt': updated_at}},
+                {reservedf.UPDATED_AT: updated_at, intf.ID: {'$gt': id}}
+            ]
+        sort = [(reservedf.UPDATED_AT, ASCENDING), (intf.ID, ASCENDING)]
+        # whole documents are read to count reclaimed bytes
+        return self.retry.call(lambda: list(self.entities.find(
+            criteria, sort=sort, limit=self.batch_size)))
+
+    def _next_expired_batch(self, now):
+        criteria = {reservedf.EXPIRES_AT: {'$lte': now}}
+        return self.retry.call(lambda: list(self.entities.find(
+            criteria, sort=[(reservedf.EXPIRES_AT, ASCENDING)], limit=self.batch_size)))
+
+    def _remove(self, documents, condition=None):
+        """
+            Removes documents unless they were restored by create meanwhile.
+            Returns number of removed documents and their size
+        """
+        ids = [doc[intf.ID] for doc in documents]
+        criteria = {intf.ID: {'$in': ids}}
+        criteria.update(condition or {intf.DELETED: True})
+        result = self.retry.call(lambda: self.entities.remove(criteria, safe=True))
+        removed = result.get('n', 0) if result else 0
+        size = sum(len(BSON.encode(doc)) for doc in documents)
+        if removed < len(documents):
+            # some were restored, size is counted in proportion
+            size = size * removed // len(documents)
+        return removed, size
+
+    def _acquire(self):
+        """ Takes the lease, returns checkpoint or None if lease is taken """
+        now = datetime.utcnow()
+        try:
+            self.checkpoints.insert({'_id': CHECKPOINT_ID,
+                                     checkpointf.LOCKED_UNTIL: now}, safe=True)
+        except DuplicateKeyError:
+            pass
+        return self.retry.call(lambda: self.checkpoints.find_and_modify(
+            {'_id': CHECKPOINT_ID, checkpointf.LOCKED_UNTIL: {'$lte': now}},
+            {'$set': {checkpointf.LOCKED_UNTIL: self._lease_end()}},
+            new=True))
+
+    def _save(self, checkpoint, release=False):
+        checkpoint[checkpointf.LOCKED_UNTIL] = datetime.utcnow() if release \
+                                               else self._lease_end()
+        self.retry.call(lambda: self.checkpoints.save(checkpoint, safe=True))
+
+    def _lease_end(self):
+        return datetime.utcnow() + timedelta(seconds=self.lease)
+
+
+class PurgeScheduler(Thread):
+    """
+        Runs purger every interval seconds in background thread
+        of the process. Lease of purger keeps runs of several processes
+        from overlapping.
+    """
+
+    def __init__(self, purger, interval):
+        super(PurgeScheduler, self).__init__(name='coltrane-purge')
+        self.daemon = True
+        self.purger = purger
+        self.interval = interval
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.purger.run()
+            except Exception:
+                LOG.exception('Purge failed')
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    Retry policy of storage operations interrupted by replica set failover.
+"""
+
+import logging
+import random
+from threading import Lock
+from time import sleep, time
+from pymongo.errors import AutoReconnect
+from coltrane.appstorage import atomic_operations
+from coltrane.appstorage.exceptions import StorageError
+from coltrane.utils import Enum
+
+
+LOG = logging.getLogger('coltrane.appstorage.retry')
+
+# atomic operations giving the same result when applied twice
+IDEMPOTENT_OPERATIONS = frozenset(['$set', '$unset', '$addToSet', '$pull', '$pullAll'])
+
+
+class counters(Enum):
+    RETRIES  = 'retries'
+    GIVE_UPS = 'give_ups'
+
+
+class RetryPolicy(object):
+    """
+        Repeats operations failed with AutoReconnect.
+        Delay before n-th retry is random between 0 and base_delay * 2^n
+        (but not more than max_delay), so workers don't hit new primary at
+        once. All attempts of one operation fit in budget seconds, which
+        must be well under uWSGI harakiri. Writes that are not idempotent
+        are never replayed, they might have been applied already.
+        Counters changed since the last report are logged at most once
+        per report_interval seconds.
+    """
+
+    def __init__(self, attempts=5, base_delay=0.05, max_delay=1.0, budget=5.0,
+                 report_interval=60.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.report_interval = report_interval
+        self.counters = dict((name, 0) for name in counters.values())
+        self._reported = dict(self.counters)
+        self._reported_at = time()
+        self._lock = Lock()
+
+    def call(self, operation, idempotent=True):
+        """ Calls operation (function without arguments) and returns its result.
+            Raises StorageError when operation can't be retried anymore """
+        started = time()
+        if started - self._reported_at >= self.report_interval:
+            self._report(started)
+        attempt = 0
+        while True:
+            try:
+                return operation()
+            except AutoReconnect, e:
+                attempt += 1
+                delay = random.uniform(0, min(self.max_delay,
+                                              self.base_delay * 2 ** attempt))
+                if not idempotent or attempt >= self.attempts or \
+                   time() - started + delay > self.budget:
+                    self._count(counters.GIVE_UPS)
+                    LOG.error('Gave up after %d attempts in %.3fs: %s',
+                              attempt, time() - started, e)
+                    raise StorageError('Storage is not available [%s]' % e)
+                self._count(counters.RETRIES)
+                sleep(delay)
+
+    def stats(self):
+        """ Returns copy of counters, e.g. to be collected by monitoring """
+        with self._lock:
+            return dict(self.counters)
+
+    def _report(self, now):
+        with self._lock:
+            if now - self._reported_at < self.report_interval:
+                return
+            self._reported_at = now
+            if self.counters == self._reported:
+                return
+            self._reported = dict(self.counters)
+        LOG.info('Retry stats: %s', ' '.join('%s=%d' % item
+                                             for item in sorted(self._reported.items())))
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+
+def is_idempotent_update(update):
+    """ Checks if update document may be applied twice """
+    return all(op in IDEMPOTENT_OPERATIONS
+               for op in update if op in atomic_operations)
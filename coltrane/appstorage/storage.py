@@ -5,19 +5,56 @@
               - dreambrother
 """
 
-from datetime import datetime
+import json
+import logging
+from datetime import datetime, timedelta
+from time import time
 from uuid import uuid4
 from functools import wraps
 from hashlib import sha1
+from bson.code import Code
+from bson.son import SON
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from coltrane.appstorage import _external_key, _internal_id, intf, extf, reservedf, atomic_operations
 from coltrane.appstorage.datatypes import BaseType
-from coltrane.appstorage.typeconverters import get_external_converter, try_get_geopoint_external_converter, get_internal_converter
+from coltrane.appstorage.indexes import _geo_paths
+from coltrane.appstorage.retry import RetryPolicy, is_idempotent_update
+from coltrane.appstorage.typeconverters import get_internal_converter, GeoPointConverter, VALUE_EXTERNAL_CONVERTERS
 
 from .exceptions import *
 
 
 # internal constants
 DICT_TYPE = type(dict())
+LIST_TYPE = type(list())
+INTERNAL_FIELDS = frozenset(intf.values())
+GEO_KEY_PREFIX = GeoPointConverter.START_FOR_GEO_KEY
+
+# fields of query plan returned by explain
+EXPLAIN_FIELDS = ('cursor', 'isMultiKey', 'n', 'nscannedObjects', 'nscanned',
+                  'scanAndOrder', 'indexOnly', 'millis', 'indexBounds')
+
+# accumulators of aggregate, count takes no field
+AGGREGATE_OPERATIONS = ('count', 'sum', 'avg', 'min', 'max')
+
+# group command used by db without aggregation framework runs JavaScript,
+# field paths are passed as json strings
+JS_GET = ('function get(doc, path) { var val = doc; var keys = path.split("."); '
+          'for (var i = 0; i < keys.length && val != null; i++) val = val[keys[i]]; '
+          'return val === undefined ? null : val; }')
+JS_REDUCE = {
+    'count': 'out[%(name)s] += 1;',
+    'sum':   'v = get(doc, %(field)s); if (typeof v == "number") out[%(name)s] += v;',
+    'avg':   'v = get(doc, %(field)s); if (typeof v == "number") '
+             '{ out[%(name)s].sum += v; out[%(name)s].n += 1; }',
+    'min':   'v = get(doc, %(field)s); if (v !== null && '
+             '(out[%(name)s] === null || v < out[%(name)s])) out[%(name)s] = v;',
+    'max':   'v = get(doc, %(field)s); if (v !== null && '
+             '(out[%(name)s] === null || v > out[%(name)s])) out[%(name)s] = v;',
+}
+
+LOG = logging.getLogger('coltrane.appstorage.storage')
+SLOW_LOG = logging.getLogger('coltrane.appstorage.slow')
 
 def verify_tokens(f):
     @wraps(f)
@@ -34,11 +71,26 @@ def verify_tokens(f):
 
 class AppdataStorage(object):
 
-    def __init__(self, entities):
+    def __init__(self, entities, slow_query_threshold=None, secondary=None,
+                 retry=None, bucket_ttls=None):
         """
             :param entities: MongoDB collection object
+            :param slow_query_threshold: seconds, find, update and delete
+                operations taking longer are logged to SLOW_LOG
+            :param secondary: MongoDB collection object of secondaries,
+                read operations called with read_secondary=True use it
+            :param retry: RetryPolicy of db operations
+            :param bucket_ttls: dict of bucket or (app_id, bucket) and seconds,
+                documents created in the bucket without _expires_at
+                expire in that many seconds
         """
         self.entities = entities
+        self.slow_query_threshold = slow_query_threshold
+        self.secondary = secondary
+        self.retry = retry or RetryPolicy()
+        self.bucket_ttls = bucket_ttls or {}
+        # db older than 2.2 has no aggregation framework
+        self.aggregation_framework = True
 
     @verify_tokens
     def create(self, app_id, user_id, bucket, ip_address, document):
@@ -53,7 +105,7 @@ class AppdataStorage(object):
          }
          $document saves in root of document.
          Function creations new id and set it to _id field, when _id is not filled in user document.
-         If user document's _id already exists, InvalidDocumentIdError will be raised.
+         If live document with the key already exists, DocumentExistsError is raised.
          Parameters:
          app_id: String, application id
          user_id: String, user id
@@ -69,46 +121,140 @@ class AppdataStorage(object):
             raise InvalidDocumentError('Document must be instance of dict type')
 
 
-        # check if a key is already exists, if it isn't - generate new
-        # check if a key is already exists, if it isn't - generate new
-        if extf.KEY not in document:
-            document[extf.KEY] = uuid4()
+        document = self._make_doc_for_insert(app_id, user_id, bucket,
+                                             ip_address, document)
+        id = document[intf.ID]
+        # removed doc with same id is replaced by the new one as a whole,
+        # the same way create_many and upsert do it.
+        # id of the document is fixed, so saving it twice does no harm
+        fields = dict((k, v) for k, v in document.items() if k != intf.ID)
+        replaced = self.retry.call(lambda: self.entities.update(
+            _dead_criteria(id), fields, multi=False, safe=True))
+        if not _updated_count(replaced):
+            attempts = []
+            def insert():
+                attempts.append(True)
+                self.entities.insert(document, safe=True)
+            try:
+                self.retry.call(insert)
+            except DuplicateKeyError:
+                # retry after lost response finds the document the failed attempt inserted
+                found = len(attempts) > 1 and self.retry.call(lambda: self.entities.find_one(
+                    {intf.ID: id}, fields=[reservedf.CREATED_AT]))
+                if not found or \
+                   found.get(reservedf.CREATED_AT) != _db_time(document[reservedf.CREATED_AT]):
+                    raise DocumentExistsError(bucket=bucket, key=_external_key(id))
 
-        document = _from_external_to_internal(app_id, user_id, bucket, document)
-        # add required fields to document
-        document[intf.APP_ID] = app_id
-        document[intf.USER_ID] = user_id
-        # adding str(False) to hashid means that document isn't deleted
-        document[intf.HASHID] = sha1(app_id+user_id+bucket+str(False)).hexdigest()
-        document[intf.IP_ADDRESS] = ip_address
-        document[intf.DELETED] = False
+        return _external_key(id)
 
-        document[reservedf.BUCKET] = bucket
-        document[reservedf.CREATED_AT] = datetime.utcnow()
 
-        id = document[intf.ID]
-        removed_doc_criteria = {
-            intf.ID: id,
-            intf.DELETED: True
-        }
-        if self._is_document_exists(removed_doc_criteria):
-            # if removed doc with same id exists - update it
-            del document[intf.ID]
-            self.entities.update(removed_doc_criteria, {'$set': document}, multi=False)
-        else:
-            self.entities.insert(document)
+    @verify_tokens
+    def create_many(self, app_id, user_id, bucket, ip_address, documents):
+        """ Bulk create operation.
+         Prepares every document the same way create does, then resolves
+         key collisions and soft-deleted documents with one query and
+         writes all new documents with a single batched insert.
+         Parameters:
+         app_id: String, application id
+         user_id: String, user id
+         bucket: String, document type (bucket)
+         documents: List of dicts, user documents
 
-        return _external_key(id)
+         Returns list of (key, created) tuples in the order of documents,
+         created is False when a live document with that key already exists,
+         including one created concurrently, or the key is repeated
+         in the batch """
+
+        # validations
+        if documents is None:
+            raise InvalidDocumentError('Documents must be not null')
+        if type(documents) is not LIST_TYPE:
+            raise InvalidDocumentError('Documents must be instance of list type')
+        for document in documents:
+            if type(document) is not DICT_TYPE:
+                raise InvalidDocumentError('Document must be instance of dict type')
+
+        prepared = [self._make_doc_for_insert(app_id, user_id, bucket,
+                                              ip_address, document)
+                    for document in documents]
+        ids = [document[intf.ID] for document in prepared]
+
+        # one round trip to find out which ids are taken by live documents
+        # and which ones belong to soft-deleted or expired documents
+        live, removed = set(), set()
+        now = datetime.utcnow()
+        taken = self.retry.call(lambda: list(self.entities.find(
+            {intf.ID: {'$in': ids}},
+            fields=[intf.ID, intf.DELETED, reservedf.EXPIRES_AT])))
+        for found in taken:
+            expires_at = found.get(reservedf.EXPIRES_AT)
+            if found.get(intf.DELETED) or (expires_at is not None and expires_at <= now):
+                removed.add(found[intf.ID])
+            else:
+                live.add(found[intf.ID])
+
+        to_insert = []
+        seen = set()
+        for document in prepared:
+            id = document[intf.ID]
+            if id not in live and id not in seen:
+                to_insert.append(document)
+            seen.add(id)
+
+        if removed:
+            # removed documents are replaced by new ones as a whole
+            self.retry.call(lambda: self.entities.remove(
+                _dead_criteria({'$in': list(removed)}), safe=True))
+        inserted = self._insert_batch(to_insert)
+
+        return [(_external_key(document[intf.ID]), document[intf.ID] in inserted)
+                for document in prepared]
+
+    def _insert_batch(self, documents):
+        """ Inserts documents with batched inserts. Batch stops at the first
+            document whose id was taken concurrently, so the rest of the batch
+            is inserted again without it.
+            Returns set of ids of inserted documents """
+        inserted = set()
+        while documents:
+            try:
+                # part of the batch may have been inserted before failure
+                self.retry.call(lambda: self.entities.insert(documents, safe=True),
+                                idempotent=False)
+                inserted.update(document[intf.ID] for document in documents)
+                break
+            except DuplicateKeyError:
+                ids = [document[intf.ID] for document in documents]
+                stored = dict((found[intf.ID], found.get(reservedf.CREATED_AT))
+                              for found in self.retry.call(lambda: list(self.entities.find(
+                                  {intf.ID: {'$in': ids}},
+                                  fields=[intf.ID, reservedf.CREATED_AT]))))
+                # documents before the failed one are inserted,
+                # the failed one is the first created by somebody else
+                for failed, document in enumerate(documents):
+                    if stored.get(document[intf.ID]) != _db_time(document[reservedf.CREATED_AT]):
+                        break
+                    inserted.add(document[intf.ID])
+                documents = documents[failed + 1:]
+        return inserted
 
 
     @verify_tokens
-    def get(self, app_id, user_id, bucket, key):
+    def get(self, app_id, user_id, bucket, key, read_secondary=False,
+            view=None, fields=None, exclude=None):
         """ Read operation for CRUD service.
          Parameters:
          app_id: String, application id
          user_id: String, user id
          document_key: String, document key
          bucket: String, type of document
+         read_secondary: Boolean, document may be read from secondary,
+            i.e. it may be a bit stale
+         view: Function making returned view of fetched internal document,
+            external document by default
+         fields, exclude: Lists of fields to return or to leave out,
+            e.g. ['title', 'author.name'], only one of them may be passed.
+            _key and reserved fields are always returned
 
          Returns founded document or None if object not found """
 
@@ -118,34 +264,285 @@ class AppdataStorage(object):
 
         # logic
         document_id = _internal_id(app_id, user_id, bucket, 0, key)
-        res = self.entities.find_one({intf.ID: document_id, intf.DELETED: False})
+        projection = _generate_projection(fields, exclude)
+        res = self.retry.call(lambda: self._reader(read_secondary).find_one(
+            _live_criteria(document_id), fields=projection))
         if res is None:
             return None
 
-        return _to_external(res)
+        return (view or _to_external)(res)
 
 
     @verify_tokens
-    def find(self, app_id, user_id, bucket, filter_opts=None,
-             sort=None, skip=0, limit=1000, count=False):
+    def get_version(self, app_id, user_id, bucket, key, read_secondary=False):
+        """ Returns time of the last change of the document, i.e. _updated_at
+         or _created_at if the document was not updated since it was created.
+         Only these fields are fetched, so it is a cheap way to find out
+         whether a document known to client has changed.
+         Parameters are the same as of get
 
-        criteria = _generate_criteria(app_id, user_id, bucket, filter_opts=filter_opts)
+         Returns datetime or None if object not found """
 
-        opt_criteria = {}
-        if skip < 0:
-            raise RuntimeError("offset parameter must not be less then 0")
-        if limit < 0:
-            raise RuntimeError("limit parameter must be greater then 0")
-        opt_criteria['skip']  = skip
-        opt_criteria['limit'] = limit
-        opt_criteria['sort'] = sort
+        # validations
+        if key is None:
+            raise InvalidDocumentKeyError('Document key must be not null')
+
+        # logic
+        document_id = _internal_id(app_id, user_id, bucket, 0, key)
+        res = self.retry.call(lambda: self._reader(read_secondary).find_one(
+            _live_criteria(document_id),
+            fields=[reservedf.CREATED_AT, reservedf.UPDATED_AT]))
+        if res is None:
+            return None
+
+        # created document has no _updated_at until it is updated.
+        # Document created over removed one replaces it as a whole, so its
+        # version is its own _created_at, later than any version of the removed one
+        versions = [res.get(reservedf.CREATED_AT), res.get(reservedf.UPDATED_AT)]
+        versions = [v for v in versions if v is not None]
+        return max(versions) if versions else None
+
+
+    @verify_tokens
+    def get_many(self, app_id, user_id, bucket, keys, read_secondary=False,
+                 view=None, fields=None, exclude=None):
+        """ Read operation for many documents at once.
+         All documents are fetched with one query.
+         Parameters:
+         app_id: String, application id
+         user_id: String, user id
+         bucket: String, type of document
+         keys: List of strings, document keys
+         read_secondary, view, fields, exclude: see get
 
-        cursor = self.entities.find(criteria, **opt_criteria)
+         Returns list of found documents in the order of keys,
+         None is placed instead of each document that was not found """
+
+        # validations
+        if not keys:
+            raise InvalidDocumentKeyError('Document keys must be not empty')
+        if None in keys:
+            raise InvalidDocumentKeyError('Document key must be not null')
+
+        # logic
+        ids = [_internal_id(app_id, user_id, bucket, 0, key) for key in keys]
+        found = {}
+        reader = self._reader(read_secondary)
+        projection = _generate_projection(fields, exclude)
+        for res in self.retry.call(lambda: list(reader.find(
+                _live_criteria({'$in': list(set(ids))}), fields=projection))):
+            found[res[intf.ID]] = res
+
+        view = view or _to_external
+        return [view(found[id]) if id in found else None for id in ids]
+
+
+    @verify_tokens
+    def find(self, app_id, user_id, bucket, filter_opts=None,
+             sort=None, skip=0, limit=1000, count=False, after=None,
+             read_secondary=False, view=None, fields=None, exclude=None):
+        """ Find operation for CRUD service.
+         Parameters:
+         filter_opts: Dict, filter in external format
+         sort: List of (field, order) pairs, _key field can be used to
+            sort by document key
+         skip, limit: Integers, pagination parameters
+         count: Boolean, return number of documents instead of documents
+         after: Tuple (value, key), sort field value and key of the last
+            document of previous page. Only documents placed after it in
+            the sort order are returned, it requires sort to be specified
+         read_secondary, view, fields, exclude: see get
+
+         Returns list of found documents or its count """
+
+        started = time()
+        criteria, cursor = self._find_cursor(app_id, user_id, bucket,
+                                    filter_opts, sort, skip, limit, after,
+                                    read_secondary, fields, exclude)
         if count:
-            return cursor.count(with_limit_and_skip=True)
+            result = self.retry.call(
+                lambda: cursor.clone().count(with_limit_and_skip=True))
         else:
-            documents = list(cursor)
-            return map(_to_external, documents)
+            result = self.retry.call(lambda: list(cursor.clone()))
+        self._log_if_slow('find', app_id, bucket, criteria, started, sort)
+
+        if count:
+            return result
+        return map(view or _to_external, result)
+
+
+    @verify_tokens
+    def explain(self, app_id, user_id, bucket, filter_opts=None,
+                sort=None, skip=0, limit=1000, after=None, read_secondary=False,
+                fields=None, exclude=None):
+        """ Returns query plan of find operation with the same parameters:
+         index used, number of scanned documents and time in milliseconds """
+
+        criteria, cursor = self._find_cursor(app_id, user_id, bucket,
+                                    filter_opts, sort, skip, limit, after,
+                                    read_secondary, fields, exclude)
+        plan = self.retry.call(cursor.explain)
+        return dict((field, plan[field]) for field in EXPLAIN_FIELDS
+                    if field in plan)
+
+
+    @verify_tokens
+    def aggregate(self, app_id, user_id, bucket, filter_opts=None, group_by=None,
+                  accumulators=None, sort=None, limit=None, read_secondary=False):
+        """ Aggregate operation, groups documents matching the filter by values
+         of fields and computes accumulators of every group in db.
+         Parameters:
+         filter_opts: Dict, filter in external format
+         group_by: List of fields, all documents make one group if it is empty
+         accumulators: Dict of output field and (operation, field) pair,
+            operation is one of AGGREGATE_OPERATIONS, field of count is None
+         sort: List of (output field, order) pairs
+         limit: Int, how many groups are returned, all of them if None
+         read_secondary: see get
+
+         Returns list of groups, each has fields of group_by
+         and output fields of accumulators.
+         Without aggregate command, i.e. on db 2.0, documents matching
+         the filter may make no more than 20000 groups, db fails otherwise """
+
+        group_by = group_by or []
+        accumulators = accumulators or {}
+        for name, (operation, field) in accumulators.items():
+            if operation not in AGGREGATE_OPERATIONS:
+                raise RuntimeError('Unknown aggregate operation %s' % operation)
+            if name in group_by:
+                raise RuntimeError('Field %s is grouped and accumulated at once' % name)
+        # fields of group are renamed, paths can't be keys of group id
+        paths = dict((field, '_id.k%d' % i) for i, field in enumerate(group_by))
+        for field, order in sort or []:
+            if field not in paths and field not in accumulators:
+                raise RuntimeError('Sort field %s is not in output of aggregate' % field)
+        sort = [(paths.get(field, field), order) for field, order in sort or []]
+
+        criteria = _generate_criteria(app_id, user_id, bucket, filter_opts=filter_opts)
+        if _geo_paths(criteria):
+            raise RuntimeError('Geo search can not be used in aggregate')
+        # filter by _key drops __hashid__, but groups never leave the bucket
+        criteria[intf.HASHID] = sha1(app_id+user_id+bucket+str(False)).hexdigest()
+
+        reader = self._reader(read_secondary)
+        started = time()
+        groups = None
+        if self.aggregation_framework:
+            try:
+                groups = self.retry.call(lambda: self._aggregate(reader, criteria,
+                    group_by, accumulators, sort, limit))
+            except OperationFailure, e:
+                if 'no such cmd' not in str(e):
+                    raise
+                LOG.warning('Aggregation framework is not supported, group is used')
+                self.aggregation_framework = False
+        if groups is None:
+            groups = self.retry.call(lambda: self._group(reader, criteria,
+                group_by, accumulators, sort, limit))
+        self._log_if_slow('aggregate', app_id, bucket, criteria, started, sort)
+
+        results = []
+        for group in groups:
+            keys = group[intf.ID] or {}
+            result = dict((field, keys.get('k%d' % i))
+                          for i, field in enumerate(group_by))
+            for name, (operation, field) in accumulators.items():
+                result[name] = group.get(name)
+            results.append(_from_internal_to_external(result))
+        return results
+
+    def _aggregate(self, reader, criteria, group_by, accumulators, sort, limit):
+        """ Groups documents by aggregate command of db 2.2+ """
+        group = {intf.ID: dict(('k%d' % i, '$' + field)
+                               for i, field in enumerate(group_by)) or None}
+        for name, (operation, field) in accumulators.items():
+            if operation == 'count':
+                group[name] = {'$sum': 1}
+            else:
+                group[name] = {'$' + operation: '$' + field}
+
+        pipeline = [{'$match': criteria}, {'$group': group}]
+        if sort:
+            pipeline.append({'$sort': SON(sort)})
+        if limit:
+            pipeline.append({'$limit': limit})
+        return reader.database.command('aggregate', reader.name,
+                                       pipeline=pipeline)['result']
+
+    def _group(self, reader, criteria, group_by, accumulators, sort, limit):
+        """ Groups documents by group command of db 2.0, it runs JavaScript
+            and returns no more than 20000 groups. Groups are sorted
+            and limited here, result has the same form as aggregate's """
+        key = Code('function (doc) { %s return {%s}; }' % (JS_GET, ', '.join(
+            '"k%d": get(doc, %s)' % (i, json.dumps(field))
+            for i, field in enumerate(group_by))))
+        initial = {}
+        reduce = []
+        finalize = []
+        for name, (operation, field) in accumulators.items():
+            js_name = json.dumps(name)
+            if operation in ('count', 'sum'):
+                initial[name] = 0
+            elif operation == 'avg':
+                initial[name] = {'sum': 0, 'n': 0}
+                finalize.append('out[%(name)s] = out[%(name)s].n ? '
+                                'out[%(name)s].sum / out[%(name)s].n : null;'
+                                % {'name': js_name})
+            else:
+                initial[name] = None
+            reduce.append(JS_REDUCE[operation] % {'name': js_name,
+                                                  'field': json.dumps(field)})
+        reduce = Code('function (doc, out) { %s var v; %s }' % (JS_GET, ' '.join(reduce)))
+        finalize = Code('function (out) { %s }' % ' '.join(finalize)) if finalize else None
+
+        groups = []
+        for found in reader.group(key, criteria, initial, reduce, finalize):
+            group = {intf.ID: dict(('k%d' % i, found.get('k%d' % i))
+                                   for i in range(len(group_by)))}
+            for name, (operation, field) in accumulators.items():
+                # numbers of JavaScript are doubles
+                group[name] = int(found[name]) if operation == 'count' else found[name]
+            groups.append(group)
+
+        def value(group, path):
+            for key in path.split('.'):
+                group = group.get(key) if isinstance(group, dict) else None
+            return group
+        for path, order in reversed(sort):
+            groups.sort(key=lambda group: value(group, path), reverse=order < 0)
+        return groups[:limit] if limit else groups
+
+
+    @verify_tokens
+    def find_batches(self, app_id, user_id, bucket, filter_opts=None,
+                     sort=None, skip=0, limit=1000, after=None, batch_size=100,
+                     read_secondary=False, view=None, fields=None, exclude=None):
+        """ Same as find but returns generator of lists of found documents.
+         Documents are pulled from db and converted by batches of batch_size,
+         so only one batch is held in memory at once """
+
+        criteria, cursor = self._find_cursor(app_id, user_id, bucket,
+                                    filter_opts, sort, skip, limit, after,
+                                    read_secondary, fields, exclude)
+        cursor.batch_size(batch_size)
+        view = view or _to_external
+
+        def batches():
+            batch = []
+            while True:
+                # cursor is lost with the primary, so failed fetch isn't replayed
+                try:
+                    document = self.retry.call(cursor.next, idempotent=False)
+                except StopIteration:
+                    break
+                batch.append(view(document))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        return batches()
 
 
     @verify_tokens
@@ -156,7 +553,9 @@ class AppdataStorage(object):
             app_id: String, application id
             user_id: String, user id
             document: Dict, document with given _id will be updated in db
-            bucket: String, document type """
+            bucket: String, document type
+
+            Returns number of matched documents """
 
         # validations
         if document is None:
@@ -179,26 +578,153 @@ class AppdataStorage(object):
 
         update = self._make_doc_for_update(document)
 
-        self.entities.update(criteria, update, multi=True, safe=True)
+        started = time()
+        result = self.retry.call(lambda: self.entities.update(criteria, update,
+                                                              multi=True, safe=True),
+                                 idempotent=is_idempotent_update(update))
+        self._log_if_slow('update', app_id, bucket, criteria, started)
+        return _updated_count(result)
+
+
+    @verify_tokens
+    def update_many(self, app_id, user_id, bucket, ip_address, updates):
+        """ Bulk update operation.
+            Parameters:
+            updates: List of (key, document) pairs, each document is applied
+                to the document with the key the same way update does it
+
+            Returns list of numbers of matched documents, 0 or 1,
+            in the order of updates.
+            db has no batched updates, so every document takes its own
+            round trip, only validation and HTTP overhead are saved """
+
+        # validations
+        if updates is None:
+            raise InvalidDocumentError('Updates must be not null')
+        for key, document in updates:
+            if key is None:
+                raise InvalidDocumentKeyError('Document key must be not null')
+
+        return [self.update(app_id, user_id, bucket, ip_address, document, key=key)
+                for key, document in updates]
+
+
+    @verify_tokens
+    def upsert(self, app_id, user_id, bucket, ip_address, document, key):
+        """ Update or create operation.
+            Document with the key is updated the same way update does it,
+            if it doesn't exist it is created from the update document
+            by one db upsert, with _created_at and default _expires_at
+            copied from its criteria. Concurrent upserts can't create
+            two documents: the one losing the race updates the document
+            created by the other.
+            Parameters:
+            document: Dict, update document
+            key: String, document key
+
+            Returns True if document was created, False if it was updated """
+
+        # validations
+        if document is None:
+            raise InvalidDocumentError('Document for update cannot be null')
+        if type(document) is not DICT_TYPE:
+            raise InvalidDocumentError('Document must be instance of dict type')
+        if key is None:
+            raise InvalidDocumentKeyError('Document key must be not null')
+
+        document = _from_external_to_internal(app_id, user_id, bucket, document)
+        now = datetime.utcnow()
+        document[intf.IP_ADDRESS] = ip_address
+        document[reservedf.UPDATED_AT] = now
+        update = self._make_doc_for_update(document)
+        idempotent = is_idempotent_update(update)
+
+        # fields every live document with the id has, db copies them
+        # from criteria to the document it inserts
+        id = _internal_id(app_id, user_id, bucket, 0, key)
+        criteria = {
+            intf.ID: id,
+            intf.APP_ID: app_id,
+            intf.USER_ID: user_id,
+            intf.HASHID: sha1(app_id+user_id+bucket+str(False)).hexdigest(),
+            intf.DELETED: False,
+            reservedf.BUCKET: bucket,
+            # operator isn't copied, expired document is replaced as removed one
+            reservedf.EXPIRES_AT: _not_expired()
+        }
+        # db 2.0 has no $setOnInsert, fields of new document come from criteria.
+        # _created_at matches only the document created by this call,
+        # so retry after lost response of the upsert updates that document
+        new_criteria = dict(criteria)
+        new_criteria[reservedf.CREATED_AT] = now
+        expires_at = self._default_expiration(app_id, bucket, now)
+        if expires_at is not None and \
+           reservedf.EXPIRES_AT not in update.get('$set', {}):
+            new_criteria[reservedf.EXPIRES_AT] = expires_at
+
+        started = time()
+        try:
+            for attempt in (1, 2):
+                result = self.retry.call(lambda: self.entities.update(
+                    criteria, update, safe=True), idempotent=idempotent)
+                if _updated_count(result):
+                    return False
+                try:
+                    self.retry.call(lambda: self.entities.update(
+                        new_criteria, update, upsert=True, safe=True), idempotent=idempotent)
+                    return True
+                except DuplicateKeyError:
+                    # removed or expired document has the same id, it is replaced
+                    # by the new one, or concurrent upsert has just created
+                    # the document, it is updated
+                    if attempt == 2:
+                        raise
+                    self.retry.call(lambda: self.entities.remove(
+                        _dead_criteria(id), safe=True))
+        finally:
+            self._log_if_slow('upsert', app_id, bucket, criteria, started)
 
 
     @verify_tokens
     def delete(self, app_id, user_id, bucket, ip_address,
                key=None, filter_opts=None):
+        """ Soft delete operation for CRUD, removed documents are kept
+            with __deleted__ flag.
+            Delete by key is retried after failover, delete by filter is not:
+            documents deleted by the failed attempt can't be counted.
+            Returns number of deleted documents """
         if key:
             criteria = _generate_criteria(app_id, user_id, bucket,
                                           filter_opts={extf.KEY: key})
         else:
             criteria = _generate_criteria(app_id, user_id, bucket,
                                           filter_opts=filter_opts)
-        self.entities.update(criteria, {
+        # time of this deletion tells whether a lost attempt removed the document
+        now = _db_time(datetime.utcnow())
+        update = {
             '$set': {
                 intf.HASHID: sha1(app_id+user_id+bucket+str(True)).hexdigest(),
                 intf.DELETED:True,
                 intf.IP_ADDRESS:ip_address,
-                reservedf.UPDATED_AT:datetime.utcnow()
+                reservedf.UPDATED_AT:now
             }
-        }, multi=True)
+        }
+        started = time()
+        attempts = []
+        def delete():
+            attempts.append(True)
+            return self.entities.update(criteria, update, multi=True, safe=True)
+        result = self.retry.call(delete, idempotent=bool(key))
+        self._log_if_slow('delete', app_id, bucket, criteria, started)
+        deleted = _updated_count(result)
+        if not deleted and len(attempts) > 1:
+            # repeated attempt doesn't match the document deleted by the failed one,
+            # it is counted if it was removed at the time of this deletion
+            dead = _dead_criteria(criteria[intf.ID])
+            dead[reservedf.UPDATED_AT] = now
+            if self.retry.call(lambda: self.entities.find_one(dead, fields=[intf.ID])):
+                deleted = 1
+        return deleted
 
 
     def is_document_exists(self, app_id, user_id, bucket, filter_opts=None):
@@ -207,6 +733,91 @@ class AppdataStorage(object):
         criteria = _generate_criteria(app_id, user_id, bucket, filter_opts)
         return self._is_document_exists(criteria)
 
+    def _find_cursor(self, app_id, user_id, bucket, filter_opts,
+                     sort, skip, limit, after, read_secondary=False,
+                     fields=None, exclude=None):
+        """ Makes db cursor for find operations.
+            Returns criteria of the query and the cursor """
+        criteria = _generate_criteria(app_id, user_id, bucket, filter_opts=filter_opts)
+
+        if sort:
+            sort = [(intf.ID if field == extf.KEY else field, order)
+                    for field, order in sort]
+            # documents with equal values of sort field are ordered by id,
+            # so the order is stable and pages can be continued by key
+            field, order = sort[-1]
+            if field != intf.ID:
+                sort.append((intf.ID, order))
+
+        if after is not None:
+            if not sort:
+                raise RuntimeError("sort parameter must be specified to continue from document")
+            keyset = _generate_keyset_criteria(app_id, user_id, bucket, sort, after)
+            criteria.setdefault('$and', []).append(keyset)
+
+        opt_criteria = {}
+        if skip < 0:
+            raise RuntimeError("offset parameter must not be less then 0")
+        if limit < 0:
+            raise RuntimeError("limit parameter must be greater then 0")
+        opt_criteria['skip']  = skip
+        opt_criteria['limit'] = limit
+        opt_criteria['sort'] = sort
+        opt_criteria['fields'] = _generate_projection(fields, exclude)
+
+        reader = self._reader(read_secondary)
+        return criteria, reader.find(criteria, **opt_criteria)
+
+    def _reader(self, read_secondary):
+        """ Collection to read from, writes always go to self.entities """
+        if read_secondary and self.secondary is not None:
+            return self.secondary
+        return self.entities
+
+    def _log_if_slow(self, operation, app_id, bucket, criteria, started,
+                     sort=None):
+        """ Logs shape of criteria of the operation if it took longer
+            than slow_query_threshold """
+        elapsed = time() - started
+        if self.slow_query_threshold is None or elapsed < self.slow_query_threshold:
+            return
+        SLOW_LOG.warning('%s app=%s bucket=%s time=%.3fs criteria=%s sort=%s',
+            operation, app_id, bucket, elapsed,
+            _criteria_shape(criteria), sort and [f for f, o in sort])
+
+    def _make_doc_for_insert(self, app_id, user_id, bucket, ip_address, document):
+        """ Converts external document to internal one and adds all fields
+            required for a new document """
+        # check if a key is already exists, if it isn't - generate new
+        if extf.KEY not in document:
+            document[extf.KEY] = uuid4()
+
+        document = _from_external_to_internal(app_id, user_id, bucket, document)
+        # add required fields to document
+        document[intf.APP_ID] = app_id
+        document[intf.USER_ID] = user_id
+        # adding str(False) to hashid means that document isn't deleted
+        document[intf.HASHID] = sha1(app_id+user_id+bucket+str(False)).hexdigest()
+        document[intf.IP_ADDRESS] = ip_address
+        document[intf.DELETED] = False
+
+        document[reservedf.BUCKET] = bucket
+        document[reservedf.CREATED_AT] = datetime.utcnow()
+        if reservedf.EXPIRES_AT not in document:
+            expires_at = self._default_expiration(app_id, bucket,
+                                                  document[reservedf.CREATED_AT])
+            if expires_at is not None:
+                document[reservedf.EXPIRES_AT] = expires_at
+        return document
+
+    def _default_expiration(self, app_id, bucket, created_at):
+        """ Expiration time of document created in the bucket at created_at
+            or None if the bucket has no TTL """
+        ttl = self.bucket_ttls.get((app_id, bucket), self.bucket_ttls.get(bucket))
+        if ttl is None:
+            return None
+        return created_at + timedelta(seconds=ttl)
+
     def _make_doc_for_update(self, document):
         update = {}
         for k, v in document.items():
@@ -229,7 +840,8 @@ class AppdataStorage(object):
              raise RuntimeError('Criteria object must not be None')
 
          # query document with one field (_id) to decrease network traffic. It is necessary fields minimum.
-         found =  self.entities.find_one(criteria,  fields=['_id'])
+         found = self.retry.call(
+             lambda: self.entities.find_one(criteria, fields=['_id']))
          if found:
              return True
          else:
@@ -241,7 +853,7 @@ def _filter_int_fields(document):
     Filter out all internal fields
     """
     return {k: v for k, v in document.items()
-             if not k in intf.values()}
+             if not k in INTERNAL_FIELDS}
 
 
 def _filter_ext_fields(document):
@@ -255,8 +867,11 @@ def _to_external(document):
     if not document:
         return None
 
-    external = _filter_int_fields(document)
-    external = _from_internal_to_external(external)
+    external = _from_internal_to_external(document)
+    if external is document:
+        external = dict(document)
+    for field in INTERNAL_FIELDS:
+        external.pop(field, None)
     external[extf.KEY] = _external_key(document[intf.ID])
 
     return external
@@ -331,47 +946,95 @@ def _from_internal_to_external(doc):
     Convert document from internal view to the external.
     If document contains external fields/data types, convert its values to the internal fields/types.
     {<int_1>:[{<int_2>:10}, {'key':20}]} => {<ext_1>:[{<ext_2>:10}, {'key':20}]}
+    Dicts and lists which don't need conversion are returned as is,
+    new ones are created only for changed ones.
     """
-    def _from_dict(doc):
-
-        external = {}
-        for key in doc:
-            val = doc[key]
-            # due to absence internal data type for geo point
-            # we need to check every type whether it can be geo data.
-            # Key of geo data starts with special prefix.
-            converter = try_get_geopoint_external_converter(key)
-            if not converter:
-                if type(val) == dict:
-                    val = _from_dict(val)
-                elif type(val) == list:
-                    val = _from_list(val)
-                else:
-                    # val type is not dict, not list, and most likely it is internal data type
-                    converter = get_external_converter(val)
-            if converter:
-                key, val = converter.to_external(key, val)
-            external[key] = val
-        return external
-
-    def _from_list(l):
-        internal = []
-        for val in l:
-            if type(val) == list:
-                val = _from_list(val)
-            elif type(val) == dict:
-                val = _from_dict(val)
-            else:
-                # val type is not dict, not list, and most likely it is internal data type
-                converter = get_external_converter(val)
-                if converter:
-                    _, val = converter.to_external(None, val)
-            internal.append(val)
-        return internal
-
-    return _from_dict(doc)
+    return _dict_to_external(doc)
 
 
+def _dict_to_external(doc):
+    external = None
+    for key, val in doc.iteritems():
+        new_key = key
+        # due to absence internal data type for geo point
+        # its key starts with special prefix
+        if key.startswith(GEO_KEY_PREFIX):
+            new_key, new_val = GeoPointConverter.to_external(key, val)
+        else:
+            new_val = _value_to_external(val)
+        if new_val is not val or new_key is not key:
+            if external is None:
+                external = dict(doc)
+            if new_key is not key:
+                del external[key]
+            external[new_key] = new_val
+    return doc if external is None else external
+
+
+def _list_to_external(l):
+    external = None
+    for i, val in enumerate(l):
+        new_val = _value_to_external(val)
+        if new_val is not val:
+            if external is None:
+                external = list(l)
+            external[i] = new_val
+    return l if external is None else external
+
+
+def _value_to_external(val):
+    val_type = val.__class__
+    if val_type is DICT_TYPE:
+        return _dict_to_external(val)
+    if val_type is LIST_TYPE:
+        return _list_to_external(val)
+    converter = VALUE_EXTERNAL_CONVERTERS.get(val_type)
+    if converter:
+        return converter.to_external(None, val)[1]
+    return val
+
+
+def _db_time(value):
+    """ Datetime as it is read back from db, which keeps milliseconds """
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+
+def _updated_count(result):
+    """ Number of documents matched by update from result of getLastError """
+    return result.get('n', 0) if result else 0
+
+
+def _generate_projection(fields=None, exclude=None):
+    """
+    Makes projection of find from lists of external fields to return
+    or to leave out. _id and reserved fields are always returned,
+    they are needed to make _key and version of the document.
+    Geo point is stored under prefixed key, so both keys are projected.
+    """
+    if fields is None and exclude is None:
+        return None
+    if fields is not None and exclude is not None:
+        raise RuntimeError('Only one of fields and exclude may be passed')
+
+    def keys(field):
+        head, _, last = field.rpartition('.')
+        geo = (head + '.' if head else '') + GEO_KEY_PREFIX + last
+        return field, geo
+
+    required = set([extf.KEY, intf.ID] + reservedf.values())
+    if fields is not None:
+        projection = dict.fromkeys(reservedf.values(), True)
+        for field in fields:
+            if field not in required:
+                projection.update(dict.fromkeys(keys(field), True))
+    else:
+        projection = {}
+        for field in exclude:
+            if field not in required:
+                projection.update(dict.fromkeys(keys(field), False))
+        if not projection:
+            return None
+    return projection
 
 
 def _generate_criteria(app_id, user_id, bucket, filter_opts=None):
@@ -385,5 +1048,68 @@ def _generate_criteria(app_id, user_id, bucket, filter_opts=None):
             del criteria[intf.HASHID]
         criteria.update(filter_opts)
 
+    # expired documents removed by db a bit later must not be found
+    if reservedf.EXPIRES_AT in criteria:
+        criteria.setdefault('$and', []).append({reservedf.EXPIRES_AT: _not_expired()})
+    else:
+        criteria[reservedf.EXPIRES_AT] = _not_expired()
     return criteria
 
+
+def _not_expired():
+    """ Condition on _expires_at matching documents without it
+        and documents expiring in future """
+    return {'$not': {'$lte': datetime.utcnow()}}
+
+
+def _live_criteria(id):
+    """ Criteria of live documents by id or condition on id """
+    return {intf.ID: id, intf.DELETED: False, reservedf.EXPIRES_AT: _not_expired()}
+
+
+def _dead_criteria(id):
+    """ Criteria of removed or expired documents by id or condition on id,
+        new documents with the same id replace them """
+    return {intf.ID: id, '$or': [{intf.DELETED: True},
+                                 {reservedf.EXPIRES_AT: {'$lte': datetime.utcnow()}}]}
+
+
+def _criteria_shape(criteria):
+    """
+        Returns criteria with values replaced by 1, so queries differing
+        by values only look the same in the log
+    """
+    def _shape(val):
+        if type(val) == DICT_TYPE:
+            return dict((k, _shape(v)) for k, v in val.items())
+        if type(val) == LIST_TYPE and len(val) and type(val[0]) == DICT_TYPE:
+            return [_shape(v) for v in val]
+        return 1
+    return _shape(criteria)
+
+
+def _generate_keyset_criteria(app_id, user_id, bucket, sort, after):
+    """ Generates criteria for documents placed after the given one
+        in the sort order. Unlike skip it is served by index on sort
+        field and costs the same for every page.
+        after is a pair of sort field value and key of the document """
+
+    value, key = after
+    document_id = _internal_id(app_id, user_id, bucket, 0, key)
+    field, order = sort[0]
+    op = '$gt' if order > 0 else '$lt'
+
+    if field == intf.ID:
+        return {intf.ID: {op: document_id}}
+    # missing and null values go before all others and can't be
+    # compared with them, i.e. {$gt: null} matches nothing
+    if value is None:
+        ties = {field: None, intf.ID: {op: document_id}}
+        if order < 0:
+            return ties
+        return {'$or': [{field: {'$ne': None}}, ties]}
+    after = [{field: {op: value}},
+             {field: value, intf.ID: {op: document_id}}]
+    if order < 0:
+        after.append({field: None})
+    return {'$or': after}
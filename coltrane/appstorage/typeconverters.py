@@ -144,12 +144,17 @@ MAPPING = ((DBRef, Pointer, PointerConverter),
            (dict, GeoPoint, GeoPointConverter),
            (datetime, datetime, None))
 
+# the same mapping as dicts, the first match of MAPPING wins
+_INTERNAL_CONVERTERS = dict((ext_type, converter)
+                            for int_type, ext_type, converter in reversed(MAPPING))
+_EXTERNAL_CONVERTERS = dict((int_type, converter)
+                            for int_type, ext_type, converter in reversed(MAPPING))
+
+# converters of values, geo points are recognized by key instead
+VALUE_EXTERNAL_CONVERTERS = dict((int_type, converter)
+                                 for int_type, converter in _EXTERNAL_CONVERTERS.items()
+                                 if converter and int_type is not dict)
 
-def try_get_geopoint_external_converter(key):
-    """If key start with geo prefix than make geo point external converter"""
-    if key.startswith(GeoPointConverter.START_FOR_GEO_KEY):
-        return GeoPointConverter
-    return None
 
 def get_internal_converter(ext_obj):
     """
@@ -157,21 +162,4 @@ def get_internal_converter(ext_obj):
         :return: converter for ext_obj
         :rtype: :class:`BaseConverter`
         """
-    obj_class = ext_obj.__class__
-    for v in MAPPING:
-        if obj_class == v[1]:
-            return v[2]
-    return None
-
-
-def get_external_converter(int_obj):
-    """
-        :param int_obj: internal date type such as datetime, DBRef, Binary, etc.
-        :return: converter for int_obj
-        :rtype: :class:`BaseConverter`
-        """
-    obj_class = int_obj.__class__
-    for v in MAPPING:
-        if obj_class == v[0]:
-            return v[2]
-    return None
\ No newline at end of file
+    return _INTERNAL_CONVERTERS.get(ext_obj.__class__)
@@ -8,6 +8,7 @@ import os
 COOKIE_USER_AUTH_TOKEN = 'auth_token'
 COOKIE_APP_TOKEN       = 'app_token'
 COOKIE_ANONYMOUS_TOKEN = 'anonymous'
+COOKIE_HOSTING_LINK    = 'hosting_link'
 
 MYSQL_URI       = os.environ.get('COLTRANE_MYSQL_URI') or \
                   'mysql://coltrane@127.0.0.1:3306/coltrane'
@@ -19,6 +20,11 @@ MYSQL_TEST_URI  = os.environ.get('COLTRANE_MYSQL_TEST_URI') or \
 
 HOSTING_ROOT    = os.environ.get('HOSTING_ROOT')
 
+#: memcached servers shared by all processes to cache authentication data
+AUTH_CACHE_SERVERS = [s.strip() for s in
+                      os.environ.get('COLTRANE_AUTH_CACHE_SERVERS', '').split(',')
+                      if s.strip()]
+
 class DefaultConfig(object):
     SQLALCHEMY_DATABASE_URI = MYSQL_URI
     HOSTING_ROOT = HOSTING_ROOT
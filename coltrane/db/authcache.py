@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+    Cache of users and apps authenticated by tokens.
+
+    If AUTH_CACHE_SERVERS are configured, REST workers keep found users
+    and apps in memcached shared by all processes. Models invalidate entries
+    when tokens change, so the website and apphosting reach caches of
+    REST workers through the shared one. Without shared cache workers keep
+    them in process local caches, invalidation reaches only caches of
+    the current process then.
+"""
+
+from hashlib import sha256
+from weakref import WeakSet
+from werkzeug.contrib.cache import MemcachedCache, NullCache
+from coltrane import config
+
+
+#: process local caches, i.e. coltrane.utils.TTLCache instances,
+#: they are weakly referenced, so caches of dropped managers go away
+local_caches = WeakSet()
+
+if config.AUTH_CACHE_SERVERS:
+    shared_cache = MemcachedCache(config.AUTH_CACHE_SERVERS,
+                                  key_prefix='coltrane.auth.')
+else:
+    shared_cache = NullCache()
+
+
+def user_key(auth_hash):
+    return 'user:' + auth_hash
+
+
+def app_key(app_token):
+    # tokens themselves are never put in cache
+    return 'app:' + sha256(app_token).hexdigest()
+
+
+def invalidate(key):
+    shared_cache.delete(key)
+    for cache in local_caches:
+        cache.delete(key)
@@ -0,0 +1,27 @@
+from sqlalchemy import *
+from migrate import *
+from migrate.changeset.constraint import UniqueConstraint
+
+meta = MetaData()
+
+apptokens = Table('apptokens', meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('user_id', Integer),
+    Column('app_id', Integer),
+)
+
+unique_user_app = UniqueConstraint('user_id', 'app_id', table=apptokens,
+                                   name='uq_apptokens_user_app')
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    # concurrent requests could create several tokens, the first one is kept
+    migrate_engine.execute(
+        'DELETE t FROM apptokens t JOIN apptokens k '
+        'ON t.user_id = k.user_id AND t.app_id = k.app_id AND t.id > k.id')
+    unique_user_app.create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    unique_user_app.drop()
@@ -3,6 +3,7 @@
     :Authors: - qweqwe
 """
 
+from coltrane.db import authcache
 from coltrane.db.extension import db
 from datetime import datetime
 from flaskext.bcrypt import generate_password_hash, check_password_hash
@@ -10,6 +11,7 @@ from hashlib import sha256, sha224
 from os import urandom
 from uuid import  uuid4
 
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 
 
@@ -61,8 +63,11 @@ class User(db.Model):
     def regenerate_auth_tokens(self):
         """ Regenerate tokens and save them in db
         """
+        old_auth_hash = self.auth_hash
         self.generate_auth_tokens()
         db.session.commit()
+        if old_auth_hash:
+            authcache.invalidate(authcache.user_key(old_auth_hash))
         return self.auth_token
 
     @property
@@ -297,6 +302,8 @@ class AppToken(db.Model):
     """
 
     __tablename__ = 'apptokens'
+    # user has one token for the app, see get_or_create
+    __table_args__ = (db.UniqueConstraint('user_id', 'app_id', name='uq_apptokens_user_app'),)
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -321,4 +328,33 @@ class AppToken(db.Model):
             str(self.user_id) +
             str(self.app_id)  +
             str(urandom(12))
-        ).hexdigest()
\ No newline at end of file
+        ).hexdigest()
+
+
+    @classmethod
+    def create(cls, user, application):
+        token = cls(user, application)
+        db.session.add(token)
+        db.session.commit()
+        # guard may have cached the token as unknown
+        authcache.invalidate(authcache.app_key(token.token))
+        return token
+
+    @classmethod
+    def get_or_create(cls, user_id, app_id):
+        """ Returns token of the user for the app, a new one is created
+            only if the user has no token for the app yet.
+            Assets of a page are requested at once by different workers,
+            the token created by the first of them is returned to all
+        """
+        find = lambda: cls.query.filter(
+            (cls.user_id == user_id) & (cls.app_id == app_id)
+        ).first()
+        token = find()
+        if token:
+            return token
+        try:
+            return cls.create(User.query.get(user_id), Application.query.get(app_id))
+        except IntegrityError:
+            db.session.rollback()
+            return find()
@@ -1,4 +1,6 @@
 from pymongo.errors import OperationFailure
+from coltrane.appstorage.exceptions import IndexQuotaExceededError, IndexLimitExceededError
+from coltrane.appstorage.exceptions import DocumentExistsError
 from coltrane.rest import exceptions
 from coltrane.utils import Enum
 
@@ -12,8 +14,11 @@ class http_status(Enum):
     OK                    = 200
     CREATED               = 201
 
+    NOT_MODIFIED          = 304
+
     BAD_REQUEST           = 400
     UNAUTHORIZED          = 401
+    FORBIDDEN             = 403
     NOT_FOUND             = 404
     CONFLICT              = 409
 
@@ -31,6 +36,7 @@ class app_status(Enum):
     USER_UNAUTHORIZED = 6
     NOT_IMPLEMENTED   = 7
     SERVER_ERROR      = 8
+    QUOTA_EXCEEDED    = 9
 
 
 
@@ -40,5 +46,8 @@ ERROR_INFO_MATCHING = {
     exceptions.InvalidDocumentFieldsError:    (app_status.BAD_REQUEST, http_status.BAD_REQUEST),
     exceptions.InvalidJSONFormatError:  (app_status.BAD_REQUEST, http_status.BAD_REQUEST),
     exceptions.InvalidRequestError:     (app_status.BAD_REQUEST, http_status.BAD_REQUEST),
+    DocumentExistsError: (app_status.CONFLICT, http_status.CONFLICT),
+    IndexQuotaExceededError: (app_status.QUOTA_EXCEEDED, http_status.FORBIDDEN),
+    IndexLimitExceededError: (app_status.QUOTA_EXCEEDED, http_status.FORBIDDEN),
     OperationFailure: (app_status.BAD_REQUEST, http_status.BAD_REQUEST)
 }
\ No newline at end of file
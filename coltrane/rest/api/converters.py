@@ -8,6 +8,17 @@ from coltrane.rest import validators
 import json
 
 class KeysConverter(BaseConverter):
+    """
+        Matches comma separated list of keys only, single key is
+        matched by KeyConverter
+    """
+    # must be checked before KeyConverter which matches any value
+    weight = 50
+
+    def __init__(self, url_map):
+        super(KeysConverter, self).__init__(url_map)
+        self.regex = r'[^/]*,[^/]*'
+
     def to_python(self, value):
         keys = [k.strip() for k in value.split(',')]
 
@@ -21,7 +32,7 @@ class KeysConverter(BaseConverter):
         return keys
 
     def to_url(self, values):
-        return ','.join(BaseConverter.to_url(value) for value in values)
+        return ','.join(BaseConverter.to_url(self, value) for value in values)
 
 
 class KeyConverter(BaseConverter):
@@ -33,7 +44,7 @@ class KeyConverter(BaseConverter):
         return key
 
     def to_url(self, value):
-        return BaseConverter.to_url(value)
+        return BaseConverter.to_url(self, value)
 
 
 class BucketConverter(BaseConverter):
@@ -1,8 +1,10 @@
 import abc
 from datetime import datetime as dt
 from functools import wraps
-from coltrane.appstorage import try_convert_to_date, reservedf
+from werkzeug.wrappers import BaseResponse
+from coltrane.appstorage import try_convert_to_date, reservedf, intf, extf, _external_key
 from coltrane.appstorage.datatypes import Pointer, Blob, GeoPoint
+from coltrane.appstorage.typeconverters import MAPPING, GeoPointConverter
 from coltrane.rest import exceptions
 from coltrane.utils import traverse, Enum
 
@@ -140,18 +142,117 @@ DESERIALISATORS = {
     type_codes.GEO_POINT: GeoPointCaster
 }
 
+def _wire_encoder(converter, caster):
+    if converter is None:
+        return caster.serialize
+    def encode(key, val):
+        return caster.serialize(key, converter.to_external(key, val)[1])
+    return encode
+
+# encoders of internal values straight to the JSON view,
+# geo points are recognized by key instead
+WIRE_ENCODERS = dict((int_type, _wire_encoder(converter, SERIALISATORS[ext_type]))
+                     for int_type, ext_type, converter in MAPPING
+                     if int_type is not dict and ext_type in SERIALISATORS)
+
+INTERNAL_FIELDS = frozenset(intf.values())
+GEO_KEY_PREFIX = GeoPointConverter.START_FOR_GEO_KEY
+
+
+class WireDocument(dict):
+    """ Document which is already in the JSON view, serialize doesn't walk it """
+
+
 def serialize(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        resp = f(*args, **kwargs)
+        body = resp[0]
+        # ready response, e.g. streamed one, is serialized by handler itself
+        if isinstance(body, BaseResponse):
+            return resp
+        return (serialize_document(body),) + tuple(resp[1:])
+    return wrapper
+
+
+def serialize_document(doc):
+    if isinstance(doc, WireDocument):
+        return doc
     def walker(key, value):
+        if isinstance(value, WireDocument):
+            return key, value
         caster = serialisator(value)
         if caster:
             return key, caster.serialize(key, value)
+    return traverse(doc, walker)
 
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        resp = f(*args, **kwargs)
-        body, code = resp
-        return traverse(body, walker), code
-    return wrapper
+
+def wire_document(document):
+    """
+    Converts document fetched from db straight to the JSON view.
+    It gives the same result as external document made by storage
+    and passed to serialize_document, but document is walked once
+    and only changed dicts and lists are copied.
+    Used as view of storage read operations.
+    """
+    if not document:
+        return None
+    wire = WireDocument()
+    for key, val in document.iteritems():
+        if key in INTERNAL_FIELDS:
+            continue
+        key, val = _wire_item(key, val)
+        wire[key] = val
+    wire[extf.KEY] = _external_key(document[intf.ID])
+    return wire
+
+
+def _wire_item(key, val):
+    # due to absence internal data type for geo point
+    # its key starts with special prefix
+    if key.startswith(GEO_KEY_PREFIX):
+        key, point = GeoPointConverter.to_external(key, val)
+        return key, GeoPointCaster.serialize(key, point)
+    val_type = val.__class__
+    if val_type is dict:
+        return key, _wire_dict(val)
+    if val_type is list:
+        return key, _wire_list(val)
+    encoder = WIRE_ENCODERS.get(val_type)
+    if encoder:
+        return key, encoder(key, val)
+    return key, val
+
+
+def _wire_dict(doc):
+    wire = None
+    for key, val in doc.iteritems():
+        new_key, new_val = _wire_item(key, val)
+        if new_val is not val or new_key is not key:
+            if wire is None:
+                wire = dict(doc)
+            if new_key is not key:
+                del wire[key]
+            wire[new_key] = new_val
+    return doc if wire is None else wire
+
+
+def _wire_list(l):
+    wire = None
+    for i, val in enumerate(l):
+        val_type = val.__class__
+        if val_type is dict:
+            new_val = _wire_dict(val)
+        elif val_type is list:
+            new_val = _wire_list(val)
+        else:
+            encoder = WIRE_ENCODERS.get(val_type)
+            new_val = encoder(None, val) if encoder else val
+        if new_val is not val:
+            if wire is None:
+                wire = list(l)
+            wire[i] = new_val
+    return l if wire is None else wire
 
 
 def deserialize(obj):
@@ -1,41 +1,121 @@
+import base64
 import logging
+import zlib
+from datetime import datetime as dt
+from hashlib import sha1
+from itertools import chain
 from flask import Blueprint
-from coltrane.appstorage import reservedf, forbidden_fields
-from coltrane.appstorage.datatypes import Pointer
-from coltrane.appstorage.storage import AppdataStorage
+from pymongo import GEO2D
+from werkzeug.http import quote_etag
+from coltrane.appstorage import reservedf, intf, forbidden_fields, try_convert_to_date
+from coltrane.appstorage.datatypes import Pointer, BaseType, GeoPoint
+from coltrane.appstorage.exceptions import DocumentExistsError
+from coltrane.appstorage.indexes import DeclaredIndexes, DECLARATION_FIELDS
+from coltrane.appstorage.retry import RetryPolicy
+from coltrane.appstorage.storage import AppdataStorage, AGGREGATE_OPERATIONS
 from coltrane.appstorage.storage import extf
-from coltrane.rest.api.datatypes import serialize, deserialize, TYPE_FIELD
+from coltrane.rest.api.datatypes import serialize, serialize_document, deserialize, serialisator, TYPE_FIELD
+from coltrane.rest.api.datatypes import wire_document, WireDocument, type_codes
 from coltrane.rest.extensions import guard
+from coltrane.rest.extensions.compression import WBITS, decompress, decompress_stream
 from coltrane.rest import exceptions, validators, http_status, STATUS_CODE, app_status
 from coltrane.rest.utils import *
 
 RESULTS = 'results'
+CURSOR = 'cursor'
+SPECIAL_INDEXES = '.indexes'
+INDEX_TYPE = 'type'
+INDEX_FIELD_REGEX = re.compile(r'^[a-zA-Z0-9_][a-zA-Z0-9_\-]*(\.[a-zA-Z0-9_\-]+)*$')
+OUTPUT_FIELD_REGEX = re.compile(r'^[a-zA-Z0-9_][a-zA-Z0-9_\-]*$')
+AGGREGATE_KEYS = ('filter', 'group', 'fields', 'sort', 'limit')
+
+# reserved fields set by storage, _expires_at is set by clients
+PROTECTED_FIELDS = [f for f in reservedf.values() if f != reservedf.EXPIRES_AT]
+# internal and reserved fields except creation and update time can't be
+# aggregated, _key is stored as internal id
+NOT_AGGREGATED_FIELDS = (set(intf.values()) | set(reservedf.values()) | set([extf.KEY])) - \
+                        set([reservedf.CREATED_AT, reservedf.UPDATED_AT])
 
 LOG = logging.getLogger('coltrane.rest.api.v1')
 LOG.debug('starting rest api')
 
 
-storage = AppdataStorage(lazy_coll)
+storage = AppdataStorage(lazy_coll, secondary=lazy_secondary_coll)
+indexes = DeclaredIndexes(lazy_coll, lazy_indexes_coll)
 api = Blueprint("api_v1", __name__)
 
 
+@api.record
+def configure_storage(state):
+    config = state.app.config
+    storage.slow_query_threshold = config.get('SLOW_QUERY_THRESHOLD')
+    storage.retry = RetryPolicy(attempts=config.get('MONGODB_RETRY_ATTEMPTS', 5),
+                                budget=config.get('MONGODB_RETRY_BUDGET', 5.0),
+                                report_interval=config.get('MONGODB_RETRY_REPORT_INTERVAL', 60.0))
+    storage.bucket_ttls = config.get('BUCKET_TTLS') or {}
+
+
 @api.route('/<bucket:bucket>/<key:key>', methods=['GET'])
 @jsonify
 @serialize
 def get_by_keys_handler(bucket, key):
 
     include_fields = extract_include_data()
-
-    doc = storage.get(get_app_id(), get_user_id(), bucket, key)
+    fields, exclude = extract_projection_data(include_fields=include_fields)
+
+    # embedded documents change on their own, so such responses aren't cached
+    if not include_fields and is_conditional_request():
+        # version is checked on primary, stale secondary must not answer 304
+        version = storage.get_version(get_app_id(), get_user_id(), bucket, key)
+        if version is not None:
+            etag = document_etag(bucket, key, version)
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+
+    doc = storage.get(get_app_id(), get_user_id(), bucket, key,
+                      read_secondary=is_secondary_read(),
+                      view=response_view(include_fields),
+                      fields=fields, exclude=exclude)
     if doc:
         if include_fields:
             fetch_embed_documents([doc], include_fields)
-        return doc, http_status.OK
+            return doc, http_status.OK
+        return doc, http_status.OK, etag_header(
+            document_etag(bucket, key, document_version(doc)))
     else:
         return {STATUS_CODE: app_status.NOT_FOUND,
                 'message': resp_msgs.DOC_NOT_EXISTS}, http_status.NOT_FOUND
 
 
+@api.route('/<bucket:bucket>/<keys:keys>', methods=['GET'])
+@jsonify
+@serialize
+def get_by_multiple_keys_handler(bucket, keys):
+
+    include_fields = extract_include_data()
+    fields, exclude = extract_projection_data(include_fields=include_fields)
+
+    docs = storage.get_many(get_app_id(), get_user_id(), bucket, keys,
+                            read_secondary=is_secondary_read(),
+                            view=response_view(include_fields),
+                            fields=fields, exclude=exclude)
+    found = [doc for doc in docs if doc]
+    if not found:
+        return {STATUS_CODE: app_status.NOT_FOUND,
+                'message': resp_msgs.DOC_NOT_EXISTS}, http_status.NOT_FOUND
+
+    if include_fields:
+        fetch_embed_documents(found, include_fields)
+    results = []
+    for key, doc in zip(keys, docs):
+        if doc:
+            results.append(doc)
+        else:
+            results.append({extf.KEY: key, STATUS_CODE: app_status.NOT_FOUND,
+                            'message': resp_msgs.DOC_NOT_EXISTS})
+    return {RESULTS: results}, http_status.OK
+
+
 @api.route('/<bucket:bucket>', methods=['GET'])
 @jsonify
 @serialize
@@ -45,21 +125,49 @@ def get_by_filter_handler(bucket):
     skip, limit = extract_pagination_data()
     sort = extract_sort_data()
     count = extract_counting_data() # count flag
+    include_fields = extract_include_data()
+    fields, exclude = extract_projection_data(sort, include_fields)
+    after = extract_cursor_data(sort)
     count_only = count
     # if limit greater then 0 it means that documents have to be returned as well as count parameter
     if limit:
         count_only = False
 
+    if is_explain_mode():
+        plan = storage.explain(get_app_id(), get_user_id(), bucket,
+                               filter_opts, sort, skip, limit, after,
+                               read_secondary=is_secondary_read(),
+                               fields=fields, exclude=exclude)
+        return {'explain': plan}, http_status.OK
+
+    if is_stream_mode() and not count_only:
+        return stream_documents(bucket, filter_opts, sort, skip, limit, after,
+                                include_fields, count, fields, exclude)
+
     storage_response = storage.find(get_app_id(), get_user_id(), bucket,
-                             filter_opts, sort, skip, limit, count_only)
+                             filter_opts, sort, skip, limit, count_only, after,
+                             read_secondary=is_secondary_read(),
+                             view=response_view(include_fields),
+                             fields=fields, exclude=exclude)
     if count_only:
         return {RESULTS: [], 'count': storage_response}, http_status.OK
     else:
         if len(storage_response):
+            if include_fields:
+                fetch_embed_documents(storage_response, include_fields)
             response = {RESULTS: storage_response}
             if count:
                 response.update({'count': len(storage_response)})
-            return response, http_status.OK
+            if sort and len(storage_response) == limit:
+                cursor = make_cursor(storage_response[-1], sort)
+                if cursor:
+                    response[CURSOR] = cursor
+            if include_fields:
+                return response, http_status.OK
+            etag = page_etag(bucket, storage_response)
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+            return response, http_status.OK, etag_header(etag)
 
         return {'message': resp_msgs.DOC_NOT_EXISTS,
                 STATUS_CODE: app_status.NOT_FOUND}, http_status.NOT_FOUND
@@ -79,18 +187,140 @@ def post_handler(bucket, key):
     else:
         key = document.get(extf.KEY, None)
 
-    if extf.KEY in document:
-        if storage.is_document_exists(get_app_id(), get_user_id(),
-                        bucket, {extf.KEY: key}):
-            raise exceptions.DocumentAlreadyExistsError(
-                key=key,
-                bucket=bucket)
-
-    document_key = storage.create(get_app_id(), get_user_id(), bucket, get_remote_ip(),
-                                  document)
+    try:
+        document_key = storage.create(get_app_id(), get_user_id(), bucket, get_remote_ip(),
+                                      document)
+    except DocumentExistsError:
+        raise exceptions.DocumentAlreadyExistsError(
+            key=key,
+            bucket=bucket)
     return {extf.KEY: document_key}, http_status.CREATED
 
 
+@api.route('/<bucket:bucket>/_bulk', methods=['POST'])
+@jsonify
+@serialize
+def bulk_post_handler(bucket):
+    """ Create many documents at once and get result for each of them back
+    """
+    documents = extract_bulk_form_data()
+
+    created = storage.create_many(get_app_id(), get_user_id(), bucket,
+                                  get_remote_ip(), documents)
+    results = []
+    for key, success in created:
+        if success:
+            results.append({extf.KEY: key, STATUS_CODE: app_status.CREATED})
+        else:
+            error = exceptions.DocumentAlreadyExistsError(key=key, bucket=bucket)
+            results.append({extf.KEY: key, STATUS_CODE: app_status.CONFLICT,
+                            'message': error.message})
+    return {RESULTS: results}, http_status.OK
+
+
+@api.route('/<bucket:bucket>/_bulk', methods=['PATCH'])
+@jsonify
+@serialize
+def bulk_patch_handler(bucket):
+    """ Update many documents by keys at once and get result for each of them back
+    """
+    updates = extract_bulk_update_data()
+
+    updated = storage.update_many(get_app_id(), get_user_id(), bucket,
+                                  get_remote_ip(), updates)
+    results = []
+    for (key, document), count in zip(updates, updated):
+        if count:
+            results.append({extf.KEY: key, STATUS_CODE: app_status.OK,
+                            'message': resp_msgs.DOC_UPDATED})
+        else:
+            results.append({extf.KEY: key, STATUS_CODE: app_status.NOT_FOUND,
+                            'message': resp_msgs.DOC_NOT_EXISTS})
+    return {RESULTS: results}, http_status.OK
+
+
+@api.route('/<bucket:bucket>/_aggregate', methods=['POST'])
+@jsonify
+@serialize
+def aggregate_handler(bucket):
+    """ Group documents matching the filter and get count, sum, avg,
+        min or max of every group back, groups are computed by db.
+        db 2.0 has no aggregate command and its group command fails when
+        documents make more than 20000 groups, whatever limit is
+    """
+    filter_opts, group_by, accumulators, sort, limit = extract_aggregate_data()
+
+    results = storage.aggregate(get_app_id(), get_user_id(), bucket,
+                                filter_opts, group_by, accumulators, sort, limit,
+                                read_secondary=is_secondary_read())
+    return {RESULTS: results}, http_status.OK
+
+
+@api.route('/<bucket:bucket>/_export', methods=['GET'])
+def export_handler(bucket):
+    """ Export all documents of the bucket as newline delimited json
+    """
+    batches = storage.find_batches(get_app_id(), get_user_id(), bucket, limit=0,
+        batch_size=current_app.config.get('STREAM_BATCH_SIZE', 100),
+        read_secondary=is_secondary_read(), view=wire_document)
+
+    def generate():
+        for batch in batches:
+            yield ''.join(to_json(serialize_document(doc)) + '\n'
+                          for doc in batch)
+
+    return current_app.response_class(generate(),
+        mimetype='application/x-ndjson')
+
+
+@api.route('/<bucket:bucket>/_import', methods=['POST'])
+@jsonify
+@serialize
+def import_handler(bucket):
+    """ Import newline delimited json documents, e.g. made by export.
+        Body is read line by line and documents are created by batches,
+        so memory used by request doesn't depend on size of import
+    """
+    batch_size = current_app.config.get('IMPORT_BATCH_SIZE', 500)
+    max_errors = current_app.config.get('MAX_IMPORT_ERRORS', 100)
+    summary = {'created': 0, 'failed': 0, 'errors': []}
+
+    def error(line_number, message):
+        summary['failed'] += 1
+        if len(summary['errors']) < max_errors:
+            summary['errors'].append({'line': line_number, 'message': message})
+
+    def create(batch):
+        line_numbers, documents = zip(*batch)
+        created = storage.create_many(get_app_id(), get_user_id(), bucket,
+                                      get_remote_ip(), list(documents))
+        for line_number, (key, success) in zip(line_numbers, created):
+            if success:
+                summary['created'] += 1
+            else:
+                error(line_number, exceptions.DocumentAlreadyExistsError(
+                    key=key, bucket=bucket).message)
+
+    batch = []
+    lines = extract_body_lines()
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            batch.append((line_number, extract_import_document(line)))
+        except exceptions.ApiError, e:
+            error(line_number, e.message)
+            continue
+        if len(batch) == batch_size:
+            create(batch)
+            batch = []
+    if batch:
+        create(batch)
+
+    return summary, http_status.OK
+
+
 @api.route('/<bucket:bucket>/<key:key>', methods=['PUT'])
 @jsonify
 @serialize
@@ -101,25 +331,22 @@ def put_by_keys_handler(bucket, key):
     document = extract_form_data()
     force = is_force_mode()
 
-    filter_opts = {extf.KEY: key}
-
-    if not storage.is_document_exists(get_app_id(), get_user_id(),
-        bucket, filter_opts):
-        if force:
-            document[extf.KEY] = key
-            document = generate_normal_view(document)
-            storage.create(get_app_id(), get_user_id(), bucket, get_remote_ip(),
-                document)
+    if force:
+        created = storage.upsert(get_app_id(), get_user_id(), bucket,
+            get_remote_ip(), document, key)
+        if created:
             return {extf.KEY: key}, http_status.CREATED
-        else:
-            return {STATUS_CODE: app_status.NOT_FOUND,
-                    'message': resp_msgs.DOC_NOT_EXISTS}, http_status.NOT_FOUND
-    else:
-        storage.update(get_app_id(), get_user_id(), bucket, get_remote_ip(),
-            document, key=key)
         return {STATUS_CODE: app_status.OK,
                 'message': resp_msgs.DOC_UPDATED}, http_status.OK
 
+    updated = storage.update(get_app_id(), get_user_id(), bucket, get_remote_ip(),
+        document, key=key)
+    if updated:
+        return {STATUS_CODE: app_status.OK,
+                'message': resp_msgs.DOC_UPDATED}, http_status.OK
+    return {STATUS_CODE: app_status.NOT_FOUND,
+            'message': resp_msgs.DOC_NOT_EXISTS}, http_status.NOT_FOUND
+
 
 @api.route('/<bucket:bucket>', methods=['PUT'])
 @jsonify
@@ -132,29 +359,26 @@ def put_by_filter_handler(bucket):
     filter_opts = extract_filter_opts()
     force = is_force_mode()
 
-    if not storage.is_document_exists(get_app_id(), get_user_id(),
-                                      bucket, filter_opts):
-        if force:
-            document = generate_normal_view(document)
+    updated = storage.update(get_app_id(), get_user_id(), bucket, get_remote_ip(),
+                             document, filter_opts=filter_opts)
+    if updated:
+        return {'message': resp_msgs.DOC_UPDATED, STATUS_CODE: app_status.OK}, http_status.OK
 
-            key = storage.create(
-                get_app_id(), get_user_id(),  bucket, get_remote_ip(), document
-            )
-            return {
-                extf.KEY: key, 'message': resp_msgs.DOC_CREATED,
-                STATUS_CODE: app_status.CREATED
-            }, http_status.CREATED
+    if force:
+        document = generate_normal_view(document)
 
-        else:
-            return {
-                'message': resp_msgs.DOC_NOT_EXISTS,
-                STATUS_CODE: app_status.NOT_FOUND
-            }, http_status.NOT_FOUND
-
-    storage.update(get_app_id(), get_user_id(), bucket, get_remote_ip(),
-                   document, filter_opts=filter_opts)
+        key = storage.create(
+            get_app_id(), get_user_id(),  bucket, get_remote_ip(), document
+        )
+        return {
+            extf.KEY: key, 'message': resp_msgs.DOC_CREATED,
+            STATUS_CODE: app_status.CREATED
+        }, http_status.CREATED
 
-    return {'message': resp_msgs.DOC_UPDATED, STATUS_CODE: app_status.OK}, http_status.OK
+    return {
+        'message': resp_msgs.DOC_NOT_EXISTS,
+        STATUS_CODE: app_status.NOT_FOUND
+    }, http_status.NOT_FOUND
 
 
 @api.route('/<bucket:bucket>/<key:key>', methods=['DELETE'])
@@ -163,16 +387,13 @@ def put_by_filter_handler(bucket):
 def delete_by_keys_handler(bucket, key):
     """ Deletes existing document (C.O.)
     """
-    filter_opts = {extf.KEY: key}
-    if not storage.is_document_exists(get_app_id(), get_user_id(),
-        bucket, filter_opts):
+    deleted = storage.delete(get_app_id(), get_user_id(), bucket, get_remote_ip(),
+        key=key)
+    if not deleted:
         return {STATUS_CODE: app_status.NOT_FOUND,
                 'message': resp_msgs.DOC_NOT_EXISTS}, http_status.NOT_FOUND
-    else:
-        storage.delete(get_app_id(), get_user_id(), bucket, get_remote_ip(),
-            filter_opts=filter_opts)
-        return {STATUS_CODE: app_status.OK,
-                'message': resp_msgs.DOC_DELETED}, http_status.OK
+    return {STATUS_CODE: app_status.OK,
+            'message': resp_msgs.DOC_DELETED}, http_status.OK
 
 
 @api.route('/<bucket:bucket>', methods=['DELETE'])
@@ -182,44 +403,262 @@ def delete_by_filter_handler(bucket):
     """ Delete all documents matched with filter
     """
     filter_opts = extract_filter_opts()
-    if not storage.is_document_exists(get_app_id(), get_user_id(),
-                                      bucket, filter_opts):
+    deleted = storage.delete(get_app_id(), get_user_id(), bucket, get_remote_ip(),
+                             filter_opts=filter_opts)
+    if not deleted:
         return {'message': resp_msgs.DOC_NOT_EXISTS,
                 STATUS_CODE: app_status.NOT_FOUND}, http_status.NOT_FOUND
-    
-    storage.delete(get_app_id(), get_user_id(), bucket, get_remote_ip(),
-                    filter_opts=filter_opts)
 
     return {'message': resp_msgs.DOC_DELETED}, http_status.OK
 
 
-def fetch_embed_documents(documents, include_fields):
+@api.route('/<special:special>', defaults={'bucket': None},
+           methods=['GET', 'POST', 'PUT', 'DELETE'])
+@api.route('/<special:special>/<bucket:bucket>',
+           methods=['GET', 'POST', 'PUT', 'DELETE'])
+@jsonify
+@serialize
+def special_handler(special, bucket):
+    """ Dispatches requests to special buckets such as .indexes
+    """
+    handler = special_handlers.get((special, request.method))
+    if handler is None:
+        return {STATUS_CODE: app_status.NOT_FOUND,
+                'message': resp_msgs.NOT_FOUND}, http_status.NOT_FOUND
+    return handler(bucket)
+
+
+def get_indexes_handler(bucket):
+    """ Lists indexes declared by the app for the bucket or for all buckets
+    """
+    results = []
+    for declaration in indexes.find(get_app_id(), bucket):
+        fields = declaration[DECLARATION_FIELDS]
+        if fields[0][1] == GEO2D:
+            declaration[INDEX_TYPE] = GEO2D
+        declaration[DECLARATION_FIELDS] = [field if direction in (1, GEO2D) else '-' + field
+            for field, direction in fields]
+        results.append(declaration)
+    return {RESULTS: results}, http_status.OK
+
+
+def post_index_handler(bucket):
+    """ Declares index on the fields of the bucket
+    """
+    if bucket is None:
+        return {STATUS_CODE: app_status.NOT_FOUND,
+                'message': resp_msgs.NOT_FOUND}, http_status.NOT_FOUND
+
+    fields = extract_index_data()
+    created = indexes.declare(get_app_id(), bucket, fields,
+        current_app.config.get('MAX_APP_INDEXES', 10),
+        current_app.config.get('MAX_GEO_INDEXES', 1),
+        current_app.config.get('MAX_DECLARED_INDEXES', 50))
+    if created:
+        return {STATUS_CODE: app_status.CREATED,
+                'message': resp_msgs.INDEX_CREATED}, http_status.CREATED
+    return {STATUS_CODE: app_status.OK,
+            'message': resp_msgs.INDEX_EXISTS}, http_status.OK
+
+
+def delete_index_handler(bucket):
+    """ Removes index declared by the app, fields are passed the same way
+        as for declaration
+    """
+    if bucket is None:
+        return {STATUS_CODE: app_status.NOT_FOUND,
+                'message': resp_msgs.NOT_FOUND}, http_status.NOT_FOUND
+
+    fields = extract_index_data()
+    if not indexes.undeclare(get_app_id(), bucket, fields):
+        return {STATUS_CODE: app_status.NOT_FOUND,
+                'message': resp_msgs.INDEX_NOT_EXISTS}, http_status.NOT_FOUND
+    return {'message': resp_msgs.INDEX_DELETED}, http_status.OK
+
+
+special_handlers = {
+    (SPECIAL_INDEXES, 'GET'): get_indexes_handler,
+    (SPECIAL_INDEXES, 'POST'): post_index_handler,
+    (SPECIAL_INDEXES, 'DELETE'): delete_index_handler,
+}
+
+
+def stream_documents(bucket, filter_opts, sort, skip, limit, after,
+                     include_fields, count, fields=None, exclude=None):
+    """ Streams found documents to the client batch by batch, so memory
+        used by request doesn't depend on number of documents.
+        Response generator is run when request context is already gone,
+        so everything it needs is taken from the request beforehand. """
+
+    app_id, user_id = get_app_id(), get_user_id()
+    batch_size = current_app.config.get('STREAM_BATCH_SIZE', 100)
+    batches = storage.find_batches(app_id, user_id, bucket, filter_opts,
+                                   sort, skip, limit, after, batch_size,
+                                   read_secondary=is_secondary_read(),
+                                   view=response_view(include_fields),
+                                   fields=fields, exclude=exclude)
+    # first batch is fetched before the response is started
+    # to be able to answer with error if nothing was found
+    first = next(batches, None)
+    if first is None:
+        return {'message': resp_msgs.DOC_NOT_EXISTS,
+                STATUS_CODE: app_status.NOT_FOUND}, http_status.NOT_FOUND
+
+    def generate():
+        total = 0
+        last = None
+        yield '{"%s": [' % RESULTS
+        for batch in chain([first], batches):
+            if include_fields:
+                fetch_embed_documents(batch, include_fields, app_id, user_id)
+            for doc in batch:
+                yield (',' if total else '') + to_json(serialize_document(doc))
+                total += 1
+            last = batch[-1]
+        yield ']'
+        if count:
+            yield ', "count": %d' % total
+        if sort and total == limit:
+            cursor = make_cursor(last, sort)
+            if cursor:
+                yield ', "%s": "%s"' % (CURSOR, cursor)
+        yield '}'
+
+    return current_app.response_class(generate(),
+        mimetype='application/json'), http_status.OK
+
+
+def document_version(document):
+    """ Time of the last change of external or JSON view of the document
+        as iso string, see AppdataStorage.get_version """
+    versions = [document.get(reservedf.CREATED_AT), document.get(reservedf.UPDATED_AT)]
+    return max(v.isoformat() if isinstance(v, dt) else v for v in versions) or ''
+
+
+def document_etag(bucket, key, version):
+    if isinstance(version, dt):
+        version = version.isoformat()
+    return sha1('|'.join([get_app_id(), get_user_id(), bucket, key, version])
+                .encode('utf-8')).hexdigest()
+
+
+def page_etag(bucket, documents):
+    """ Page changes when any of its documents is changed, removed
+        or a new one gets into it, so versions of its documents are hashed.
+        Query is in the url, client keeps etag for the url """
+    hash = sha1('|'.join([get_app_id(), get_user_id(), bucket]).encode('utf-8'))
+    for document in documents:
+        hash.update(('|%s|%s' % (document[extf.KEY], document_version(document)))
+                    .encode('utf-8'))
+    return hash.hexdigest()
+
+
+def etag_header(etag):
+    # the same document may be pretty printed or compressed, so tag is weak.
+    # quote_etag of werkzeug makes lowercase w/ prefix
+    return {'ETag': 'W/' + quote_etag(etag)}
+
+
+def is_conditional_request():
+    # ETags of werkzeug are false if they hold weak tags only
+    return 'If-None-Match' in request.headers
+
+
+def not_modified(etag):
+    return current_app.response_class(status=http_status.NOT_MODIFIED,
+                                      headers=etag_header(etag)), http_status.NOT_MODIFIED
+
+
+def response_view(include_fields):
+    """ Found documents are converted straight to the JSON view,
+        unless their pointers are replaced by embedded documents """
+    if include_fields:
+        return None
+    return wire_document
+
+
+def fetch_embed_documents(documents, include_fields, app_id=None, user_id=None):
     """Check whether document contain each of include_fields.
     If it has such key and its value is Pointer then make fetching document
     corresponding to Pointer object. Also make fetching embedded documents if a value
-    by specified key is list and have all or some Pointer objects."""
-
-    def fetch_by_pointer(pointer):
-        embed_doc = storage.get(get_app_id(),
-            get_user_id(), pointer.bucket, pointer.key)
-        embed_doc_view = {TYPE_FIELD: 'Object',
-                          Pointer.BUCKET: pointer.bucket, Pointer.KEY: pointer.key}
-        if embed_doc:
-            embed_doc_view.update(embed_doc)
-        return embed_doc_view
-
-    for field in include_fields:
+    by specified key is list and have all or some Pointer objects.
+    Include field may be a path like 'author.company', then 'company' is
+    fetched in documents fetched by 'author' pointers. Paths are resolved
+    level by level and each level costs one query per bucket."""
+
+    app_id = app_id or get_app_id()
+    user_id = user_id or get_user_id()
+    requests = [(documents, include_fields)]
+    while requests:
+        requests = fetch_embed_level(requests, app_id, user_id)
+
+
+def fetch_embed_level(requests, app_id, user_id):
+    """Fetch pointers of the top level of include paths for all requests.
+    Each request is a pair of documents and include fields for them.
+    Returns requests for the next level of include paths."""
+
+    def pointers(val):
+        if isinstance(val, Pointer):
+            return [val]
+        elif type(val) == list:
+            return [v for v in val if isinstance(v, Pointer)]
+        return []
+
+    # split include paths into top level field and the rest of path
+    fields = []
+    for documents, include_fields in requests:
+        paths = {}
+        for field in include_fields:
+            field, _, tail = field.partition('.')
+            tails = paths.setdefault(field, [])
+            if tail:
+                tails.append(tail)
+        for field, tails in paths.items():
+            fields.append((documents, field, tails))
+
+    # collect pointers of all documents grouped by bucket
+    buckets = {}
+    for documents, field, _ in fields:
+        for doc in documents:
+            for pointer in pointers(doc.get(field)):
+                buckets.setdefault(pointer.bucket, set()).add(pointer.key)
+
+    # fetch all documents of the bucket at once
+    views = {}
+    found = set()
+    for bucket, keys in buckets.items():
+        keys = list(keys)
+        embed_docs = storage.get_many(app_id, user_id, bucket, keys)
+        for key, embed_doc in zip(keys, embed_docs):
+            embed_doc_view = {TYPE_FIELD: 'Object',
+                              Pointer.BUCKET: bucket, Pointer.KEY: key}
+            if embed_doc:
+                embed_doc_view.update(embed_doc)
+                found.add((bucket, key))
+            views[(bucket, key)] = embed_doc_view
+
+    # put fetched documents in place of pointers
+    next_requests = []
+    for documents, field, tails in fields:
+        embedded = {}
         for doc in documents:
             val = doc.get(field)
-            if val:
-                if isinstance(val, Pointer):
-                    doc[field] = fetch_by_pointer(val)
-                elif type(val) == list:
-                    for i in range(len(val)):
-                        v = val[i]
-                        if not isinstance(v, Pointer):
-                            continue
-                        val[i] = fetch_by_pointer(v)
+            for pointer in pointers(val):
+                if (pointer.bucket, pointer.key) in found:
+                    embedded[(pointer.bucket, pointer.key)] = \
+                        views[(pointer.bucket, pointer.key)]
+            if isinstance(val, Pointer):
+                doc[field] = views[(val.bucket, val.key)]
+            elif type(val) == list:
+                for i in range(len(val)):
+                    v = val[i]
+                    if not isinstance(v, Pointer):
+                        continue
+                    val[i] = views[(v.bucket, v.key)]
+        if tails and embedded:
+            next_requests.append((embedded.values(), tails))
+    return next_requests
 
 
 def validate_forbidden_fields(doc, fields=None):
@@ -230,7 +669,7 @@ def validate_forbidden_fields(doc, fields=None):
 
     
 def validate_document(document):
-    fields = forbidden_fields.values() + reservedf.values()
+    fields = forbidden_fields.values() + PROTECTED_FIELDS
     validate_forbidden_fields(document, fields)
     validators.SaveDocumentKeysValidator(document).validate()
 
@@ -241,10 +680,29 @@ def validate_filter(filter):
 
 
 def validate_doc_for_update(update_doc):
-    fields = forbidden_fields.values() + extf.values() + reservedf.values()
+    fields = forbidden_fields.values() + extf.values() + PROTECTED_FIELDS
     validate_forbidden_fields(update_doc, fields)
     validators.UpdateDocumentKeysValidator(update_doc).validate()
 
+
+def cast_expiration(document):
+    """
+    _expires_at is passed as Date or as iso string the way it is returned,
+    it is stored as datetime. Updates may $set it as well
+    """
+    if type(document) is not dict:
+        return
+    for doc in (document, document.get('$set')):
+        if type(doc) is not dict or reservedf.EXPIRES_AT not in doc:
+            continue
+        value = doc[reservedf.EXPIRES_AT]
+        if isinstance(value, basestring):
+            value = try_convert_to_date(value)
+        if not isinstance(value, dt):
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. %s must be a date' % reservedf.EXPIRES_AT)
+        doc[reservedf.EXPIRES_AT] = value
+
     
 def generate_normal_view(document):
     """
@@ -271,19 +729,112 @@ def from_json(obj):
         raise exceptions.InvalidJSONFormatError("Invalid json object \"%s\"" % obj)
 
 
-def extract_form_data():
+def extract_content_encoding():
     """
-    Extracts form data when was passed json data in the HTTP headers
+    Returns gzip or deflate if body of request is compressed, None otherwise
     """
-    if request.json:
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if not encoding or encoding == 'identity':
+        return None
+    if encoding not in WBITS:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Content encoding %s is not supported' % encoding)
+    return encoding
+
+
+def extract_body():
+    """
+    Returns body of request, compressed one is decompressed
+    """
+    encoding = extract_content_encoding()
+    max_size = current_app.config.get('MAX_DECOMPRESSED_SIZE', 16 * 1024 * 1024)
+    try:
+        body = decompress(request.data, encoding, max_size)
+    except zlib.error:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Body is not compressed by %s' % encoding)
+    if body is None:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Decompressed body is greater than %d bytes' % max_size)
+    return body
+
+
+def extract_body_lines():
+    """
+    Returns iterator over lines of request body read from the stream,
+    compressed body is decompressed on the fly and may be no greater
+    than MAX_DECOMPRESSED_SIZE after decompression. Line may be
+    no greater than MAX_IMPORT_LINE_SIZE, so memory used by the request
+    doesn't depend on the body
+    """
+    encoding = extract_content_encoding()
+    max_size = current_app.config.get('MAX_DECOMPRESSED_SIZE', 16 * 1024 * 1024)
+    max_line = current_app.config.get('MAX_IMPORT_LINE_SIZE', 1024 * 1024)
+
+    def too_long():
+        return exceptions.InvalidRequestError(
+            'Invalid request syntax. Line is greater than %d bytes' % max_line)
+
+    def lines():
+        chunks = iter(lambda: request.stream.read(65536), '')
+        if encoding:
+            chunks = decompress_stream(chunks, encoding)
+        # parts of unfinished line, they are joined once the line ends
+        tail = []
+        tail_size = 0
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if encoding and size > max_size:
+                    raise exceptions.InvalidRequestError(
+                        'Invalid request syntax. Decompressed body is greater '
+                        'than %d bytes' % max_size)
+                chunk_lines = chunk.split('\n')
+                if len(chunk_lines) > 1:
+                    chunk_lines[0] = ''.join(tail) + chunk_lines[0]
+                    tail = []
+                    tail_size = 0
+                tail.append(chunk_lines.pop())
+                tail_size += len(tail[-1])
+                for line in chunk_lines:
+                    if len(line) > max_line:
+                        raise too_long()
+                    yield line + '\n'
+                if tail_size > max_line:
+                    raise too_long()
+        except zlib.error:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Body is not compressed by %s' % encoding)
+        tail = ''.join(tail)
+        if tail:
+            yield tail
+    return lines()
+
+
+def extract_json_data():
+    """
+    Extracts json object passed in the body of request
+    """
+    if extract_content_encoding():
+        obj = from_json(extract_body())
+    elif request.json:
         obj = request.json
     elif request.data:
         obj = from_json(request.data)
     else:
         #FIXME: DIRTY DIRTY DIRTY SUCKER
         obj = from_json(request.form.keys()[0])
+    return obj
+
 
+def extract_form_data():
+    """
+    Extracts form data when was passed json data in the HTTP headers
+    """
+    obj = extract_json_data()
     document = deserialize(obj)
+    cast_expiration(document)
 
     if request.method == 'POST':
         validate_document(document)
@@ -294,6 +845,216 @@ def extract_form_data():
     return document
 
 
+def extract_bulk_data():
+    """
+    Extracts list of objects passed to bulk operations
+    """
+    obj = extract_json_data()
+    if type(obj) is not list or not len(obj):
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. List of documents was not specified')
+    max_bulk_size = current_app.config.get('MAX_BULK_SIZE', 1000)
+    if len(obj) > max_bulk_size:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. No more than %d documents '
+            'can be passed at once' % max_bulk_size)
+    return obj
+
+
+def extract_bulk_form_data():
+    """
+    Extracts list of documents for bulk operations
+    """
+    documents = []
+    for doc in extract_bulk_data():
+        if type(doc) is not dict:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Each document must be an object')
+        document = deserialize(doc)
+        cast_expiration(document)
+        validate_document(document)
+        documents.append(document)
+    return documents
+
+
+def extract_bulk_update_data():
+    """
+    Extracts list of (key, update document) pairs for bulk update,
+    each update document has _key of the document it is applied to
+    """
+    updates = []
+    for doc in extract_bulk_data():
+        if type(doc) is not dict or not isinstance(doc.get(extf.KEY), basestring):
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Each document must be an object with _key')
+        doc = dict(doc)
+        key = doc.pop(extf.KEY)
+        if not doc:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Nothing to update in document [%s]' % key)
+        document = deserialize(doc)
+        cast_expiration(document)
+        validate_doc_for_update(generate_normal_view(document))
+        updates.append((key, document))
+    return updates
+
+
+def extract_import_document(line):
+    """
+    Extracts document from a line of imported data.
+    Reserved fields are set by storage, so they are dropped
+    instead of being refused, exported _expires_at is kept
+    """
+    obj = from_json(line)
+    if type(obj) is not dict:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Each document must be an object')
+    for field in PROTECTED_FIELDS:
+        obj.pop(field, None)
+
+    document = deserialize(obj)
+    cast_expiration(document)
+    validate_document(document)
+    return document
+
+
+def extract_index_data():
+    """
+    Extracts fields of declared index, they are passed the same way as
+    sort parameter, i.e. {"fields": ["price", "-rating"]}.
+    Geo index has one field and 2d type, i.e. {"fields": ["place"], "type": "2d"}
+    """
+    obj = extract_json_data()
+    fields = obj.get(DECLARATION_FIELDS) if type(obj) is dict else None
+    if type(fields) is not list or not len(fields):
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Fields of index were not specified')
+    geo = obj.get(INDEX_TYPE) == GEO2D
+    if INDEX_TYPE in obj and not geo:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Only %s index type is supported' % GEO2D)
+    if geo and (len(fields) != 1 or not isinstance(fields[0], basestring)
+                or fields[0].startswith('-') or fields[0] == extf.KEY):
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Geo index must have one field')
+    max_fields = current_app.config.get('MAX_INDEX_FIELDS', 5)
+    if len(fields) > max_fields:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Index may have no more than %d fields'
+            % max_fields)
+
+    index = []
+    for field in fields:
+        if not isinstance(field, basestring):
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Field of index must be a string')
+        direction = 1
+        if field.startswith('-'):
+            field = field[1:]
+            direction = -1
+        # internal fields such as __hashid__ can't be indexed by apps
+        if not INDEX_FIELD_REGEX.match(field) or field.startswith('__'):
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Field [%s] can not be indexed' % field)
+        if field in [f for f, d in index]:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Field [%s] is passed twice' % field)
+        index.append((field, GEO2D if geo else direction))
+    return index
+
+
+def extract_aggregate_data():
+    """
+    Extracts aggregate request, e.g.
+    {"filter": {"price": {"$gt": 10}}, "group": ["category"],
+     "fields": {"n": {"$count": true}, "total": {"$sum": "price"}},
+     "sort": ["-total"], "limit": 10}
+    Every part is optional, though group or fields must be passed.
+    Returns filter, group fields, accumulators, sort and limit
+    """
+    obj = extract_json_data()
+    if type(obj) is not dict:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Aggregate must be an object')
+    for key in obj:
+        if key not in AGGREGATE_KEYS:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Unknown aggregate option [%s]' % key)
+
+    filter_opts = obj.get('filter')
+    if filter_opts is not None:
+        if type(filter_opts) is not dict:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Filter must be an object')
+        filter_opts = make_filter_opts(filter_opts)
+        if has_geo_point(filter_opts):
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Geo search can not be used in aggregate')
+
+    def document_field(field):
+        if not isinstance(field, basestring) or not INDEX_FIELD_REGEX.match(field) \
+           or field.startswith('__') or field.split('.')[0] in NOT_AGGREGATED_FIELDS:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Field [%s] can not be aggregated' % field)
+        return field
+
+    group_by = obj.get('group') or []
+    if isinstance(group_by, basestring):
+        group_by = [group_by]
+    if type(group_by) is not list:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Group must be a field or list of fields')
+    group_by = [document_field(field) for field in group_by]
+    if len(set(group_by)) != len(group_by):
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Group field is passed twice')
+
+    fields = obj.get('fields') or {}
+    if type(fields) is not dict:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Fields must be an object')
+    accumulators = {}
+    for name, spec in fields.items():
+        if not OUTPUT_FIELD_REGEX.match(name) or name.startswith('__') \
+           or name in group_by:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Invalid output field [%s]' % name)
+        key = spec.keys()[0] if type(spec) is dict and len(spec) == 1 else ''
+        operation = key[1:]
+        if not key.startswith('$') or operation not in AGGREGATE_OPERATIONS:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Field [%s] must be one of $%s'
+                % (name, ', $'.join(AGGREGATE_OPERATIONS)))
+        field = None if operation == 'count' else document_field(spec.values()[0])
+        accumulators[name] = (operation, field)
+    if not group_by and not accumulators:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Group or fields must be specified')
+
+    sort = []
+    if type(obj.get('sort') or []) is not list:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Sort must be a list of fields')
+    for field in obj.get('sort') or []:
+        order = 1
+        if isinstance(field, basestring) and field.startswith('-'):
+            field = field[1:]
+            order = -1
+        if field not in group_by and field not in accumulators:
+            raise exceptions.InvalidRequestError(
+                'Invalid request syntax. Sort field [%s] is not grouped '
+                'or aggregated' % field)
+        sort.append((field, order))
+
+    max_limit = current_app.config.get('MAX_QUERY_LIMIT', 1000)
+    limit = obj.get('limit', current_app.config.get('DEFAULT_QUERY_LIMIT', 100))
+    if type(limit) is not int or not 0 < limit <= max_limit:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Limit must be between 1 and %d' % max_limit)
+
+    return filter_opts, group_by, accumulators, sort, limit
+
+
 def extract_filter_opts():
     """
     Extracts filter data from the url
@@ -301,15 +1062,33 @@ def extract_filter_opts():
     filter = request.args.get('filter', None)
     if filter is not None:
         filter = filter.strip()
-        filter = from_json(filter)
-        if not len(filter):
-            raise exceptions.InvalidRequestError(
-                'Invalid request syntax. Filter options were not specified')
+        filter = make_filter_opts(from_json(filter))
 
-        filter = deserialize(filter)
-        normal_view = generate_normal_view(filter)
-        validate_filter(normal_view)
+    return filter
 
+
+def has_geo_point(obj):
+    """ Checks if deserialized object contains geo point at any level """
+    if isinstance(obj, GeoPoint):
+        return True
+    if type(obj) is dict:
+        return any(has_geo_point(v) for v in obj.values())
+    if type(obj) is list:
+        return any(has_geo_point(v) for v in obj)
+    return False
+
+
+def make_filter_opts(filter):
+    """
+    Validates filter passed as json object and makes external document of it
+    """
+    if not len(filter):
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Filter options were not specified')
+
+    filter = deserialize(filter)
+    normal_view = generate_normal_view(filter)
+    validate_filter(normal_view)
     return filter
 
 
@@ -320,6 +1099,28 @@ def is_force_mode():
     return force
 
 
+def is_stream_mode():
+    stream = False
+    if request.args.get('stream', '').strip() == 'true':
+        stream = True
+    return stream
+
+
+def is_secondary_read():
+    """ Apps listed in SECONDARY_READ_APPS by operator may read from secondaries,
+        i.e. data may be a bit stale, by passing read=secondary parameter.
+        Writes always go to primary """
+    return request.args.get('read', '').strip() == 'secondary' and \
+           get_app_id() in current_app.config.get('SECONDARY_READ_APPS', [])
+
+
+def is_explain_mode():
+    explain = False
+    if request.args.get('explain', '').strip() == 'true':
+        explain = True
+    return explain
+
+
 def extract_sort_data():
     sort_data = request.args.get('sort')
     if sort_data:
@@ -350,6 +1151,85 @@ def extract_include_data():
         return None
 
 
+def extract_projection_data(sort=None, include_fields=None):
+    """
+        Extracts fields to return, fields=a,b.c, or to leave out, exclude=a,b.c.
+        Fields needed to make cursor and to embed documents are added to
+        fields to return and removed from fields to leave out.
+        Returns (fields, exclude) pair
+    """
+    def extract(param):
+        value = request.args.get(param, '').strip()
+        if not value:
+            return None
+        fields = [f.strip() for f in value.split(',')]
+        validators.ProjectionKeysValidator(fields).validate()
+        return fields
+
+    fields, exclude = extract('fields'), extract('exclude')
+    if fields is not None and exclude is not None:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Only one of fields and exclude parameters can be passed.')
+    required = [field for field, order in sort or []]
+    required += [field.partition('.')[0] for field in include_fields or []]
+    if fields is not None:
+        fields += required
+    if exclude is not None:
+        # neither required field nor its parts or parents can be left out
+        overlaps = lambda a, b: a == b or a.startswith(b + '.') or b.startswith(a + '.')
+        exclude = [field for field in exclude
+                   if not any(overlaps(field, r) for r in required)] or None
+    return fields, exclude
+
+
+def extract_cursor_data(sort):
+    """
+        Extracts cursor returned with the previous page.
+        Returns (value, key) pair of the last document of that page
+    """
+    token = request.args.get(CURSOR, '').strip()
+    if not token:
+        return None
+    try:
+        field, order, value, key = json.loads(base64.urlsafe_b64decode(str(token)))
+    except Exception:
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Parameter cursor has invalid value.')
+    if not sort or sort[0] != (field, order):
+        raise exceptions.InvalidRequestError(
+            'Invalid request syntax. Parameter cursor does not match sort parameter.')
+
+    value = deserialize({'value': value})['value']
+    return value, key
+
+
+def make_cursor(document, sort):
+    """
+        Makes opaque cursor pointing to the document, next page starts right
+        after it. Returns None if value of sort field can't be put in cursor
+    """
+    field, order = sort[0]
+    value = document
+    for k in field.split('.'):
+        value = value.get(k) if isinstance(value, dict) else None
+    if isinstance(document, WireDocument):
+        # values are serialized already, reserved dates are plain iso strings
+        if k in reservedf.values() and isinstance(value, basestring):
+            value = {TYPE_FIELD: type_codes.DATE, 'iso': value}
+        elif isinstance(value, dict) and value.get(TYPE_FIELD) == type_codes.DATE:
+            pass
+        elif isinstance(value, (dict, list)):
+            return None
+    else:
+        if isinstance(value, (dict, list, BaseType)):
+            return None
+        caster = serialisator(value)
+        if caster:
+            value = caster.serialize(None, value)
+    return base64.urlsafe_b64encode(
+        json.dumps([field, order, value, document[extf.KEY]]))
+
+
 def extract_pagination_data():
     """
         Extracts pagination data
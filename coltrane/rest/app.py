@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from coltrane.rest import ERROR_INFO_MATCHING, http_status, app_status as app_status
 from coltrane.rest.utils import resp_msgs
-from coltrane.rest.utils import jsonify
+from coltrane.rest.utils import jsonify, configure_json
 
 __author__ = 'apetrovich'
 
@@ -13,6 +13,8 @@ from coltrane.rest.config import DefaultConfig
 from coltrane.rest.lib.guard_manager import GuardManager
 from coltrane.rest.extensions import mongodb
 from coltrane.rest.extensions import guard
+from coltrane.rest.extensions import compression
+from coltrane.rest.extensions import purge
 from coltrane.db.extension import db
 from coltrane.rest.api import api_v1, converters
 
@@ -26,7 +28,7 @@ DEFAULT_MODULES = (
     (api_v1, '/v1'),
 )
 
-DEFAULT_EXTENSIONS = (guard, mongodb, db)
+DEFAULT_EXTENSIONS = (guard, mongodb, db, compression, purge)
 
 
 def create_app(exts = None, modules=None, config=None, dict_config=None):
@@ -60,6 +62,8 @@ def configure_app(app, config, dict_config=None):
     if dict_config is not None:
         app.config.update(**dict_config)
 
+    configure_json(app.config['JSON_ENCODERS'])
+
 
 def configure_modules(app, modules):
     for module, url_prefix in modules:
@@ -90,6 +94,11 @@ def configure_logging(app):
     debug_file_handler.setFormatter(formatter)
     app.logger.addHandler(debug_file_handler)
 
+    # retry counters are reported periodically with info level
+    retry_logger = logging.getLogger('coltrane.appstorage.retry')
+    retry_logger.setLevel(logging.INFO)
+    retry_logger.addHandler(debug_file_handler)
+
     error_log = app.config['ERROR_LOG']
     error_file_handler =  RotatingFileHandler(error_log, maxBytes=100000,
                                               backupCount=10)
@@ -97,6 +106,13 @@ def configure_logging(app):
     error_file_handler.setFormatter(formatter)
     app.logger.addHandler(error_file_handler)
 
+    slow_query_log = app.config['SLOW_QUERY_LOG']
+    slow_query_handler = RotatingFileHandler(slow_query_log, maxBytes=100000,
+                                             backupCount=10)
+    slow_query_handler.setLevel(logging.WARNING)
+    slow_query_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logging.getLogger('coltrane.appstorage.slow').addHandler(slow_query_handler)
+
 
 def configure_errorhandlers(app):
     @app.errorhandler(Exception)
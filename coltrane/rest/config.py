@@ -8,6 +8,27 @@ from coltrane import config
 class DefaultConfig(object):
     DEFAULT_QUERY_LIMIT = 100
     MAX_QUERY_LIMIT = 1000
+    MAX_BULK_SIZE = 1000
+    STREAM_BATCH_SIZE = 100
+    IMPORT_BATCH_SIZE = 500
+    MAX_IMPORT_ERRORS = 100
+    # every line of imported body is held in memory at once
+    MAX_IMPORT_LINE_SIZE = 1024 * 1024
+    MAX_APP_INDEXES = 10
+    # geo indexes of all apps, db 2.0 uses only one 2d index of collection
+    MAX_GEO_INDEXES = 1
+    # indexes of all apps, db keeps no more than 64 indexes of collection
+    MAX_DECLARED_INDEXES = 50
+    MAX_INDEX_FIELDS = 5
+    SLOW_QUERY_THRESHOLD = 0.5
+    AUTH_CACHE_TTL     = 30
+    # json modules in order of preference, the first importable one is used
+    JSON_ENCODERS      = ('simplejson', 'json')
+    COMPRESSION_MIN_SIZE  = 500
+    COMPRESSION_LEVEL     = 6
+    # bytes, limit of gzip or deflate compressed request body once decompressed
+    MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+    AUTH_CACHE_SIZE    = 10000
     LOGGER_NAME        ='coltrane.rest'
     SQLALCHEMY_DATABASE_URI = config.MYSQL_URI
     MONGODB_HOST       ='127.0.0.1'
@@ -16,15 +37,61 @@ class DefaultConfig(object):
     MONGODB_SLAVE_OKAY = False
     MONGODB_USERNAME   = None
     MONGODB_PASSWORD   = None
+    MONGODB_MAX_POOL_SIZE   = 10
+    MONGODB_NETWORK_TIMEOUT = None
+    MONGODB_WRITE_CONCERN   = {}
+    MONGODB_SECONDARIES     = []
+    # ids of apps whose read=secondary requests are served by secondaries
+    SECONDARY_READ_APPS     = []
+    # retries of operations interrupted by failover, budget is in seconds
+    # and must be well under uWSGI harakiri
+    MONGODB_RETRY_ATTEMPTS  = 5
+    MONGODB_RETRY_BUDGET    = 5.0
+    # seconds between log lines with retry counters
+    MONGODB_RETRY_REPORT_INTERVAL = 60.0
     APPDATA_COLLECTION ='appdata'
+    INDEXES_COLLECTION ='appindexes'
+    # bucket or (app_id, bucket): seconds, documents created without
+    # _expires_at expire in that many seconds
+    BUCKET_TTLS        = {}
+    # seconds, soft-deleted documents are removed for good after retention
+    PURGE_RETENTION     = 30 * 24 * 3600
+    PURGE_APP_RETENTION = {}
+    PURGE_BATCH_SIZE    = 500
+    PURGE_BATCH_PAUSE   = 0.1
+    # seconds between purges run by REST processes, None leaves it to cron
+    PURGE_INTERVAL      = None
+    PURGE_COLLECTION    = 'appdatapurge'
     DEBUG_LOG          = '/web/rest/debug.log'
     ERROR_LOG          = '/web/rest/error.log'
+    SLOW_QUERY_LOG     = '/web/rest/slow.log'
 
 class TestConfig(object):
     TESTING            = True
     SQLALCHEMY_DATABASE_URI = config.MYSQL_TEST_URI
     DEFAULT_QUERY_LIMIT = 100
     MAX_QUERY_LIMIT = 1000
+    MAX_BULK_SIZE = 1000
+    STREAM_BATCH_SIZE = 100
+    IMPORT_BATCH_SIZE = 500
+    MAX_IMPORT_ERRORS = 100
+    # every line of imported body is held in memory at once
+    MAX_IMPORT_LINE_SIZE = 1024 * 1024
+    MAX_APP_INDEXES = 10
+    # geo indexes of all apps, db 2.0 uses only one 2d index of collection
+    MAX_GEO_INDEXES = 1
+    # indexes of all apps, db keeps no more than 64 indexes of collection
+    MAX_DECLARED_INDEXES = 50
+    MAX_INDEX_FIELDS = 5
+    SLOW_QUERY_THRESHOLD = 0.5
+    AUTH_CACHE_TTL     = 30
+    # json modules in order of preference, the first importable one is used
+    JSON_ENCODERS      = ('simplejson', 'json')
+    COMPRESSION_MIN_SIZE  = 500
+    COMPRESSION_LEVEL     = 6
+    # bytes, limit of gzip or deflate compressed request body once decompressed
+    MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+    AUTH_CACHE_SIZE    = 10000
     LOGGER_NAME        ='coltrane.rest'
     MONGODB_HOST       ='127.0.0.1'
     MONGODB_PORT       = 27017
@@ -32,7 +99,31 @@ class TestConfig(object):
     MONGODB_SLAVE_OKAY = False
     MONGODB_USERNAME   = None
     MONGODB_PASSWORD   = None
+    MONGODB_MAX_POOL_SIZE   = 10
+    MONGODB_NETWORK_TIMEOUT = None
+    MONGODB_WRITE_CONCERN   = {}
+    MONGODB_SECONDARIES     = []
+    # ids of apps whose read=secondary requests are served by secondaries
+    SECONDARY_READ_APPS     = []
+    # retries of operations interrupted by failover, budget is in seconds
+    # and must be well under uWSGI harakiri
+    MONGODB_RETRY_ATTEMPTS  = 5
+    MONGODB_RETRY_BUDGET    = 5.0
+    # seconds between log lines with retry counters
+    MONGODB_RETRY_REPORT_INTERVAL = 60.0
     APPDATA_COLLECTION ='appdata'
+    INDEXES_COLLECTION ='appindexes'
+    # bucket or (app_id, bucket): seconds, documents created without
+    # _expires_at expire in that many seconds
+    BUCKET_TTLS        = {}
+    # seconds, soft-deleted documents are removed for good after retention
+    PURGE_RETENTION     = 30 * 24 * 3600
+    PURGE_APP_RETENTION = {}
+    PURGE_BATCH_SIZE    = 500
+    PURGE_BATCH_PAUSE   = 0.1
+    # seconds between purges run by REST processes, None leaves it to cron
+    PURGE_INTERVAL      = None
+    PURGE_COLLECTION    = 'appdatapurge'
 
 
 class DebugConfig(TestConfig):
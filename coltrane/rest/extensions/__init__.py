@@ -2,6 +2,10 @@ __author__ = 'apetrovich'
 
 from .guard import Guard
 from .mongodb import FlaskMongodb
+from .compression import Compression
+from .purge import Purge
 
 guard = Guard()
-mongodb = FlaskMongodb()
\ No newline at end of file
+mongodb = FlaskMongodb()
+compression = Compression()
+purge = Purge()
@@ -0,0 +1,105 @@
+import zlib
+from flask import current_app, request
+
+# wbits of zlib giving gzip and zlib (HTTP deflate) format
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class Compression(object):
+    """
+        Compresses responses by gzip or deflate, whichever client accepts.
+        Responses smaller than COMPRESSION_MIN_SIZE are sent as is,
+        streamed responses are compressed chunk by chunk.
+    """
+
+    _default_config = {
+        # bytes, smaller responses aren't worth compressing
+        'COMPRESSION_MIN_SIZE':  500,
+        # 1 is the fastest, 9 gives the smallest output
+        'COMPRESSION_LEVEL':     6,
+        'COMPRESSION_MIMETYPES': ['application/json', 'application/x-ndjson'],
+    }
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        for k, v in self._default_config.items():
+            app.config.setdefault(k, v)
+
+        self.app = app
+        self.app.after_request(self._after_request)
+
+    def _after_request(self, response):
+        config = current_app.config
+        if response.mimetype not in config['COMPRESSION_MIMETYPES']:
+            return response
+        response.headers.add('Vary', 'Accept-Encoding')
+
+        if not 200 <= response.status_code < 300 or response.status_code == 204 \
+           or 'Content-Encoding' in response.headers:
+            return response
+        encoding = request.accept_encodings.best_match(WBITS.keys())
+        if encoding is None or not request.accept_encodings[encoding]:
+            return response
+
+        level = config['COMPRESSION_LEVEL']
+        if response.is_streamed:
+            # iter_encoded can't be used, it reads response.response lazily
+            charset = response.charset
+            chunks = (chunk.encode(charset) if isinstance(chunk, unicode) else chunk
+                      for chunk in response.response)
+            response.response = compress_stream(chunks, encoding, level)
+            del response.headers['Content-Length']
+        else:
+            data = response.data
+            if len(data) < config['COMPRESSION_MIN_SIZE']:
+                return response
+            response.data = compress(data, encoding, level)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+def compress(data, encoding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    """ Compressor keeps small chunks until it has enough data,
+        so chunks of compressed stream are not sent too often """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def decompress(data, encoding, max_size):
+    """
+        Decompresses request body compressed by gzip or deflate.
+        Returns None if decompressed body is greater than max_size
+    """
+    decompressor = zlib.decompressobj(WBITS[encoding])
+    decompressed = decompressor.decompress(data, max_size + 1)
+    if len(decompressed) > max_size:
+        return None
+    return decompressed + decompressor.flush()
+
+
+def decompress_stream(chunks, encoding, chunk_size=65536):
+    """ Decompressed chunks are no greater than chunk_size
+        however well the data was compressed """
+    decompressor = zlib.decompressobj(WBITS[encoding])
+    for chunk in chunks:
+        while chunk:
+            decompressed = decompressor.decompress(chunk, chunk_size)
+            if decompressed:
+                yield decompressed
+            chunk = decompressor.unconsumed_tail
+    yield decompressor.flush()
@@ -25,6 +25,8 @@ class Guard(object):
 
 
     def init_manager(self):
+        if hasattr(self.manager, 'init_app'):
+            self.manager.init_app(self.app)
         if hasattr(self.manager, 'get_auth_token'):
             self.get_auth_token = self.manager.get_auth_token
             self.get_app_token  = self.manager.get_app_token
@@ -2,6 +2,7 @@ __author__ = 'qweqwe'
 
 from pymongo import Connection
 from pymongo.database import Database
+from pymongo.master_slave_connection import MasterSlaveConnection
 
 class FlaskMongodb(object):
 
@@ -11,7 +12,14 @@ class FlaskMongodb(object):
         'MONGODB_DATABASE':  'test_db',
         'MONGODB_SLAVE_OKAY': False,
         'MONGODB_USERNAME':   None,
-        'MONGODB_PASSWORD':   None
+        'MONGODB_PASSWORD':   None,
+        'MONGODB_MAX_POOL_SIZE':   10,
+        # seconds, used for connecting too, pymongo waits 20s if it is None
+        'MONGODB_NETWORK_TIMEOUT': None,
+        # getLastError options of writes: w, wtimeout, j, fsync
+        'MONGODB_WRITE_CONCERN':   {},
+        # 'host:port' of secondaries serving reads allowed to be stale
+        'MONGODB_SECONDARIES':     []
     }
 
     def __init__(self, app=None):
@@ -34,35 +42,80 @@ class FlaskMongodb(object):
 
         self.app.mongodb_connection, \
         self.app.mongodb_database = self.init_connection()
+        self.app.mongodb_secondary_connection = self.init_secondary_connection()
 
 
     def _teardown_request(self, request):
         self.app.mongodb_connection.end_request()
+        if self.app.mongodb_secondary_connection is not None:
+            self.app.mongodb_secondary_connection.end_request()
         return request
 
 
-    def init_connection(self):
+    def _get_config(self):
         if hasattr(self, 'app'):
-            config = self.app.config
+            return self.app.config
         else:
-            config = self._default_config
+            return self._default_config
+
+
+    def _connect(self, host, port=None, slave_okay=False):
+        config = self._get_config()
+        options = dict(config.get('MONGODB_WRITE_CONCERN') or {})
+        return Connection(
+            host=host,
+            port=port,
+            max_pool_size=config.get('MONGODB_MAX_POOL_SIZE'),
+            network_timeout=config.get('MONGODB_NETWORK_TIMEOUT'),
+            slave_okay=slave_okay,
+            **options
+        )
+
+
+    def init_connection(self):
+        config = self._get_config()
 
-        connection = Connection(
+        connection = self._connect(
             host=config.get('MONGODB_HOST'),
             port=config.get('MONGODB_PORT'),
             slave_okay=config.get('MONGODB_SLAVE_OKAY')
         )
 
         database = Database(connection, config.get('MONGODB_DATABASE'))
+        self._authenticate(database)
+
+        return connection, database
+
+
+    def init_secondary_connection(self):
+        """ Connection used for reads which may go to secondaries.
+            Returns None if there are no secondaries configured,
+            MasterSlaveConnection picks random one for every query
+        """
+        config = self._get_config()
+        secondaries = config.get('MONGODB_SECONDARIES')
+        if not secondaries:
+            return None
 
+        slaves = []
+        for host in secondaries:
+            slave = self._connect(host, slave_okay=True)
+            self._authenticate(Database(slave, config.get('MONGODB_DATABASE')))
+            slaves.append(slave)
+
+        if len(slaves) == 1:
+            return slaves[0]
+        return MasterSlaveConnection(self.app.mongodb_connection, slaves)
+
+
+    def _authenticate(self, database):
+        config = self._get_config()
         if config.get('MONGODB_USERNAME') is not None:
             database.authenticate(
                 config.get('MONGODB_USERNAME'),
                 config.get('MONGODB_PASSWORD')
             )
 
-        return connection, database
-
 
     @property
     def connection(self):
@@ -71,3 +124,12 @@ class FlaskMongodb(object):
         else:
             connection, _ = self.init_connection()
             return connection
+
+
+    @property
+    def secondary_connection(self):
+        """ Connection for reads from secondaries,
+            primary one if there are no secondaries """
+        if hasattr(self, 'app') and self.app.mongodb_secondary_connection is not None:
+            return self.app.mongodb_secondary_connection
+        return self.connection
@@ -0,0 +1,65 @@
+import os
+from threading import Lock
+from coltrane.appstorage.purge import Purger, PurgeScheduler
+from coltrane.appstorage.retry import RetryPolicy
+
+
+class Purge(object):
+    """
+        Runs purge of soft-deleted documents in background thread
+        if PURGE_INTERVAL is set. Thread is started by the first request
+        of every process, threads don't survive fork of uWSGI workers.
+        Otherwise purge is run by cron, see coltrane.rest.purge
+    """
+
+    _default_config = {
+        # seconds, documents deleted earlier are removed for good
+        'PURGE_RETENTION':     30 * 24 * 3600,
+        # app_id: seconds, retention of apps differing from default one
+        'PURGE_APP_RETENTION': {},
+        'PURGE_BATCH_SIZE':    500,
+        # seconds between batches
+        'PURGE_BATCH_PAUSE':   0.1,
+        # seconds between runs of in-process scheduler, None disables it
+        'PURGE_INTERVAL':      None,
+        'PURGE_COLLECTION':    'appdatapurge',
+    }
+
+    def __init__(self, app=None):
+        self.scheduler = None
+        self._pid = None
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        for k, v in self._default_config.items():
+            app.config.setdefault(k, v)
+
+        self.app = app
+        if app.config['PURGE_INTERVAL']:
+            self.app.before_request(self._start_scheduler)
+
+    def _start_scheduler(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            purger = make_purger(self.app.config, self.app.mongodb_database)
+            self.scheduler = PurgeScheduler(purger, self.app.config['PURGE_INTERVAL'])
+            self.scheduler.start()
+            self._pid = os.getpid()
+
+
+def make_purger(config, database):
+    """ Purger of appdata collection of the database set up by config """
+    return Purger(database[config['APPDATA_COLLECTION']],
+                  database[config['PURGE_COLLECTION']],
+                  retention=config['PURGE_RETENTION'],
+                  app_retention=config['PURGE_APP_RETENTION'],
+                  batch_size=config['PURGE_BATCH_SIZE'],
+                  pause=config['PURGE_BATCH_PAUSE'],
+                  retry=RetryPolicy(attempts=config.get('MONGODB_RETRY_ATTEMPTS', 5),
+                                    budget=config.get('MONGODB_RETRY_BUDGET', 5.0),
+                                    report_interval=config.get('MONGODB_RETRY_REPORT_INTERVAL', 60.0)))
@@ -1,18 +1,77 @@
 __author__ = 'qweqwe'
 
-from coltrane.db.models import User, AppToken
+from collections import namedtuple
 from hashlib import sha256
+from sqlalchemy.orm import joinedload
+from werkzeug.contrib.cache import NullCache
+from coltrane.db import authcache
+from coltrane.db.models import User, AppToken
+from coltrane.utils import TTLCache
+
+
+# immutable views of ORM instances, they are safe to share between requests
+UserSnapshot = namedtuple('UserSnapshot', 'id nickname email')
+AppSnapshot  = namedtuple('AppSnapshot', 'id name domain author_id')
+
 
 #TODO: (Someday) use HandlerSocket
 class GuardManager(object):
-    
-    def __init__(self):
-        pass
+    """
+        Authenticates users and apps by tokens. Found users and apps, as well
+        as unknown tokens, are cached for ttl seconds in the shared cache,
+        so most of requests don't touch MySQL at all. Process local cache
+        is used only if there is no shared one: invalidation doesn't reach
+        local caches of other processes and they would accept revoked
+        tokens until ttl passes.
+    """
+
+    def __init__(self, ttl=30, max_size=10000, backend=None):
+        """
+            :param backend: werkzeug cache shared by processes,
+                authcache.shared_cache is used by default
+        """
+        self.ttl = ttl
+        self.backend = backend if backend is not None else authcache.shared_cache
+        if isinstance(self.backend, NullCache):
+            self.cache = TTLCache(ttl, max_size)
+            authcache.local_caches.add(self.cache)
+        else:
+            self.cache = NullCache()
+
+    def init_app(self, app):
+        self.ttl = app.config.get('AUTH_CACHE_TTL', self.ttl)
+        if isinstance(self.cache, TTLCache):
+            self.cache.ttl = self.ttl
+            self.cache.max_size = app.config.get('AUTH_CACHE_SIZE', self.cache.max_size)
 
     def authenticate_user(self, token):
-        return User.query.filter(User.auth_hash == sha256(token).hexdigest()).first()
+        auth_hash = sha256(token).hexdigest()
+        return self._cached(authcache.user_key(auth_hash),
+                            lambda: self._load_user(auth_hash))
 
     def authenticate_app(self, token):
-        token = AppToken.query.filter(AppToken.token == token).first()
+        return self._cached(authcache.app_key(token),
+                            lambda: self._load_app(token))
+
+    def _cached(self, key, load):
+        # unknown tokens are cached as False, None means cache miss
+        value = self.cache.get(key)
+        if value is None:
+            value = self.backend.get(key)
+            if value is None:
+                value = load() or False
+                self.backend.set(key, value, timeout=self.ttl)
+            self.cache.set(key, value)
+        return value or None
+
+    def _load_user(self, auth_hash):
+        user = User.query.filter(User.auth_hash == auth_hash).first()
+        if user:
+            return UserSnapshot(user.id, user.nickname, user.email)
+
+    def _load_app(self, token):
+        token = AppToken.query.options(joinedload('application'))\
+                              .filter(AppToken.token == token).first()
         if token:
-            return token.application
\ No newline at end of file
+            app = token.application
+            return AppSnapshot(app.id, app.name, app.domain, app.author_id)
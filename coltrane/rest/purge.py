@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+    Removes soft-deleted documents for good, run it by cron:
+    python -m coltrane.rest.purge --retention 604800 --app 42:86400
+    Settings not given in command line are taken from config.
+"""
+
+import argparse
+import logging
+import sys
+from flask import Flask
+from coltrane.rest.app import configure_app
+from coltrane.rest.config import DebugConfig
+from coltrane.rest.extensions import mongodb
+from coltrane.rest.extensions.purge import make_purger
+
+
+def app_retention(value):
+    app_id, _, seconds = value.rpartition(':')
+    if not app_id:
+        raise argparse.ArgumentTypeError('APP_ID:SECONDS expected, got %s' % value)
+    return app_id, int(seconds)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Purge soft-deleted documents')
+    parser.add_argument('--retention', type=int, metavar='SECONDS',
+                        help='remove documents deleted earlier')
+    parser.add_argument('--app', type=app_retention, action='append',
+                        metavar='APP_ID:SECONDS', default=[],
+                        help='retention of the app, may be repeated')
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--pause', type=float, metavar='SECONDS',
+                        help='pause between batches')
+    parser.add_argument('--debug', action='store_true',
+                        help='use debug config')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    app = Flask(__name__)
+    configure_app(app, DebugConfig if args.debug else None)
+    mongodb.init_app(app)
+
+    config = app.config
+    if args.retention is not None:
+        config['PURGE_RETENTION'] = args.retention
+    if args.app:
+        retention = dict(config['PURGE_APP_RETENTION'])
+        retention.update(args.app)
+        config['PURGE_APP_RETENTION'] = retention
+    if args.batch_size is not None:
+        config['PURGE_BATCH_SIZE'] = args.batch_size
+    if args.pause is not None:
+        config['PURGE_BATCH_PAUSE'] = args.pause
+
+    result = make_purger(config, app.mongodb_database).run()
+    if result is None:
+        print 'Purge is already running'
+        return 1
+    print 'removed %(removed)d deleted and %(expired)d expired documents, ' \
+          '%(bytes)d bytes in %(batches)d batches, %(seconds).3fs' % result
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
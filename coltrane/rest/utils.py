@@ -4,11 +4,12 @@
               - pasha
 """
 
-from coltrane.appstorage.storage import intf
+from coltrane.appstorage.indexes import IndexManager, DECLARATION_APP_ID
 from coltrane.rest.extensions import mongodb
 from coltrane.utils import Enum
 
 import re
+from pymongo import ASCENDING
 from flask import current_app, request
 from functools import wraps
 import json
@@ -22,6 +23,11 @@ class resp_msgs(Enum):
     DOC_DELETED = "Document has been deleted"
     DOC_UPDATED = "Document has been updated"
     INTERNAL_ERROR  = "Internal server error"
+    NOT_FOUND       = "Resource doesn't exist"
+    INDEX_CREATED   = "Index has been created"
+    INDEX_EXISTS    = "Index already exists"
+    INDEX_DELETED   = "Index has been deleted"
+    INDEX_NOT_EXISTS = "Index doesn't exist"
 
 
 class lazy_coll(object):
@@ -29,46 +35,138 @@ class lazy_coll(object):
         This class is used to initialize mongodb collection lazily.
         I.e. it will use mongodb collection object only when Flask
         application was initialized.
+        Subclasses set config option holding name of their collection.
     """
+    collection_option = 'APPDATA_COLLECTION'
+
     class __metaclass__(type):
-        coll = None
         @property
         def entities(self):
-            if self.coll:
-                return self.coll
+            # every subclass keeps its own collection
+            coll = self.__dict__.get('coll')
+            if coll:
+                return coll
             else:
                 conf = current_app.config
                 db   = conf['MONGODB_DATABASE']
-                coll = conf['APPDATA_COLLECTION']
-                self.coll = mongodb.connection[db][coll]
+                coll = conf[self.collection_option]
+                self.coll = self.get_connection()[db][coll]
 
-                self.coll.ensure_index(intf.HASHID)
+                self.init_collection(self.coll)
                 return self.coll
         def __getattr__(self, name):
             return getattr(self.entities, name)
 
+    @staticmethod
+    def get_connection():
+        return mongodb.connection
+
+    @staticmethod
+    def init_collection(coll):
+        IndexManager(coll).ensure_default_indexes()
+
+
+class lazy_secondary_coll(lazy_coll):
+    """ Appdata collection for reads which may go to secondaries """
+
+    @staticmethod
+    def get_connection():
+        return mongodb.secondary_connection
+
+    @staticmethod
+    def init_collection(coll):
+        # indexes are created through primary
+        pass
+
+
+class lazy_indexes_coll(lazy_coll):
+    """ Collection of indexes declared by applications """
+    collection_option = 'INDEXES_COLLECTION'
+
+    @staticmethod
+    def init_collection(coll):
+        IndexManager(coll).ensure_index([(DECLARATION_APP_ID, ASCENDING)])
+
+
+DT_HANDLER = lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else None
+
+
+def dumps_encoder(module):
+    """ Encoder of json module compatible with stdlib json """
+    def encode(obj, pretty=False):
+        if pretty:
+            return module.dumps(obj, indent=2, default=DT_HANDLER)
+        return module.dumps(obj, separators=(',', ':'), default=DT_HANDLER)
+    return encode
+
+
+def ujson_encoder(module):
+    """ ujson has no default hook, responses made by @serialize
+        have no datetimes left, others should not contain them """
+    def encode(obj, pretty=False):
+        return module.dumps(obj, indent=2 if pretty else 0)
+    return encode
+
+
+# makers of encoders by name of json module
+JSON_ENCODERS = {
+    'simplejson': dumps_encoder,
+    'ujson': ujson_encoder,
+    'json': dumps_encoder,
+}
+
+
+def select_json_encoder(names):
+    """ Returns encoder of the first json module of names which can be imported.
+        Encoder is a function (obj, pretty=False) returning json string """
+    for name in names:
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        return JSON_ENCODERS[name](module)
+    raise RuntimeError('None of json modules %s can be imported' % ', '.join(names))
+
+
+json_encoder = select_json_encoder(('simplejson', 'json'))
+
+
+def configure_json(names):
+    """ Selects json encoder used by jsonify and to_json """
+    global json_encoder
+    json_encoder = select_json_encoder(names)
+
+
+def to_json(obj, pretty=False):
+    return json_encoder(obj, pretty)
+
+
+def is_pretty_mode():
+    return request.args.get('pretty', '').strip() == 'true'
+
+
 def jsonify(f):
     """ Used to decorate Flask route handlers,
-        it will return json with proper mime-type
+        it will return json with proper mime-type.
+        Json is compact unless pretty=true parameter is passed.
+        Handler may return (body, code, headers) to add response headers
     """
 
-    DT_HANDLER = lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else None
-
-    def to_json(dict):
-        return json.dumps(dict, indent=None if request.is_xhr else 2,
-            default=DT_HANDLER)
-
     @wraps(f)
     def wrapper(*args, **kwargs):
         resp = f(*args, **kwargs)
-        try:
-            body, code = resp
-        except (TypeError, ValueError) as e:
-            body = resp
-            code = 200
+        headers = None
+        if isinstance(resp, tuple) and len(resp) == 3:
+            body, code, headers = resp
+        else:
+            try:
+                body, code = resp
+            except (TypeError, ValueError) as e:
+                body = resp
+                code = 200
         if not isinstance(body, current_app.response_class):
-            return current_app.response_class(to_json(body),
-                mimetype='application/json', status=code)
+            return current_app.response_class(to_json(body, is_pretty_mode()),
+                mimetype='application/json', status=code, headers=headers)
         else:
             return body
 
@@ -201,6 +201,20 @@ class FilterKeysValidator(KeyValidator):
         super(FilterKeysValidator, self).validate(recursive)
 
 
+class ProjectionKeysValidator(KeyValidator):
+    """
+        Validator for list of fields to return or to leave out.
+        It allows symbol '.' for fields of embedded documents:
+            fields = ['title', 'author.name']
+    """
+    #Allowed: _a-b.c_
+    # Forbidden: __a, b__, -c, $d
+    key_re = re.compile(r'^(?!__)\w[\w\.-]*(?<!__)$')
+
+    def __init__(self, fields):
+        super(ProjectionKeysValidator, self).__init__(fields)
+
+
 class UpdateDocumentKeysValidator(KeyValidator):
     """
         Document validator to update underlying document.
@@ -3,6 +3,7 @@ import json
 import unittest
 import datetime
 import time
+import zlib
 from bson.binary import Binary
 from bson.dbref import DBRef
 from pymongo import GEO2D
@@ -11,11 +12,12 @@ from coltrane.appstorage import reservedf, forbidden_fields
 from coltrane.appstorage.datatypes import Pointer, Blob, GeoPoint
 from coltrane.rest.api import api_v1
 from coltrane.rest.api import v1
+from coltrane.rest.api import datatypes
 from coltrane.rest.api.datatypes import type_codes, TYPE_FIELD
 from coltrane.rest.utils import resp_msgs
-from coltrane.rest.api.v1 import from_json, storage, RESULTS
+from coltrane.rest.api.v1 import from_json, storage, RESULTS, CURSOR
 from coltrane.rest.app import create_app
-from coltrane.rest.extensions import mongodb
+from coltrane.rest.extensions import mongodb, compression
 from coltrane.rest.config import TestConfig
 from coltrane.rest import STATUS_CODE, app_status, http_status
 from coltrane.appstorage.storage import extf, intf
@@ -63,6 +65,16 @@ class ApiTestCase(ApiBaseTestClass):
         res = from_json(rv.data)
         assert res['message'] == u'Invalid json object ""all""'
 
+    def test_compact_and_pretty_json(self):
+        self.app.post(API_V1 + '/books/1',
+            data=json.dumps({'a': [1, 2], 'b': {'c': 'd'}}),
+            follow_redirects=True)
+        compact = self.app.get(API_V1 + '/books/1').data
+        pretty = self.app.get(API_V1 + '/books/1?pretty=true').data
+        assert '\n' not in compact and ', ' not in compact
+        assert '\n' in pretty
+        assert from_json(compact) == from_json(pretty)
+
 
     def test_get_all_request(self):
         rv = self.app.get(API_V1 + '/books')
@@ -91,6 +103,18 @@ class ApiTestCase(ApiBaseTestClass):
         assert from_json(rv.data)[extf.KEY] == 'key_4'
 
         rv = self.app.get(API_V1 + '/books/key_1, key_2, key_3')
+        assert rv.status_code == http_status.OK
+        res = from_json(rv.data)[RESULTS]
+        assert [r[extf.KEY] for r in res] == ['key_1', 'key_2', 'key_3']
+        assert res[0]['title'] == 'Title3' and res[1]['title'] == 'Title2'
+        assert res[2] == {extf.KEY: 'key_3', STATUS_CODE: app_status.NOT_FOUND,
+                          'message': resp_msgs.DOC_NOT_EXISTS}
+
+        rv = self.app.get(API_V1 + '/books/key_4,key_1')
+        res = from_json(rv.data)[RESULTS]
+        assert [r[extf.KEY] for r in res] == ['key_4', 'key_1']
+
+        rv = self.app.get(API_V1 + '/books/key_3,key_5')
         assert rv.status_code == http_status.NOT_FOUND
 
 
@@ -1336,6 +1360,22 @@ class CustomDataTypesCase(ApiBaseTestClass):
         for r in res:
             assert r['b'] == 10
 
+    def test_wire_view(self):
+        dt = datetime.datetime.utcnow().isoformat()
+        self.app.post(API_V1 + '/books/1',
+            data=json.dumps({'a': 1, 'b': {'c': [1, {TYPE_FIELD: type_codes.DATE, 'iso': dt}]},
+                             'p': {TYPE_FIELD: type_codes.POINTER, '_bucket': 'books', '_key': '2'},
+                             'g': {TYPE_FIELD: type_codes.GEO_POINT, 'latitude': 10, 'longitude': 20},
+                             'blob': {TYPE_FIELD: type_codes.BLOB, 'base64': base64.encodestring('abc')}}),
+            follow_redirects=True
+        )
+        external = storage.get(v1.get_app_id(), v1.get_user_id(), 'books', '1')
+        wire = storage.get(v1.get_app_id(), v1.get_user_id(), 'books', '1',
+                           view=datatypes.wire_document)
+        assert wire == datatypes.serialize_document(external)
+        res = from_json(self.app.get(API_V1 + '/books/1').data)
+        assert res == json.loads(json.dumps(wire))
+
 
 class FetchWithCountCase(ApiBaseTestClass):
 
@@ -1564,6 +1604,32 @@ class FetchEmbedDocsCase(ApiBaseTestClass):
             assert res['book2'][k] == v
             assert res['books'][2][k] == v
 
+    def test_nested_fetch_embed(self):
+        company = {TYPE_FIELD: type_codes.POINTER, Pointer.BUCKET: 'companies', Pointer.KEY: 'c1'}
+        self.app.post(API_V1 + '/companies/c1', data=json.dumps({'title': 'ACME'}))
+        for key in ('a1', 'a2'):
+            self.app.post(API_V1 + '/authors/' + key,
+                data=json.dumps({'name': key, 'company': company}))
+        for i, key in enumerate(('a1', 'a2', 'a1', 'a3')):
+            author = {TYPE_FIELD: type_codes.POINTER, Pointer.BUCKET: 'authors', Pointer.KEY: key}
+            self.app.post(API_V1 + '/books/%d' % i,
+                data=json.dumps({'n': i, 'author': author}))
+
+        res = self.app.get(API_V1 + '/books?sort=n&include=author.company')
+        res = from_json(res.data)[RESULTS]
+        assert len(res) == 4
+        for book, name in zip(res[:3], ('a1', 'a2', 'a1')):
+            assert book['author'][TYPE_FIELD] == 'Object'
+            assert book['author']['name'] == name
+            assert book['author']['company'][TYPE_FIELD] == 'Object'
+            assert book['author']['company']['title'] == 'ACME'
+        assert res[3]['author'] == {TYPE_FIELD: 'Object',
+                                    Pointer.BUCKET: 'authors', Pointer.KEY: 'a3'}
+
+        res = self.app.get(API_V1 + '/books?sort=n&include=author')
+        res = from_json(res.data)[RESULTS]
+        assert res[0]['author']['company'][TYPE_FIELD] == type_codes.POINTER
+
 
 class RegexFiltersCase(ApiBaseTestClass):
 
@@ -1632,6 +1698,665 @@ class RegexFiltersCase(ApiBaseTestClass):
         assert len(res) == 1
         assert res[0]['b'] == 'ABC5678'
 
-        
+
+class BulkCreateCase(ApiBaseTestClass):
+
+    def setUp(self):
+        super(BulkCreateCase, self).setUpClass()
+
+    def tearDown(self):
+        super(BulkCreateCase, self).tearDownClass()
+
+    def test_bulk_create(self):
+        docs = [{extf.KEY: '1', 'a': 1}, {'a': 2}, {extf.KEY: '3', 'a': 3}]
+        resp = self.app.post(API_V1 + '/books/_bulk', data=json.dumps(docs))
+        assert resp.status_code == http_status.OK
+        res = from_json(resp.data)[RESULTS]
+        assert len(res) == 3
+        assert res[0] == {extf.KEY: '1', STATUS_CODE: app_status.CREATED}
+        assert res[1][STATUS_CODE] == app_status.CREATED
+        assert res[2] == {extf.KEY: '3', STATUS_CODE: app_status.CREATED}
+
+        resp = self.app.get(API_V1 + '/books')
+        assert len(from_json(resp.data)[RESULTS]) == 3
+
+    def test_bulk_create_with_existing_keys(self):
+        self.app.post(API_V1 + '/books/1', data=json.dumps({'a': 1}))
+        docs = [{extf.KEY: '1', 'a': 10}, {extf.KEY: '2', 'a': 2}, {extf.KEY: '2', 'a': 20}]
+        resp = self.app.post(API_V1 + '/books/_bulk', data=json.dumps(docs))
+        res = from_json(resp.data)[RESULTS]
+        assert [r[STATUS_CODE] for r in res] ==\
+               [app_status.CONFLICT, app_status.CREATED, app_status.CONFLICT]
+        assert res[0]['message'] ==\
+               "Document with key [1] and bucket [books] already exists"
+
+        assert from_json(self.app.get(API_V1 + '/books/1').data)['a'] == 1
+        assert from_json(self.app.get(API_V1 + '/books/2').data)['a'] == 2
+
+    def test_bulk_create_over_deleted(self):
+        self.app.post(API_V1 + '/books/1', data=json.dumps({'a': 1, 'b': 1}))
+        self.app.delete(API_V1 + '/books/1')
+        docs = [{extf.KEY: '1', 'a': 10}]
+        resp = self.app.post(API_V1 + '/books/_bulk', data=json.dumps(docs))
+        res = from_json(resp.data)[RESULTS]
+        assert res == [{extf.KEY: '1', STATUS_CODE: app_status.CREATED}]
+
+        doc = from_json(self.app.get(API_V1 + '/books/1').data)
+        assert doc['a'] == 10 and 'b' not in doc
+
+    def test_bulk_create_invalid(self):
+        resp = self.app.post(API_V1 + '/books/_bulk', data=json.dumps({'a': 1}))
+        assert resp.status_code == http_status.BAD_REQUEST
+
+        resp = self.app.post(API_V1 + '/books/_bulk',
+            data=json.dumps([{'a': 1}, {reservedf.CREATED_AT: 1}]))
+        assert resp.status_code == http_status.BAD_REQUEST
+
+
+class CursorPaginationCase(ApiBaseTestClass):
+
+    @classmethod
+    def setUpClass(cls):
+        super(CursorPaginationCase, cls).setUpClass()
+
+        for i in xrange(50):
+            cls.app.post(API_V1 + '/books/%02d_key' % i,
+                data=json.dumps({'age': i % 10, 'n': i}),
+                follow_redirects=True
+            )
+
+    def fetch_all(self, query):
+        keys = []
+        rv = self.app.get(API_V1 + '/books?' + query)
+        while rv.status_code == http_status.OK:
+            res = from_json(rv.data)
+            keys.extend(doc[extf.KEY] for doc in res[RESULTS])
+            if CURSOR not in res:
+                break
+            rv = self.app.get(API_V1 + '/books?%s&cursor=%s' % (query, res[CURSOR]))
+        return keys
+
+    def test_cursor_by_key(self):
+        keys = self.fetch_all('limit=7&sort=_key')
+        assert keys == ['%02d_key' % i for i in xrange(50)]
+
+    def test_cursor_with_ties(self):
+        keys = self.fetch_all('limit=6&sort=-age')
+        assert len(keys) == len(set(keys)) == 50
+        ages = [int(k[:2]) % 10 for k in keys]
+        assert ages == sorted(ages, reverse=True)
+
+    def test_cursor_with_filter(self):
+        filter = json.dumps({'n': {'$gte': 20}})
+        keys = self.fetch_all('limit=4&sort=n&filter=%s' % filter)
+        assert keys == ['%02d_key' % i for i in xrange(20, 50)]
+
+    def test_cursor_with_missing_values(self):
+        keys = self.fetch_all('limit=7&sort=missing')
+        assert keys == ['%02d_key' % i for i in xrange(50)]
+        keys = self.fetch_all('limit=7&sort=-missing')
+        assert keys == ['%02d_key' % i for i in reversed(xrange(50))]
+
+        self.app.put(API_V1 + '/books/07_key', data=json.dumps({'rare': 1}))
+        try:
+            keys = self.fetch_all('limit=7&sort=-rare')
+            assert keys[0] == '07_key' and len(set(keys)) == 50
+        finally:
+            self.app.put(API_V1 + '/books/07_key', data=json.dumps({'$unset': {'rare': 1}}))
+
+    def test_no_cursor_without_sort(self):
+        res = from_json(self.app.get(API_V1 + '/books?limit=10').data)
+        assert CURSOR not in res
+
+    def test_cursor_not_matching_sort(self):
+        res = from_json(self.app.get(API_V1 + '/books?limit=10&sort=n').data)
+        rv = self.app.get(API_V1 + '/books?limit=10&sort=age&cursor=%s' % res[CURSOR])
+        assert rv.status_code == http_status.BAD_REQUEST
+
+        rv = self.app.get(API_V1 + '/books?limit=10&sort=n&cursor=ololo')
+        assert rv.status_code == http_status.BAD_REQUEST
+
+
+class StreamFindCase(ApiBaseTestClass):
+
+    @classmethod
+    def setUpClass(cls):
+        super(StreamFindCase, cls).setUpClass()
+        cls._app.config['STREAM_BATCH_SIZE'] = 7
+
+        for i in xrange(30):
+            cls.app.post(API_V1 + '/books/%02d_key' % i,
+                data=json.dumps({'n': i, 'd': {TYPE_FIELD: type_codes.DATE,
+                                               'iso': '2012-01-%02dT00:00:00' % (i + 1)}}),
+                follow_redirects=True
+            )
+
+    def test_stream_equals_regular_response(self):
+        query = '/books?sort=n&limit=20&count=true&filter=%s' % json.dumps({'n': {'$gte': 5}})
+        regular = from_json(self.app.get(API_V1 + query).data)
+        streamed = from_json(self.app.get(API_V1 + query + '&stream=true').data)
+        assert streamed == regular
+        assert len(streamed[RESULTS]) == streamed['count'] == 20
+        assert streamed[RESULTS][0]['d'] == {TYPE_FIELD: type_codes.DATE,
+                                             'iso': '2012-01-06T00:00:00'}
+
+    def test_stream_not_found(self):
+        rv = self.app.get(API_V1 + '/books?stream=true&filter=%s' % json.dumps({'n': 100}))
+        assert rv.status_code == http_status.NOT_FOUND
+        assert from_json(rv.data) == {'message': resp_msgs.DOC_NOT_EXISTS,
+                                      STATUS_CODE: app_status.NOT_FOUND}
+
+
+class ExportImportCase(ApiBaseTestClass):
+
+    def setUp(self):
+        super(ExportImportCase, self).setUpClass()
+        book = {TYPE_FIELD: type_codes.POINTER, Pointer.BUCKET: 'books', Pointer.KEY: '0'}
+        for i in range(10):
+            self.app.post(API_V1 + '/books/%d' % i,
+                data=json.dumps({'n': i, 'book': book}),
+                follow_redirects=True)
+        self.app.delete(API_V1 + '/books/9')
+
+    def tearDown(self):
+        super(ExportImportCase, self).tearDownClass()
+
+    def test_export_import(self):
+        rv = self.app.get(API_V1 + '/books/_export')
+        assert rv.status_code == http_status.OK
+        lines = rv.data.splitlines()
+        assert len(lines) == 9
+        docs = sorted([from_json(line) for line in lines], key=lambda d: d['n'])
+        assert docs[0][extf.KEY] == '0'
+        assert docs[0]['book'][TYPE_FIELD] == type_codes.POINTER
+
+        rv = self.app.post(API_V1 + '/shelf/_import', data=rv.data + 'ololo\n')
+        res = from_json(rv.data)
+        assert res['created'] == 9
+        assert res['failed'] == 1
+        assert res['errors'] == [{'line': 10, 'message': 'Invalid json object "ololo"'}]
+
+        res = from_json(self.app.get(API_V1 + '/shelf/3').data)
+        assert res['n'] == 3
+        assert res['book'][TYPE_FIELD] == type_codes.POINTER
+
+        rv = self.app.post(API_V1 + '/shelf/_import', data=lines[0])
+        res = from_json(rv.data)
+        assert res['created'] == 0 and res['failed'] == 1
+
+    def test_import_line_size_limit(self):
+        self._app.config['MAX_IMPORT_LINE_SIZE'] = 1024
+        try:
+            rv = self.app.post(API_V1 + '/shelf/_import',
+                data=json.dumps({'a': 'x' * 2048}) + '\n')
+            assert rv.status_code == http_status.BAD_REQUEST
+        finally:
+            self._app.config['MAX_IMPORT_LINE_SIZE'] = 1024 * 1024
+
+
+class DeclaredIndexesCase(ApiBaseTestClass):
+    def setUp(self):
+        super(DeclaredIndexesCase, self).setUpClass()
+
+    def tearDown(self):
+        super(DeclaredIndexesCase, self).tearDownClass()
+        with self._app.test_request_context():
+            v1.indexes.declarations.drop()
+            v1.indexes.indexes.known = None
+
+    def test_declare_index(self):
+        resp = self.app.post(API_V1 + '/.indexes/books',
+            data=json.dumps({'fields': ['price', '-_key']}))
+        assert resp.status_code == http_status.CREATED
+
+        with self._app.test_request_context():
+            keys = [info['key'] for info in storage.entities.index_information().values()]
+        assert [(intf.HASHID, 1), ('price', 1), ('_id', -1)] in keys
+
+        resp = self.app.post(API_V1 + '/.indexes/books',
+            data=json.dumps({'fields': ['price', '-_key']}))
+        assert resp.status_code == http_status.OK
+
+        resp = from_json(self.app.get(API_V1 + '/.indexes/books').data)
+        assert len(resp[RESULTS]) == 1
+        assert resp[RESULTS][0]['fields'] == ['price', '-_key']
+        assert resp[RESULTS][0]['bucket'] == 'books'
+
+    def test_declare_invalid_index(self):
+        for fields in [[], ['__hashid__'], ['$where'], ['a', 'a'], 'a']:
+            resp = self.app.post(API_V1 + '/.indexes/books',
+                data=json.dumps({'fields': fields}))
+            assert resp.status_code == http_status.BAD_REQUEST
+
+    def test_indexes_quota(self):
+        self._app.config['MAX_APP_INDEXES'] = 2
+        try:
+            for field in ['a', 'b']:
+                resp = self.app.post(API_V1 + '/.indexes/books',
+                    data=json.dumps({'fields': [field]}))
+                assert resp.status_code == http_status.CREATED
+
+            resp = self.app.post(API_V1 + '/.indexes/cars',
+                data=json.dumps({'fields': ['c']}))
+            assert resp.status_code == http_status.FORBIDDEN
+            assert from_json(resp.data)[STATUS_CODE] == app_status.QUOTA_EXCEEDED
+        finally:
+            self._app.config['MAX_APP_INDEXES'] = 10
+
+        resp = from_json(self.app.get(API_V1 + '/.indexes').data)
+        assert len(resp[RESULTS]) == 2
+
+    def test_all_indexes_limit(self):
+        self._app.config['MAX_DECLARED_INDEXES'] = 1
+        try:
+            resp = self.app.post(API_V1 + '/.indexes/books',
+                data=json.dumps({'fields': ['a']}))
+            assert resp.status_code == http_status.CREATED
+
+            resp = self.app.post(API_V1 + '/.indexes/books',
+                data=json.dumps({'fields': ['b']}))
+            assert resp.status_code == http_status.FORBIDDEN
+            assert from_json(resp.data)[STATUS_CODE] == app_status.QUOTA_EXCEEDED
+        finally:
+            self._app.config['MAX_DECLARED_INDEXES'] = 50
+
+    def test_delete_index(self):
+        self._app.config['MAX_APP_INDEXES'] = 1
+        try:
+            resp = self.app.post(API_V1 + '/.indexes/books',
+                data=json.dumps({'fields': ['price', '-rating']}))
+            assert resp.status_code == http_status.CREATED
+            with self._app.test_request_context():
+                keys = [info['key'] for info in storage.entities.index_information().values()]
+            assert [(intf.HASHID, 1), ('price', 1), ('rating', -1), ('_id', -1)] in keys
+
+            resp = self.app.delete(API_V1 + '/.indexes/books',
+                data=json.dumps({'fields': ['price', '-rating']}))
+            assert resp.status_code == http_status.OK
+
+            with self._app.test_request_context():
+                keys = [info['key'] for info in storage.entities.index_information().values()]
+            assert [(intf.HASHID, 1), ('price', 1), ('rating', -1), ('_id', -1)] not in keys
+            resp = from_json(self.app.get(API_V1 + '/.indexes/books').data)
+            assert resp[RESULTS] == []
+
+            resp = self.app.delete(API_V1 + '/.indexes/books',
+                data=json.dumps({'fields': ['price', '-rating']}))
+            assert resp.status_code == http_status.NOT_FOUND
+
+            # quota is freed by deletion
+            resp = self.app.post(API_V1 + '/.indexes/books',
+                data=json.dumps({'fields': ['a']}))
+            assert resp.status_code == http_status.CREATED
+        finally:
+            self._app.config['MAX_APP_INDEXES'] = 10
+
+    def test_declare_geo_index(self):
+        resp = self.app.post(API_V1 + '/.indexes/places',
+            data=json.dumps({'fields': ['a.place'], 'type': '2d'}))
+        assert resp.status_code == http_status.CREATED
+
+        with self._app.test_request_context():
+            keys = [info['key'] for info in storage.entities.index_information().values()]
+        assert [('a.__geo_place', '2d'), (intf.HASHID, 1)] in keys
+
+        resp = from_json(self.app.get(API_V1 + '/.indexes/places').data)
+        assert resp[RESULTS][0]['fields'] == ['a.place']
+        assert resp[RESULTS][0]['type'] == '2d'
+
+        # the only geo index of all apps is taken
+        resp = self.app.post(API_V1 + '/.indexes/places',
+            data=json.dumps({'fields': ['b'], 'type': '2d'}))
+        assert resp.status_code == http_status.FORBIDDEN
+        assert from_json(resp.data)[STATUS_CODE] == app_status.QUOTA_EXCEEDED
+
+    def test_declare_invalid_geo_index(self):
+        for data in [{'fields': ['a', 'b'], 'type': '2d'},
+                     {'fields': ['-a'], 'type': '2d'},
+                     {'fields': ['a'], 'type': 'hashed'}]:
+            resp = self.app.post(API_V1 + '/.indexes/places', data=json.dumps(data))
+            assert resp.status_code == http_status.BAD_REQUEST
+
+
+class ExplainCase(ApiBaseTestClass):
+
+    def setUp(self):
+        super(ExplainCase, self).setUpClass()
+
+        for i in range(10):
+            self.app.post(API_V1 + '/books',
+                data=json.dumps({'a':10, 'b': i}),
+                follow_redirects=True)
+
+    def tearDown(self):
+        super(ExplainCase, self).tearDownClass()
+
+    def test_explain(self):
+        res = self.app.get(API_V1 + '/books?explain=true&filter=%s' % json.dumps({'b': {'$lt': 5}}))
+        assert res.status_code == http_status.OK
+        plan = from_json(res.data)['explain']
+        assert plan['n'] == 5
+        assert intf.HASHID in plan['cursor']
+        assert 'nscanned' in plan
+        assert 'millis' in plan
+
+class CompressionCase(ApiBaseTestClass):
+
+    @classmethod
+    def setUpClass(cls):
+        super(CompressionCase, cls).setUpClass()
+        compression.init_app(cls._app)
+
+    def tearDown(self):
+        super(CompressionCase, self).tearDownClass()
+
+    def gzip(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def test_gzip_request_and_response(self):
+        docs = [{extf.KEY: str(i), 'title': 'Title %d' % i} for i in range(50)]
+        rv = self.app.post(API_V1 + '/books/_bulk', data=self.gzip(json.dumps(docs)),
+                           headers=[('Content-Encoding', 'gzip')])
+        assert rv.status_code == http_status.OK
+        assert len(from_json(rv.data)[RESULTS]) == 50
+
+        headers = [('Accept-Encoding', 'gzip')]
+        rv = self.app.get(API_V1 + '/books?limit=50', headers=headers)
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        res = from_json(zlib.decompress(rv.data, 16 + zlib.MAX_WBITS))
+        assert len(res[RESULTS]) == 50
+
+        rv = self.app.get(API_V1 + '/books?limit=50&stream=true', headers=headers)
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert from_json(zlib.decompress(rv.data, 16 + zlib.MAX_WBITS)) == res
+
+    def test_small_response_is_not_compressed(self):
+        self.app.post(API_V1 + '/books/1', data=json.dumps({'a': 1}))
+        rv = self.app.get(API_V1 + '/books/1', headers=[('Accept-Encoding', 'gzip')])
+        assert 'Content-Encoding' not in rv.headers
+        assert from_json(rv.data)['a'] == 1
+
+    def test_invalid_compressed_body(self):
+        rv = self.app.post(API_V1 + '/books/1', data=json.dumps({'a': 1}),
+                           headers=[('Content-Encoding', 'gzip')])
+        assert rv.status_code == http_status.BAD_REQUEST
+
+    def test_compressed_import_size_limit(self):
+        lines = ''.join(json.dumps({extf.KEY: str(i), 'a': 'x' * 100}) + '\n'
+                        for i in range(100))
+        self._app.config['MAX_DECOMPRESSED_SIZE'] = 1024
+        try:
+            rv = self.app.post(API_V1 + '/books/_import', data=self.gzip(lines),
+                               headers=[('Content-Encoding', 'gzip')])
+            assert rv.status_code == http_status.BAD_REQUEST
+            # the same applies to one long line
+            rv = self.app.post(API_V1 + '/books/_import', data=self.gzip('x' * 2048),
+                               headers=[('Content-Encoding', 'gzip')])
+            assert rv.status_code == http_status.BAD_REQUEST
+        finally:
+            self._app.config['MAX_DECOMPRESSED_SIZE'] = 16 * 1024 * 1024
+
+class ConditionalGetCase(ApiBaseTestClass):
+
+    def setUp(self):
+        super(ConditionalGetCase, self).setUpClass()
+        for i in range(3):
+            self.app.post(API_V1 + '/books/%d' % i, data=json.dumps({'n': i}))
+
+    def tearDown(self):
+        super(ConditionalGetCase, self).tearDownClass()
+
+    def test_document_etag(self):
+        rv = self.app.get(API_V1 + '/books/1')
+        etag = rv.headers['ETag']
+        assert etag.startswith('W/')
+
+        rv = self.app.get(API_V1 + '/books/1', headers=[('If-None-Match', etag)])
+        assert rv.status_code == http_status.NOT_MODIFIED
+        assert rv.data == ''
+
+        time.sleep(0.01)
+        self.app.put(API_V1 + '/books/1', data=json.dumps({'n': 10}))
+        rv = self.app.get(API_V1 + '/books/1', headers=[('If-None-Match', etag)])
+        assert rv.status_code == http_status.OK
+        assert from_json(rv.data)['n'] == 10
+        assert rv.headers['ETag'] != etag
+
+    def test_page_etag(self):
+        rv = self.app.get(API_V1 + '/books?sort=n')
+        etag = rv.headers['ETag']
+        rv = self.app.get(API_V1 + '/books?sort=n', headers=[('If-None-Match', etag)])
+        assert rv.status_code == http_status.NOT_MODIFIED
+
+        self.app.delete(API_V1 + '/books/2')
+        rv = self.app.get(API_V1 + '/books?sort=n', headers=[('If-None-Match', etag)])
+        assert rv.status_code == http_status.OK
+        assert len(from_json(rv.data)[RESULTS]) == 2
+
+    def test_get_version(self):
+        version = storage.get_version(v1.get_app_id(), v1.get_user_id(), 'books', '1')
+        doc = storage.get(v1.get_app_id(), v1.get_user_id(), 'books', '1')
+        assert version == doc[reservedf.CREATED_AT]
+        assert storage.get_version(v1.get_app_id(), v1.get_user_id(), 'books', '100') is None
+
+    def test_get_version_of_new_document(self):
+        self.app.post(API_V1 + '/books/new', data=json.dumps({'n': 5}))
+        doc = storage.get(v1.get_app_id(), v1.get_user_id(), 'books', 'new')
+        assert reservedf.UPDATED_AT not in doc
+        version = storage.get_version(v1.get_app_id(), v1.get_user_id(), 'books', 'new')
+        assert version == doc[reservedf.CREATED_AT]
+
+        etag = self.app.get(API_V1 + '/books/new').headers['ETag']
+        rv = self.app.get(API_V1 + '/books/new', headers=[('If-None-Match', etag)])
+        assert rv.status_code == http_status.NOT_MODIFIED
+
+
+class ProjectionCase(ApiBaseTestClass):
+
+    def setUp(self):
+        super(ProjectionCase, self).setUpClass()
+        for i in range(3):
+            self.app.post(API_V1 + '/books/%d' % i,
+                data=json.dumps({'n': i, 'title': 'Title %d' % i,
+                                 'author': {'name': 'Name', 'bio': 'x' * 100},
+                                 'loc': {TYPE_FIELD: type_codes.GEO_POINT,
+                                         GeoPoint.LATITUDE: 10, GeoPoint.LONGITUDE: 20}}))
+
+    def tearDown(self):
+        super(ProjectionCase, self).tearDownClass()
+
+    def test_fields(self):
+        res = from_json(self.app.get(API_V1 + '/books/1?fields=title,author.name,loc').data)
+        assert res['title'] == 'Title 1'
+        assert res['author'] == {'name': 'Name'}
+        assert res['loc'][TYPE_FIELD] == type_codes.GEO_POINT
+        assert 'n' not in res
+        assert res[extf.KEY] == '1'
+        assert reservedf.CREATED_AT in res
+
+    def test_exclude(self):
+        res = from_json(self.app.get(API_V1 + '/books?sort=n&exclude=author.bio,loc').data)[RESULTS]
+        assert len(res) == 3
+        for doc in res:
+            assert doc['author'] == {'name': 'Name'}
+            assert 'loc' not in doc and 'title' in doc
+
+    def test_exclude_of_required_fields(self):
+        res = from_json(self.app.get(API_V1 + '/books?sort=author.name&limit=2&exclude=author,loc').data)
+        assert CURSOR in res
+        for doc in res[RESULTS]:
+            assert doc['author']['name'] == 'Name'
+            assert 'loc' not in doc
+
+    def test_cursor_field_is_returned(self):
+        res = from_json(self.app.get(API_V1 + '/books?sort=n&limit=2&fields=title').data)
+        assert CURSOR in res
+        assert res[RESULTS][0]['n'] == 0
+
+    def test_invalid_projection(self):
+        rv = self.app.get(API_V1 + '/books?fields=title&exclude=n')
+        assert rv.status_code == http_status.BAD_REQUEST
+        rv = self.app.get(API_V1 + '/books?fields=__hashid__')
+        assert rv.status_code == http_status.BAD_REQUEST
+
+class BulkUpdateCase(ApiBaseTestClass):
+
+    def setUp(self):
+        super(BulkUpdateCase, self).setUpClass()
+        for i in range(3):
+            self.app.post(API_V1 + '/books/%d' % i, data=json.dumps({'n': i}))
+
+    def tearDown(self):
+        super(BulkUpdateCase, self).tearDownClass()
+
+    def test_bulk_update(self):
+        updates = [{extf.KEY: '0', 'title': 'Title0'},
+                   {extf.KEY: '1', '$inc': {'n': 10}},
+                   {extf.KEY: '5', 'title': 'Title5'}]
+        rv = self.app.open(API_V1 + '/books/_bulk', method='PATCH',
+                           data=json.dumps(updates))
+        assert rv.status_code == http_status.OK
+        results = from_json(rv.data)[RESULTS]
+        assert [r[STATUS_CODE] for r in results] == \
+               [app_status.OK, app_status.OK, app_status.NOT_FOUND]
+        assert [r[extf.KEY] for r in results] == ['0', '1', '5']
+
+        assert from_json(self.app.get(API_V1 + '/books/0').data)['title'] == 'Title0'
+        assert from_json(self.app.get(API_V1 + '/books/1').data)['n'] == 11
+        rv = self.app.get(API_V1 + '/books/5')
+        assert rv.status_code == http_status.NOT_FOUND
+
+    def test_bulk_update_without_key(self):
+        rv = self.app.open(API_V1 + '/books/_bulk', method='PATCH',
+                           data=json.dumps([{'title': 'Title'}]))
+        assert rv.status_code == http_status.BAD_REQUEST
+
+    def test_update_and_delete_counts(self):
+        app_id, user_id = v1.get_app_id(), v1.get_user_id()
+        assert storage.update(app_id, user_id, 'books', '127.0.0.1',
+                              {'a': 1}, filter_opts={'n': {'$lt': 2}}) == 2
+        assert storage.update(app_id, user_id, 'books', '127.0.0.1',
+                              {'a': 1}, key='5') == 0
+        assert storage.delete(app_id, user_id, 'books', '127.0.0.1', key='2') == 1
+        assert storage.delete(app_id, user_id, 'books', '127.0.0.1', key='2') == 0
+
+
+class ExpirationCase(ApiBaseTestClass):
+
+    def setUp(self):
+        super(ExpirationCase, self).setUpClass()
+
+    def tearDown(self):
+        storage.bucket_ttls = {}
+        super(ExpirationCase, self).tearDownClass()
+
+    def iso(self, seconds):
+        return (datetime.datetime.utcnow() +
+                datetime.timedelta(seconds=seconds)).isoformat()
+
+    def test_expires_at(self):
+        expires_at = self.iso(3600)
+        rv = self.app.post(API_V1 + '/sessions/s1',
+            data=json.dumps({'user': 'a', reservedf.EXPIRES_AT: expires_at}))
+        assert rv.status_code == http_status.CREATED
+        res = from_json(self.app.get(API_V1 + '/sessions/s1').data)
+        assert res[reservedf.EXPIRES_AT] == expires_at
+
+        rv = self.app.put(API_V1 + '/sessions/s1',
+            data=json.dumps({reservedf.EXPIRES_AT: self.iso(-1)}))
+        assert rv.status_code == http_status.OK
+        rv = self.app.get(API_V1 + '/sessions/s1')
+        assert rv.status_code == http_status.NOT_FOUND
+        res = from_json(self.app.get(API_V1 + '/sessions').data)
+        assert res[RESULTS] == []
+
+        # expired document is replaced by a new one with the same key
+        rv = self.app.post(API_V1 + '/sessions/s1', data=json.dumps({'user': 'b'}))
+        assert rv.status_code == http_status.CREATED
+        res = from_json(self.app.get(API_V1 + '/sessions/s1').data)
+        assert res['user'] == 'b'
+        assert reservedf.EXPIRES_AT not in res
+
+    def test_invalid_expires_at(self):
+        rv = self.app.post(API_V1 + '/sessions/s1',
+            data=json.dumps({reservedf.EXPIRES_AT: 10}))
+        assert rv.status_code == http_status.BAD_REQUEST
+        rv = self.app.post(API_V1 + '/sessions/s1',
+            data=json.dumps({reservedf.CREATED_AT: self.iso(0)}))
+        assert rv.status_code == http_status.BAD_REQUEST
+
+    def test_bucket_ttl(self):
+        storage.bucket_ttls = {'sessions': 60}
+        self.app.post(API_V1 + '/sessions/s1', data=json.dumps({'user': 'a'}))
+        self.app.put(API_V1 + '/sessions/s2?force=true', data=json.dumps({'user': 'b'}))
+        self.app.post(API_V1 + '/books/b1', data=json.dumps({'title': 'a'}))
+
+        for key in ('s1', 's2'):
+            res = from_json(self.app.get(API_V1 + '/sessions/' + key).data)
+            assert res[reservedf.EXPIRES_AT] > res[reservedf.CREATED_AT]
+        res = from_json(self.app.get(API_V1 + '/books/b1').data)
+        assert reservedf.EXPIRES_AT not in res
+
+        with self._app.test_request_context():
+            keys = [info['key'] for info in storage.entities.index_information().values()]
+        assert [(reservedf.EXPIRES_AT, 1)] in keys
+
+
+class AggregateCase(ApiBaseTestClass):
+
+    def setUp(self):
+        super(AggregateCase, self).setUpClass()
+        for category, price in [('a', 10), ('a', 30), ('b', 5), ('c', 1)]:
+            self.app.post(API_V1 + '/books',
+                data=json.dumps({'category': category, 'price': price}))
+        self.app.post(API_V1 + '/shelf', data=json.dumps({'category': 'a', 'price': 100}))
+
+    def tearDown(self):
+        storage.aggregation_framework = True
+        super(AggregateCase, self).tearDownClass()
+
+    def aggregate(self, body):
+        rv = self.app.post(API_V1 + '/books/_aggregate', data=json.dumps(body))
+        assert rv.status_code == http_status.OK
+        return from_json(rv.data)[RESULTS]
+
+    def check_aggregate(self):
+        results = self.aggregate({
+            'filter': {'price': {'$gt': 1}},
+            'group': 'category',
+            'fields': {'n': {'$count': True}, 'total': {'$sum': 'price'},
+                       'avg': {'$avg': 'price'}, 'max': {'$max': 'price'}},
+            'sort': ['-total']})
+        assert results == [
+            {'category': 'a', 'n': 2, 'total': 40, 'avg': 20, 'max': 30},
+            {'category': 'b', 'n': 1, 'total': 5, 'avg': 5, 'max': 5}]
+
+        results = self.aggregate({'fields': {'n': {'$count': True}}})
+        assert results == [{'n': 4}]
+
+        results = self.aggregate({'group': ['category'], 'sort': ['category'], 'limit': 2})
+        assert results == [{'category': 'a'}, {'category': 'b'}]
+
+    def test_aggregate(self):
+        self.check_aggregate()
+
+    def test_aggregate_by_group_command(self):
+        storage.aggregation_framework = False
+        self.check_aggregate()
+
+    def test_invalid_aggregate(self):
+        for body in [{}, {'group': '__hashid__'}, {'group': '_key'}, {'group': '_id'},
+                     {'group': '_bucket'}, {'fields': {'n': {'$max': '_expires_at'}}},
+                     {'fields': {'n': {'$push': 'price'}}},
+                     {'group': 'category', 'sort': ['price']},
+                     {'group': 'category', 'fields': {'category': {'$count': True}}},
+                     {'filter': {'$where': 'true'}, 'group': 'category'},
+                     {'filter': {'place': {'$nearSphere': {TYPE_FIELD: type_codes.GEO_POINT,
+                        GeoPoint.LATITUDE: 2, GeoPoint.LONGITUDE: 2}}}, 'group': 'category'}]:
+            rv = self.app.post(API_V1 + '/books/_aggregate', data=json.dumps(body))
+            assert rv.status_code == http_status.BAD_REQUEST
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
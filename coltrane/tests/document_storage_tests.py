@@ -1,14 +1,22 @@
 import copy
-from coltrane.appstorage import reservedf
+from datetime import datetime, timedelta
+from coltrane.appstorage import reservedf, _internal_id
 
 __author__ = 'nik'
 
+import logging
 import unittest
+from pymongo import GEO2D
 from pymongo.connection import Connection
+from pymongo.errors import AutoReconnect
 
 from coltrane.rest import config
 from coltrane.appstorage.storage import AppdataStorage, _from_external_to_internal, intf
-from coltrane.appstorage.storage import extf
+from coltrane.appstorage.storage import extf, SLOW_LOG
+from coltrane.appstorage.datatypes import GeoPoint
+from coltrane.appstorage.exceptions import DocumentExistsError
+from coltrane.appstorage.purge import Purger, CHECKPOINT_ID, checkpointf
+from coltrane.appstorage.purge import report as purge_report
 
 
 test_database   = config.TestConfig.MONGODB_DATABASE
@@ -255,5 +263,313 @@ class DocumentStorageIntegrationTestCase(unittest.TestCase):
         assert storage.get(app_id, user_id, bucket, client_key) != None
 
 
+    def test_create_many(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'boobs'
+
+        storage.create(app_id, user_id, bucket, self.ip, {extf.KEY: 'a', 'v': 1})
+        storage.create(app_id, user_id, bucket, self.ip, {extf.KEY: 'b', 'v': 2})
+        storage.delete(app_id, user_id, bucket, self.ip, key='b')
+
+        res = storage.create_many(app_id, user_id, bucket, self.ip,
+            [{extf.KEY: 'a', 'v': 10}, {extf.KEY: 'b', 'v': 20}, {'v': 30}])
+        assert [created for _, created in res] == [False, True, True]
+        assert res[0][0] == 'a' and res[1][0] == 'b'
+
+        assert storage.get(app_id, user_id, bucket, 'a')['v'] == 1
+        assert storage.get(app_id, user_id, bucket, 'b')['v'] == 20
+        assert storage.get(app_id, user_id, bucket, res[2][0])['v'] == 30
+
+
+    def test_create_many_with_concurrently_created(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'boobs'
+
+        storage.create(app_id, user_id, bucket, self.ip, {extf.KEY: 'b', 'v': 2})
+        entities = storage.entities
+        # b is created after create_many has checked the keys
+        storage.entities = ConcurrentlyCreated(entities)
+        try:
+            res = storage.create_many(app_id, user_id, bucket, self.ip,
+                [{extf.KEY: 'a', 'v': 10}, {extf.KEY: 'b', 'v': 20}, {extf.KEY: 'c', 'v': 30}])
+        finally:
+            storage.entities = entities
+        assert res == [('a', True), ('b', False), ('c', True)]
+        assert storage.get(app_id, user_id, bucket, 'b')['v'] == 2
+        assert storage.get(app_id, user_id, bucket, 'c')['v'] == 30
+
+    def test_create_over_deleted_replaces_it(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'boobs'
+
+        storage.create(app_id, user_id, bucket, self.ip, {extf.KEY: 'a', 'v': 1, 'w': 1})
+        storage.delete(app_id, user_id, bucket, self.ip, key='a')
+        storage.create(app_id, user_id, bucket, self.ip, {extf.KEY: 'a', 'v': 2})
+        doc = storage.get(app_id, user_id, bucket, 'a')
+        assert doc['v'] == 2 and 'w' not in doc
+
+    def test_create_with_existing_key(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'boobs'
+
+        storage.create(app_id, user_id, bucket, self.ip, {extf.KEY: 'a', 'v': 1})
+        self.assertRaises(DocumentExistsError, storage.create,
+                          app_id, user_id, bucket, self.ip, {extf.KEY: 'a', 'v': 2})
+        assert storage.get(app_id, user_id, bucket, 'a')['v'] == 1
+
+        # the first attempt inserts the document, but its response is lost
+        lost = AppdataStorage(LostInsertResponse(storage.entities))
+        assert lost.create(app_id, user_id, bucket, self.ip, {extf.KEY: 'b', 'v': 1}) == 'b'
+        assert storage.get(app_id, user_id, bucket, 'b')['v'] == 1
+
+    def test_geo_index_is_not_created_by_requests(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'places'
+
+        storage.create(app_id, user_id, bucket, self.ip,
+            {'a': {'place': GeoPoint(10, 20, {GeoPoint.SEARCHING: False})}})
+        storage.find(app_id, user_id, bucket, {'b': 1})
+
+        keys = [info['key'] for info in storage.entities.index_information().values()]
+        assert not [key for key in keys if GEO2D in dict(key).values()]
+
+
+    def test_slow_query_log(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'books'
+        storage.create(app_id, user_id, bucket, self.ip, {'a': 1})
+
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+        handler = Handler()
+        SLOW_LOG.addHandler(handler)
+        storage.slow_query_threshold = 0
+        try:
+            storage.find(app_id, user_id, bucket, {'a': {'$gt': 0}})
+        finally:
+            storage.slow_query_threshold = None
+            SLOW_LOG.removeHandler(handler)
+
+        assert len(records) == 1
+        assert records[0].startswith('find app=1 bucket=books')
+        assert "'$gt': 1" in records[0]
+
+
+    def test_read_secondary(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'books'
+        secondary = Connection(slave_okay=True)[test_database][test_collection]
+        secondary_storage = AppdataStorage(storage.entities, secondary=secondary)
+
+        key = secondary_storage.create(app_id, user_id, bucket, self.ip, {'a': 1})
+
+        for read_secondary in (True, False):
+            doc = secondary_storage.get(app_id, user_id, bucket, key,
+                                        read_secondary=read_secondary)
+            assert doc['a'] == 1
+            docs = secondary_storage.find(app_id, user_id, bucket, {'a': 1},
+                                          read_secondary=read_secondary)
+            assert len(docs) == 1
+
+        assert secondary_storage._reader(True) is secondary
+        assert secondary_storage._reader(False) is storage.entities
+        assert storage._reader(True) is storage.entities
+
+    def test_projection(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'books'
+        storage.create(app_id, user_id, bucket, self.ip,
+                       {extf.KEY: 'p', 'a': 1, 'b': {'c': 2, 'd': 3}})
+
+        doc = storage.get(app_id, user_id, bucket, 'p', fields=['b.c'])
+        assert doc['b'] == {'c': 2}
+        assert 'a' not in doc
+        assert doc[extf.KEY] == 'p'
+        assert reservedf.CREATED_AT in doc
+
+        docs = storage.find(app_id, user_id, bucket, exclude=['a', extf.KEY])
+        assert len(docs) == 1
+        assert 'a' not in docs[0] and docs[0]['b'] == {'c': 2, 'd': 3}
+        assert docs[0][extf.KEY] == 'p'
+
+    def test_upsert(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'books'
+
+        assert storage.upsert(app_id, user_id, bucket, self.ip, {'a': 1, '$inc': {'n': 1}}, 'u')
+        doc = storage.get(app_id, user_id, bucket, 'u')
+        assert doc['a'] == 1 and doc['n'] == 1
+        assert reservedf.CREATED_AT in doc
+        created_at = doc[reservedf.CREATED_AT]
+
+        assert not storage.upsert(app_id, user_id, bucket, self.ip, {'$inc': {'n': 1}}, 'u')
+        doc = storage.get(app_id, user_id, bucket, 'u')
+        assert doc['n'] == 2
+        assert doc[reservedf.CREATED_AT] == created_at
+        assert storage.find(app_id, user_id, bucket, count=True) == 1
+
+        # removed document is replaced by the new one
+        storage.delete(app_id, user_id, bucket, self.ip, key='u')
+        assert storage.upsert(app_id, user_id, bucket, self.ip, {'b': 1}, 'u')
+        doc = storage.get(app_id, user_id, bucket, 'u')
+        assert doc['b'] == 1 and 'a' not in doc
+
+    def test_upsert_retried_after_lost_response(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'books'
+
+        # the first attempt creates the document, but its response is lost
+        lost = AppdataStorage(LostUpsertResponse(storage.entities))
+        assert lost.upsert(app_id, user_id, bucket, self.ip, {'a': 1}, 'u')
+        doc = storage.get(app_id, user_id, bucket, 'u')
+        assert doc['a'] == 1 and reservedf.CREATED_AT in doc
+        assert storage.find(app_id, user_id, bucket, count=True) == 1
+
+    def test_concurrent_upserts_create_one_document(self):
+        app_id = '1'
+        user_id = '1'
+        bucket = 'books'
+
+        # concurrent upsert creates the document right after update of this one misses it
+        concurrent = AppdataStorage(ConcurrentlyUpserted(storage.entities))
+        storage.upsert(app_id, user_id, bucket, self.ip, {'$inc': {'n': 1}}, 'u')
+        assert not concurrent.upsert(app_id, user_id, bucket, self.ip, {'$inc': {'n': 1}}, 'u')
+        doc = storage.get(app_id, user_id, bucket, 'u')
+        assert doc['n'] == 2 and reservedf.CREATED_AT in doc
+        assert storage.find(app_id, user_id, bucket, count=True) == 1
+
+
+class LostUpsertResponse(object):
+    """ Collection whose first upsert is applied but its response is lost """
+
+    def __init__(self, entities):
+        self.entities = entities
+        self.upserts = 0
+
+    def update(self, *args, **kwargs):
+        result = self.entities.update(*args, **kwargs)
+        if kwargs.get('upsert'):
+            self.upserts += 1
+            if self.upserts == 1:
+                raise AutoReconnect('failover')
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.entities, name)
+
+
+class LostInsertResponse(object):
+    """ Collection whose first insert is applied but its response is lost """
+
+    def __init__(self, entities):
+        self.entities = entities
+        self.inserts = 0
+
+    def insert(self, *args, **kwargs):
+        result = self.entities.insert(*args, **kwargs)
+        self.inserts += 1
+        if self.inserts == 1:
+            raise AutoReconnect('failover')
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.entities, name)
+
+
+class ConcurrentlyUpserted(object):
+    """ Collection whose first update matches nothing """
+
+    def __init__(self, entities):
+        self.entities = entities
+        self.updates = 0
+
+    def update(self, *args, **kwargs):
+        self.updates += 1
+        if self.updates == 1:
+            return {'n': 0, 'updatedExisting': False}
+        return self.entities.update(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.entities, name)
+
+
+class ConcurrentlyCreated(object):
+    """ Collection whose first find finds nothing """
+
+    def __init__(self, entities):
+        self.entities = entities
+        self.finds = 0
+
+    def find(self, *args, **kwargs):
+        self.finds += 1
+        if self.finds == 1:
+            return []
+        return self.entities.find(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.entities, name)
+
+
+class PurgeIntegrationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ip = '127.0.0.1'
+        self.checkpoints = c[test_database]['appdatapurge']
+        self.purger = Purger(storage.entities, self.checkpoints,
+                             retention=3600, app_retention={'2': 0},
+                             batch_size=2, pause=0)
+
+    def tearDown(self):
+        storage.entities.drop()
+        self.checkpoints.drop()
+
+    def age(self, app_id, key, hours):
+        """ Moves deletion time of the document hours back """
+        id = _internal_id(app_id, '1', 'books', 0, key)
+        storage.entities.update({intf.ID: id}, {'$set': {
+            reservedf.UPDATED_AT: datetime.utcnow() - timedelta(hours=hours)}})
+
+    def test_purge(self):
+        for app_id in ('1', '2'):
+            for key in ('a', 'b', 'c', 'd'):
+                storage.create(app_id, '1', 'books', self.ip, {'_key': key, 'x': 1})
+            for key in ('a', 'b', 'c'):
+                storage.delete(app_id, '1', 'books', self.ip, key=key)
+        self.age('1', 'a', 2)
+        self.age('1', 'b', 2)
+
+        result = self.purger.run()
+        # app 1 keeps recently deleted c, app 2 has no retention at all
+        assert result[purge_report.REMOVED] == 5
+        assert result[purge_report.BYTES] > 0
+        assert storage.entities.find().count() == 3
+        assert storage.entities.find({intf.DELETED: True}).count() == 1
+        assert storage.get('2', '1', 'books', 'd')['x'] == 1
+
+        checkpoint = self.checkpoints.find_one()
+        assert checkpoint[checkpointf.POSITION] is None
+        assert checkpoint[checkpointf.REMOVED] == 5
+
+        result = self.purger.run()
+        assert result[purge_report.REMOVED] == 0
+
+    def test_purge_is_not_run_twice(self):
+        self.checkpoints.insert({'_id': CHECKPOINT_ID,
+            checkpointf.LOCKED_UNTIL: datetime.utcnow() + timedelta(hours=1)})
+        assert self.purger.run() is None
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
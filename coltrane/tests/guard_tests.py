@@ -1,4 +1,5 @@
 from sqlalchemy.orm import session
+from werkzeug.contrib.cache import SimpleCache
 
 from coltrane.rest.utils import resp_msgs
 
@@ -13,6 +14,7 @@ from coltrane.rest.config import TestConfig
 from coltrane.rest import http_status, app_status, STATUS_CODE
 from coltrane.db.models import User, AppToken, Application
 from coltrane.db.extension import db
+from coltrane.db import authcache
 from coltrane import config
 
 
@@ -40,12 +42,15 @@ class GuardTestCase(unittest.TestCase):
 
         u = User('user_id1', 'ololo@gmail.com', '123456')
         a = Application("Mrazish ololo", "mrazish", "description", u)
+        # user has one token for an app, tokens created by tests are of this one
+        other = Application("Other ololo", "other", "description", u)
         at = AppToken(u,a)
-        db.session.add_all([u, a, at])
+        db.session.add_all([u, a, other, at])
         db.session.commit()
         cls.user = u
         cls.apptoken = at
         cls.application = a
+        cls.other_application = other
         cls.session = db.session
 
 
@@ -77,12 +82,87 @@ class GuardTestCase(unittest.TestCase):
         self.client.delete_cookie(self.app.config.get('SERVER_NAME'), config.COOKIE_APP_TOKEN)
         assert res._status_code == http_status.UNAUTHORIZED
 
+    def test_cached_user_is_invalidated(self):
+        manager = GuardManager()
+        auth_token = self.user.regenerate_auth_tokens()
+
+        user = manager.authenticate_user(auth_token)
+        assert user.id == self.user.id
+        assert manager.authenticate_user(auth_token) is user
+
+        self.user.regenerate_auth_tokens()
+        assert manager.authenticate_user(auth_token) is None
+        assert manager.authenticate_user(self.user.auth_token).id == self.user.id
+
+    def test_unknown_app_token_is_invalidated(self):
+        manager = GuardManager()
+        value = AppToken(self.user, self.other_application).token
+        assert manager.authenticate_app(value) is None
+
+        # unknown token is cached until created token invalidates it
+        generate = AppToken.generate
+        AppToken.generate = lambda self: value
+        try:
+            token = AppToken.create(self.user, self.other_application)
+        finally:
+            AppToken.generate = generate
+        try:
+            assert token.token == value
+            assert manager.authenticate_app(value).id == self.other_application.id
+        finally:
+            db.session.delete(token)
+            db.session.commit()
+
+    def test_shared_cache_is_not_cached_in_process(self):
+        backend = SimpleCache()
+        manager = GuardManager(backend=backend)
+        token = AppToken(self.user, self.other_application)
+        assert manager.authenticate_app(token.token) is None
+
+        db.session.add(token)
+        db.session.commit()
+        try:
+            # invalidation by another process only deletes shared entry
+            backend.delete(authcache.app_key(token.token))
+            assert manager.authenticate_app(token.token).id == self.other_application.id
+        finally:
+            db.session.delete(token)
+            db.session.commit()
+
+    def test_get_or_create_app_token(self):
+        token = AppToken.get_or_create(self.user.id, self.application.id)
+        assert token.token == self.apptoken.token
+
+    def test_get_or_create_app_token_concurrently(self):
+        create = AppToken.__dict__['create']
+        def concurrent_create(user, application):
+            # another worker creates the token after it was looked up
+            db.session.execute(AppToken.__table__.insert().values(
+                user_id=user.id, app_id=application.id, token='concurrent'))
+            db.session.commit()
+            return create.__get__(None, AppToken)(user, application)
+
+        AppToken.create = staticmethod(concurrent_create)
+        try:
+            token = AppToken.get_or_create(self.user.id, self.other_application.id)
+        finally:
+            AppToken.create = create
+        try:
+            assert token.token == 'concurrent'
+            assert AppToken.query.filter((AppToken.user_id == self.user.id) &
+                (AppToken.app_id == self.other_application.id)).count() == 1
+        finally:
+            db.session.delete(token)
+            db.session.commit()
+
+
     @classmethod
     def tearDownClass(cls):
         print "Tearing down"
         db.session.delete(cls.user)
         db.session.delete(cls.apptoken)
         db.session.delete(cls.application)
+        db.session.delete(cls.other_application)
         db.session.commit()
         cls.context.__exit__(None, None, None)
 
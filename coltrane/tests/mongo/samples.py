@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+    Sample documents in internal format and helpers of benchmarks
+    which don't need running MongoDB
+"""
+import copy
+import time
+from datetime import datetime
+
+from bson.binary import Binary
+from bson.dbref import DBRef
+
+from coltrane.appstorage import intf, reservedf
+from coltrane.appstorage.typeconverters import GeoPointConverter
+
+
+def average(v):
+    return sum(v, 0.0) / len(v)
+
+
+def measure(fn, docs):
+    start = time.time()
+    for doc in docs:
+        fn(doc)
+    duration = time.time() - start
+    return duration, len(docs) / duration
+
+
+def internal(doc, key):
+    doc = copy.deepcopy(doc)
+    doc.update({
+        intf.ID: 'app_id1|user_id|books|0|%s' % key,
+        intf.APP_ID: 'app_id1',
+        intf.USER_ID: 'user_id',
+        intf.HASHID: 'app_id1|user_id|books|0',
+        intf.DELETED: 0,
+        intf.IP_ADDRESS: '127.0.0.1',
+        reservedf.CREATED_AT: datetime.utcnow(),
+        reservedf.UPDATED_AT: datetime.utcnow()
+    })
+    return doc
+
+
+small_doc = {'a': {'b': 10}, 'Key1': {'Key2': [1, 2, 3], 'Key3': 'abcdefjhi'}}
+
+nested = {'asdasdsadsad': {'sdafdsfdskfnbkjnb': [234324, 234324, 23234]}}
+big_doc = {'a': {'b': [nested, nested, {'a': 234}],
+                 'Key3': {'Key2': [nested, nested, {'a': 234}],
+                          'Key3dfgfdgfdg': 'New Year'}}}
+
+typed_doc = {
+    'title': u'Moby Dick', 'price': 10.5, 'pages': 635, 'available': True,
+    'tags': [u'novel', u'classic', u'sea'],
+    'author': DBRef('authors', 'app_id1|user_id|authors|0|melville'),
+    'cover': Binary('\x89PNG' * 64),
+    GeoPointConverter.START_FOR_GEO_KEY + 'location': [30.3, 59.9],
+    'reviews': [{'rating': 5, 'text': u'great'}, {'rating': 4, 'text': u'long'}]
+}
+
+documents = (('small', small_doc), ('big', big_doc), ('typed', typed_doc))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    Micro-benchmark of converting documents fetched from db to the external view.
+    Compares the current conversion with the previous recursive one,
+    and two-stage response view (external document then serialize)
+    with the single-pass one. It doesn't need running MongoDB.
+    Usage: python test_conversion.py [iterations]
+"""
+import sys
+
+from coltrane.appstorage import intf, extf, _external_key
+from coltrane.appstorage.storage import _to_external
+from coltrane.appstorage.typeconverters import MAPPING, GeoPointConverter
+from coltrane.rest.api.datatypes import serialize_document, wire_document
+from coltrane.tests.mongo.samples import average, measure, internal, documents
+
+
+def legacy_to_external(document):
+    """ Conversion as it was done before, kept as baseline """
+    def get_external_converter(int_obj):
+        for v in MAPPING:
+            if int_obj.__class__ == v[0]:
+                return v[2]
+        return None
+
+    def _from_dict(doc):
+        external = {}
+        for key in doc:
+            val = doc[key]
+            converter = None
+            if key.startswith(GeoPointConverter.START_FOR_GEO_KEY):
+                converter = GeoPointConverter
+            if not converter:
+                if type(val) == dict:
+                    val = _from_dict(val)
+                elif type(val) == list:
+                    val = _from_list(val)
+                else:
+                    converter = get_external_converter(val)
+            if converter:
+                key, val = converter.to_external(key, val)
+            external[key] = val
+        return external
+
+    def _from_list(l):
+        internal = []
+        for val in l:
+            if type(val) == list:
+                val = _from_list(val)
+            elif type(val) == dict:
+                val = _from_dict(val)
+            else:
+                converter = get_external_converter(val)
+                if converter:
+                    _, val = converter.to_external(None, val)
+            internal.append(val)
+        return internal
+
+    external = {k: v for k, v in document.items() if not k in intf.values()}
+    external = _from_dict(external)
+    external[extf.KEY] = _external_key(document[intf.ID])
+    return external
+
+
+def two_stage_wire(document):
+    return serialize_document(_to_external(document))
+
+
+def representation(val):
+    """ Comparable view of converted document, datatypes don't define __eq__ """
+    if isinstance(val, dict):
+        return dict((k, representation(v)) for k, v in val.items())
+    if isinstance(val, list):
+        return [representation(v) for v in val]
+    if hasattr(val, '__dict__'):
+        return val.__class__.__name__, representation(vars(val))
+    return val
+
+
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+for name, doc in documents:
+    docs = [internal(doc, 'key_%d' % n) for n in range(iterations)]
+    assert representation(_to_external(docs[0])) == \
+           representation(legacy_to_external(docs[0]))
+    assert two_stage_wire(docs[0]) == wire_document(docs[0])
+    for label, fn in (('legacy', legacy_to_external), ('current', _to_external),
+                      ('two-stage wire', two_stage_wire),
+                      ('single-pass wire', wire_document)):
+        res = [measure(fn, docs) for i in range(3)]
+        duration, friq = tuple([average(vals) for vals in zip(*res)])
+        print 'Convert %s documents (%s). Documents amount: %d; Duration: %f; Friquency: %f' %\
+              (name, label, iterations, duration, friq)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+    Micro-benchmark of encoding responses to json by available json modules,
+    compact and pretty. Prints size of response and encoding time.
+    It doesn't need running MongoDB.
+    Usage: python test_encoding.py [responses] [documents per response]
+"""
+import sys
+
+from coltrane.rest.api.datatypes import wire_document
+from coltrane.rest.utils import select_json_encoder, JSON_ENCODERS
+from coltrane.tests.mongo.samples import average, measure, internal, documents
+
+responses = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+per_response = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+encoders = []
+for name in sorted(JSON_ENCODERS):
+    try:
+        encoders.append((name, select_json_encoder([name])))
+    except RuntimeError:
+        print '%s is not installed' % name
+
+for doc_name, doc in documents:
+    response = {'results': [wire_document(internal(doc, 'key_%d' % n))
+                            for n in range(per_response)]}
+    bodies = [response] * responses
+    for name, encoder in encoders:
+        for pretty in (True, False):
+            size = len(encoder(response, pretty))
+            res = [measure(lambda body: encoder(body, pretty), bodies)
+                   for i in range(3)]
+            duration, friq = tuple([average(vals) for vals in zip(*res)])
+            print 'Encode %s documents by %s (%s). Bytes per response: %d; ' \
+                  'Responses amount: %d; Duration: %f; Friquency: %f' %\
+                  (doc_name, name, 'pretty' if pretty else 'compact', size,
+                   responses, duration, friq)
@@ -0,0 +1,114 @@
+import logging
+import unittest
+from pymongo.errors import AutoReconnect
+from coltrane.appstorage.exceptions import StorageError
+from coltrane.appstorage.retry import RetryPolicy, is_idempotent_update, counters, LOG
+from coltrane.appstorage import reservedf
+from coltrane.appstorage.storage import AppdataStorage
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(attempts=3, base_delay=0.001, budget=1.0)
+        self.calls = 0
+
+    def failing(self, failures):
+        def operation():
+            self.calls += 1
+            if self.calls <= failures:
+                raise AutoReconnect('failover')
+            return 'done'
+        return operation
+
+    def test_retries_until_success(self):
+        assert self.policy.call(self.failing(2)) == 'done'
+        assert self.calls == 3
+        assert self.policy.stats() == {counters.RETRIES: 2, counters.GIVE_UPS: 0}
+
+    def test_gives_up_after_attempts(self):
+        self.assertRaises(StorageError, self.policy.call, self.failing(3))
+        assert self.calls == 3
+        assert self.policy.stats() == {counters.RETRIES: 2, counters.GIVE_UPS: 1}
+
+    def test_gives_up_after_budget(self):
+        self.policy = RetryPolicy(attempts=100, base_delay=1.0, budget=0)
+        self.assertRaises(StorageError, self.policy.call, self.failing(1))
+        assert self.calls == 1
+
+    def test_not_idempotent_is_not_replayed(self):
+        self.assertRaises(StorageError, self.policy.call, self.failing(1),
+                          idempotent=False)
+        assert self.calls == 1
+        assert self.policy.stats()[counters.GIVE_UPS] == 1
+
+    def test_stats_are_reported(self):
+        policy = RetryPolicy(base_delay=0.001, report_interval=0)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        LOG.addHandler(handler)
+        LOG.setLevel(logging.INFO)
+        try:
+            policy.call(self.failing(1))
+            policy.call(lambda: 'done')
+            policy.call(lambda: 'done')
+        finally:
+            LOG.removeHandler(handler)
+            LOG.setLevel(logging.NOTSET)
+        # unchanged counters are not reported again
+        assert [r.getMessage() for r in records] == ['Retry stats: give_ups=0 retries=1']
+
+    def test_idempotent_update(self):
+        assert is_idempotent_update({'$set': {'a': 1}, '$unset': {'b': 1}})
+        assert is_idempotent_update({'$addToSet': {'a': 1}})
+        assert not is_idempotent_update({'$set': {'a': 1}, '$inc': {'b': 1}})
+        assert not is_idempotent_update({'$push': {'a': 1}})
+
+
+class FailoverCollection(object):
+    """ Collection whose first update is applied or not but its response is lost """
+
+    def __init__(self, applied=True):
+        self.updates = 0
+        self.applied = applied
+        self.stored = None
+
+    def update(self, spec, document, **kwargs):
+        self.updates += 1
+        if self.updates == 1:
+            if self.applied:
+                self.stored = dict(document['$set'])
+            raise AutoReconnect('failover')
+        return {'n': 0}
+
+    def find_one(self, spec, **kwargs):
+        if self.stored and self.stored[reservedf.UPDATED_AT] == spec[reservedf.UPDATED_AT]:
+            return {'_id': spec['_id']}
+        return None
+
+
+class DeleteRetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.entities = FailoverCollection()
+        self.storage = AppdataStorage(self.entities,
+                                      retry=RetryPolicy(base_delay=0.001))
+
+    def test_delete_by_key_is_not_lost(self):
+        assert self.storage.delete('1', '1', 'books', '127.0.0.1', key='k') == 1
+        assert self.entities.updates == 2
+
+    def test_delete_by_key_of_missing_document(self):
+        self.entities.applied = False
+        assert self.storage.delete('1', '1', 'books', '127.0.0.1', key='k') == 0
+        assert self.entities.updates == 2
+
+    def test_delete_by_filter_is_not_replayed(self):
+        self.assertRaises(StorageError, self.storage.delete, '1', '1', 'books',
+                          '127.0.0.1', filter_opts={'a': 1})
+        assert self.entities.updates == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
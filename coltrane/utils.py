@@ -1,4 +1,7 @@
 from UserDict import DictMixin
+from collections import OrderedDict
+from threading import Lock
+from time import time
 
 def traverse(dct, f):
     def traverse_list(lst, f):
@@ -95,3 +98,45 @@ class EnumMetaclass(type, DictMixin):
 
 
 Enum = EnumMetaclass("Enum", (), {})
+
+
+class TTLCache(object):
+    """ In-process cache, items live for ttl seconds. When the cache holds
+        max_size items the least recently used one is evicted.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return default
+            if expires < time():
+                return default
+            # move item to the end, i.e. mark it as recently used
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time() + self.ttl, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)